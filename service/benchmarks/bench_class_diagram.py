@@ -0,0 +1,72 @@
+import argparse
+import json
+import time
+
+from benchmarks.synthetic import make_dump
+from service.endpoints.class_diagram import build_class_graph
+from service.graph_pipeline import DumpEntry
+from service.tana_types import TanaDump, Visualizer
+from service.tanaparser import FIELD, TAG, NodeIndex
+
+# Time the class diagram, and the tag schema scan in build_tag_index that
+# now also collects field definitions and tag fields, against doing the field
+# extraction as a separate walk over the dump.
+#
+#   python -m benchmarks.bench_class_diagram --nodes 200000
+#   python -m benchmarks.bench_class_diagram --dump ~/Downloads/workspace.json
+
+def separate_field_walk(index:NodeIndex):
+  # what a second, field only, walk over the dump would cost
+  field_defs = {}
+  tag_tuples = []
+  for node in index.tana_dump.docs:
+    if node.id not in index.index or not node.children or 'SYS' in node.id:
+      continue
+    if TAG in node.children and FIELD in node.children:
+      meta_node = index.index.get(node.props.ownerId)
+      if meta_node and meta_node.props.ownerId in index.index:
+        field_defs[meta_node.props.ownerId] = index.index[meta_node.props.ownerId].props.name
+    elif node.props.docType == 'tuple' and node.props.ownerId in index.index:
+      if index.index[node.props.ownerId].props.docType == 'tagDef':
+        tag_tuples.append((node.props.ownerId, node.children[0]))
+  return field_defs, [pair for pair in tag_tuples if pair[1] in field_defs]
+
+
+def timed(label, func):
+  start = time.perf_counter()
+  result = func()
+  print(f'{label:36s}{time.perf_counter() - start:8.3f}s')
+  return result
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--nodes', type=int, default=200_000)
+  parser.add_argument('--tags', type=int, default=200)
+  parser.add_argument('--fields', type=int, default=400)
+  parser.add_argument('--dump', help='use a real Tana JSON export instead')
+  args = parser.parse_args()
+
+  if args.dump:
+    with open(args.dump, 'rb') as f:
+      body = f.read()
+  else:
+    print(f'Generating a dump with {args.nodes:,} nodes, {args.tags} tags and {args.fields} fields...')
+    body = json.dumps(make_dump(args.nodes, args.tags, args.fields)).encode('utf-8')
+  tana_dump = timed('parse', lambda: TanaDump.model_validate_json(body))
+
+  index = NodeIndex(tana_dump=tana_dump, config=Visualizer())
+  timed('build_index', index.build_index)
+  timed('build_tag_index (tags + fields)', index.build_tag_index)
+  timed('separate field walk', lambda: separate_field_walk(index))
+  print(f'{len(index.tags)} tags, {len(index.field_defs)} fields, '
+        f'{sum(len(fields) for fields in index.tag_fields.values())} tag fields')
+
+  # fresh parse, since NodeIndex updates the nodes
+  entry = DumpEntry('bench', TanaDump.model_validate_json(body))
+  graph = timed('class diagram (excluding parse)', lambda: build_class_graph(entry))
+  print(f'{len(graph.nodes)} classes, {len(graph.links)} links')
+
+
+if __name__ == '__main__':
+  main()
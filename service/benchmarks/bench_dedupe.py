@@ -0,0 +1,67 @@
+import argparse
+import random
+import time
+
+from service.graphops import dedupe_edges, encode_pairs
+
+# Compare the original set based link dedupe used by /graph and /topics
+# against the NumPy based dedupe_edges() on large synthetic edge lists.
+#
+#   python -m benchmarks.bench_dedupe --edges 10000000
+
+REASONS = ['iin', 'iir', 'itl', 'itn', 'icl', 'icr', 'ifl', 'its']
+
+def make_pairs(edges, nodes, seed=42):
+  rng = random.Random(seed)
+  ids = [f'node{n:08d}' for n in range(nodes)]
+  pairs = []
+  for _ in range(edges):
+    a = ids[rng.randrange(nodes)]
+    b = ids[rng.randrange(nodes)]
+    r = REASONS[rng.randrange(len(REASONS))]
+    # roughly a third are duplicates or reversed duplicates
+    pairs.append((a, b, r))
+    if rng.random() < 0.33:
+      pairs.append((b, a, r) if rng.random() < 0.5 else (a, b, r))
+  return pairs[:edges], ids
+
+
+def legacy_dedupe(pairs):
+  candidate_pairs = set(pairs)
+  final_pairs = set()
+  [final_pairs.add((a, b, r)) for (a, b, r) in candidate_pairs
+    if (a, b, r) not in final_pairs and (b, a, r) not in final_pairs]
+  return final_pairs
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--edges', type=int, default=10_000_000)
+  parser.add_argument('--nodes', type=int, default=1_000_000)
+  parser.add_argument('--skip-legacy', action='store_true')
+  args = parser.parse_args()
+
+  print(f'Generating {args.edges:,} edges over {args.nodes:,} nodes...')
+  pairs, ids = make_pairs(args.edges, args.nodes)
+
+  if not args.skip_legacy:
+    start = time.perf_counter()
+    legacy = legacy_dedupe(pairs)
+    took = time.perf_counter() - start
+    print(f'legacy set dedupe:          {took:8.2f}s  {len(legacy):,} links')
+
+  start = time.perf_counter()
+  edges = encode_pairs(pairs, ids)
+  encoded = time.perf_counter()
+  deduped = dedupe_edges(edges)
+  done = time.perf_counter()
+  print(f'encode_pairs:               {encoded - start:8.2f}s')
+  print(f'dedupe_edges:               {done - encoded:8.2f}s  {len(deduped):,} links')
+  print(f'total (encode + dedupe):    {done - start:8.2f}s')
+
+  if not args.skip_legacy:
+    assert len(deduped) == len(legacy)
+
+
+if __name__ == '__main__':
+  main()
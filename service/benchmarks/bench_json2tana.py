@@ -0,0 +1,204 @@
+import argparse
+import random
+import sys
+import time
+
+from service.json2tana import tana_to_json
+
+# Throughput (MB/s) of tana_to_json, as used by /jsonify, /tana-to-code and
+# friends, against the original two pass version on a few shapes of paste:
+#
+#   shallow  a long flat list of nodes, some with fields (a big Tana table)
+#   deep     a deeply nested outline
+#   code     nodes with multi-line code blocks as siblings and field values
+#
+#   python -m benchmarks.bench_json2tana --mb 4
+
+
+def legacy_tana_to_json(tana_format):
+  # tana_to_json as it was, kept here for comparison
+
+  def add_child(obj, child):
+    if 'children' not in obj:
+      obj['children'] = []
+    obj['children'].append(child)
+
+  stack = []
+  top = { 'name': 'ROOT', 'is_field': False}
+  current = top
+  stack.append(top)
+  current_level = 1
+  in_code_block = False
+  code_block = ""
+
+  for line in tana_format.split('\n'):
+
+    line = line.rstrip()
+    if line == '' or line == '-':
+      continue
+
+    if in_code_block:
+      code_block += line +'\n'
+      if '```' in line and line[0:3] == '```':
+        in_code_block = False
+        if current['is_field']:
+          current['value'] = code_block
+        else:
+          # code block is sibling
+          newobj = { 'name': code_block, 'is_field': False, 'field': None, 'value': None  }
+          add_child(stack[-1], newobj)
+          current = newobj
+      continue
+
+    if '-' not in line:
+      # this could be a code block or other multi-line value
+      if '```' in line:
+        code_block = line + '\n'
+        in_code_block = True
+        continue
+
+    # count leading spaces
+    leader = line.split('-')[0]
+    level = int(len(leader) / 2) + 1
+
+    line = line.lstrip(' -')
+
+    field = None
+    value = None
+
+    is_field = '::' in line
+
+    if is_field:
+      fields = line.split('::')
+      field = fields[0].strip()
+      if fields[1].strip() != '':
+        value = fields[1].strip()
+
+    newobj = { 'name': line, 'is_field': is_field, 'field': field, 'value': value  }
+    if level < current_level:  #exdent
+      # pop off as many as needed
+      stack = stack[0:level - current_level]
+      add_child(stack[-1], newobj)
+      current = newobj
+      current_level = level
+
+    elif level > current_level:
+      # indent, means child of current
+      add_child(current, newobj)
+      stack.append(current)
+      current = newobj
+      current_level = level
+    else:
+      # same level, means add as child to same parent
+      add_child(stack[-1], newobj)
+      current = newobj
+
+  def hoist_field(node, parent):
+    value = node['value']
+    if 'children' in node:
+      children = node['children']
+      # if value is non-null and children is non-null, we have a problem
+      if value and children:
+        raise TypeError('Field with both value and children is not supported')
+      if children:
+        value = children
+    parent[node['field']] = value
+
+  def process_node(node):
+    is_field = False
+    if 'is_field' in node and node['is_field']:
+      is_field = True
+      newnode = {'field': node['field'], 'value': node['value']}
+    else:
+      newnode = { 'name': node['name']}
+
+    if 'children' in node:
+      value_node = newnode
+      # fields with fields are special...
+      if is_field:
+        if node['value'] is None:
+          node['value'] = {}
+        value_node = node['value']
+        newnode['value'] = value_node
+
+      for child in node['children']:
+        newchild = process_node(child)
+        if child['is_field']:
+          hoist_field(newchild, value_node)
+        else:
+          add_child(newnode, newchild)
+    return newnode
+
+  result = process_node(top)
+  return result['children']
+
+
+def shallow_paste(size:int, seed:int=42) -> str:
+  rng = random.Random(seed)
+  lines = ['- Big table #table']
+  while sum(map(len, lines)) < size:
+    n = len(lines)
+    lines.append(f'  - Row {n} with a [[reference^ref{n}]] #row')
+    for column in range(rng.randrange(1, 5)):
+      lines.append(f'    - Column {column}:: value {rng.randrange(1000)}')
+  return '\n'.join(lines)
+
+
+def deep_paste(size:int, depth:int=200, seed:int=42) -> str:
+  rng = random.Random(seed)
+  lines = []
+  level = 0
+  while sum(map(len, lines)) < size:
+    lines.append('  ' * level + f'- Node {len(lines)} at depth {level}')
+    # mostly down, now and again back up a long way
+    level = level + 1 if level < depth and rng.random() < 0.9 else rng.randrange(level + 1)
+  return '\n'.join(lines)
+
+
+def code_paste(size:int, seed:int=42) -> str:
+  rng = random.Random(seed)
+  lines = ['- Snippets']
+  while sum(map(len, lines)) < size:
+    n = len(lines)
+    if rng.random() < 0.5:
+      lines.append(f'  - Snippet {n}')
+      lines.append('```python')
+    else:
+      lines.append(f'  - Code {n}::')
+      lines.append('```')
+    for row in range(rng.randrange(5, 40)):
+      lines.append(f'    result_{row} = compute(value_{row}, {row} * 2)  # line {row}')
+    lines.append('```')
+  return '\n'.join(lines)
+
+
+def throughput(convert, paste:str, repeat:int) -> float:
+  best = float('inf')
+  for _ in range(repeat):
+    start = time.perf_counter()
+    convert(paste)
+    best = min(best, time.perf_counter() - start)
+  return len(paste.encode('utf-8')) / best / 1e6
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--mb', type=float, default=4.0)
+  parser.add_argument('--depth', type=int, default=200)
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  size = int(args.mb * 1e6)
+  pastes = {'shallow': shallow_paste(size), 'deep': deep_paste(size, args.depth), 'code': code_paste(size)}
+  # the original recursed once per level
+  sys.setrecursionlimit(max(sys.getrecursionlimit(), args.depth * 2 + 100))
+  print(f'{args.mb} MB pastes, deep ones {args.depth} levels')
+  for label, paste in pastes.items():
+    assert tana_to_json(paste) == legacy_tana_to_json(paste)
+    before = throughput(legacy_tana_to_json, paste, args.repeat)
+    after = throughput(tana_to_json, paste, args.repeat)
+    print(f'{label:8s} before {before:7.2f} MB/s   after {after:7.2f} MB/s   x{after / before:.2f}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,75 @@
+import argparse
+import tempfile
+import time
+
+import numpy as np
+
+from service.graphlayout import affordable_iterations, cached_layout, force_layout
+from service.processpool import TASK_TIMEOUT
+from service.settings import settings
+
+# Server side layout (/graph?layout=3) for random graphs of growing size,
+# all of it run in a process pool task with a TASK_TIMEOUT limit:
+#
+#   fixed      the original: always 120 iterations, however big the graph
+#   budgeted   cached_layout, cold: iterations cut to LAYOUT_WORK_BUDGET,
+#              no layout at all past MIN_ITERATIONS
+#   warm       cached_layout again after 5% more nodes
+#
+#   python -m benchmarks.bench_layout --nodes 5000 20000 50000 100000 --dim 3
+
+ITERATIONS = 120
+
+
+def random_graph(n:int, links_per_node:float, seed:int=0):
+  rng = np.random.default_rng(seed)
+  count = int(n * links_per_node)
+  return rng.integers(0, n, count), rng.integers(0, n, count)
+
+
+def timed(layout):
+  start = time.perf_counter()
+  positions = layout()
+  return time.perf_counter() - start, positions
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--nodes', type=int, nargs='+', default=[5000, 20000, 50000, 100000])
+  parser.add_argument('--dim', type=int, choices=[2, 3], default=3)
+  parser.add_argument('--links', type=float, default=2.0, help='links per node')
+  parser.add_argument('--skip-fixed', action='store_true', help="don't time the original, it's slow")
+  args = parser.parse_args()
+
+  # don't touch the real layout cache on disk
+  settings.temp_files = tempfile.mkdtemp()
+
+  print(f'task timeout {TASK_TIMEOUT:.0f}s')
+  for n in args.nodes:
+    src, dst = random_graph(n, args.links)
+    node_ids = [f'n{code}' for code in range(n)]
+    results = [f'{n:7d} nodes']
+    if not args.skip_fixed:
+      elapsed, _ = timed(lambda: force_layout(src, dst, n, args.dim, ITERATIONS))
+      results.append(f'fixed {elapsed:6.1f}s')
+
+    iterations = affordable_iterations(n, args.dim, ITERATIONS)
+    workspace = f'bench{n}'
+    elapsed, positions = timed(lambda: cached_layout(workspace, node_ids, src, dst, args.dim, ITERATIONS))
+    results.append(f'budgeted {elapsed:6.1f}s ({iterations} iterations)' if positions is not None
+                   else f'budgeted {elapsed:6.1f}s (left to the client)')
+
+    if positions is not None:
+      # each new node linked to one we had
+      more = n + n // 20
+      rng = np.random.default_rng(1)
+      more_src = np.concatenate([src, np.arange(n, more)])
+      more_dst = np.concatenate([dst, rng.integers(0, n, more - n)])
+      more_ids = [f'n{code}' for code in range(more)]
+      elapsed, _ = timed(lambda: cached_layout(workspace, more_ids, more_src, more_dst, args.dim, ITERATIONS))
+      results.append(f'warm {elapsed:6.1f}s')
+    print('   '.join(results))
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,125 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import time
+
+from fastapi import FastAPI, Request, Response
+from rich.console import Console
+from rich.logging import RichHandler
+from snowflake import SnowflakeGenerator
+
+from service.endpoints import inlinerefs
+from service.requestcontext import RequestContextMiddleware
+from service.settings import settings
+
+# Per-request overhead of the request middleware, on a small endpoint.
+#
+#   none     no middleware at all
+#   before   the two @app.middleware("http") functions main.py used to have
+#   after    RequestContextMiddleware
+#
+# Requests are sent straight to the ASGI app, with no server or HTTP client in
+# the way, and logged through a Rich handler (to /dev/null) as the service does.
+#
+#   python -m benchmarks.bench_middleware --requests 5000
+
+logger = logging.getLogger()
+
+BODY = json.dumps({'nodeId': 'abc', 'context': '- A node with [[an inline ref^abc123]] and [[another^def456]]\n  - child'}).encode()
+
+
+def legacy_app() -> FastAPI:
+  app = FastAPI()
+  app.include_router(inlinerefs.router)
+
+  @app.middleware("http")
+  async def add_get_authorization_headers(request: Request, call_next):
+    x_tana_api_token = request.headers.get('x-tana-api-token')
+    x_openai_api_key = request.headers.get('x-openai-api-key')
+    settings.openai_api_key = settings.openai_api_key if not x_openai_api_key else x_openai_api_key
+    settings.tana_api_token = settings.tana_api_token if not x_tana_api_token else x_tana_api_token
+    return await call_next(request)
+
+  snowflakes = SnowflakeGenerator(42)
+
+  @app.middleware("http")
+  async def log_entry_exit(request: Request, call_next):
+    x_request_id = request.headers.get('x-request-id')
+    idem = next(snowflakes) if not x_request_id else x_request_id
+    if not x_request_id:
+      request.headers.__dict__["_list"].append((b'x-request-id', bytes(str(idem), 'utf-8')))
+    logger.info(f"txid={idem} start request path={request.url.path}")
+    start_time = time.time()
+    response:Response = await call_next(request)
+    process_time = (time.time() - start_time) * 1000
+    logger.info(f"txid={idem} completed_in={process_time:.2f}ms status_code={response.status_code}")
+    if not x_request_id:
+      response.headers['x-request-id'] = str(idem)
+    return response
+
+  return app
+
+
+def plain_app() -> FastAPI:
+  app = FastAPI()
+  app.include_router(inlinerefs.router)
+  return app
+
+
+def new_app() -> FastAPI:
+  app = plain_app()
+  app.add_middleware(RequestContextMiddleware)
+  return app
+
+
+async def call(app, scope):
+  sent = False
+  async def receive():
+    nonlocal sent
+    if sent:
+      await asyncio.sleep(3600)
+    sent = True
+    return {'type': 'http.request', 'body': BODY, 'more_body': False}
+  status = None
+  async def send(message):
+    nonlocal status
+    if message['type'] == 'http.response.start':
+      status = message['status']
+  await app(dict(scope, headers=list(scope['headers'])), receive, send)
+  return status
+
+
+async def run(app, requests:int) -> float:
+  scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': 'POST',
+           'scheme': 'http', 'path': '/inlinerefs', 'raw_path': b'/inlinerefs', 'query_string': b'',
+           'root_path': '', 'headers': [(b'content-type', b'application/json'), (b'host', b'localhost')],
+           'client': ('127.0.0.1', 1234), 'server': ('127.0.0.1', 8000)}
+  assert await call(app, scope) == 200
+  # warm up, then time
+  for _ in range(100):
+    await call(app, scope)
+  start = time.perf_counter()
+  for _ in range(requests):
+    await call(app, scope)
+  return (time.perf_counter() - start) / requests
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--requests', type=int, default=5000)
+  args = parser.parse_args()
+
+  logging.basicConfig(level=logging.INFO, handlers=[
+    RichHandler(console=Console(file=open(os.devnull, 'w'), force_terminal=True, width=100), show_time=False)])
+
+  results = {}
+  for label, make_app in [('none', plain_app), ('before', legacy_app), ('after', new_app)]:
+    results[label] = asyncio.run(run(make_app(), args.requests))
+    overhead = results[label] - results['none']
+    print(f'{label:8s}{results[label] * 1e6:9.1f} us/request   overhead {overhead * 1e6:8.1f} us')
+
+
+if __name__ == '__main__':
+  main()
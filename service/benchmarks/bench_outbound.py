@@ -0,0 +1,90 @@
+import argparse
+import asyncio
+import http.server
+import threading
+import time
+
+import httpx
+
+from service.outbound import Outbound
+from service.settings import settings
+
+# Calls out to a local keep-alive HTTP server, concurrently:
+#
+#   client per call   a new httpx client (and connection) each time, as home.py did
+#   shared pool       the shared outbound client, reusing connections
+#   cached            the same, for a response it may cache (max-age)
+#
+#   python -m benchmarks.bench_outbound --calls 2000 --concurrency 16
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+  protocol_version = 'HTTP/1.1'
+  body = b'{"name": "node"}' * 64
+
+  def do_GET(self):
+    self.send_response(200)
+    self.send_header('content-type', 'application/json')
+    self.send_header('content-length', str(len(self.body)))
+    if self.path == '/cacheable':
+      self.send_header('cache-control', 'max-age=300')
+    self.end_headers()
+    self.wfile.write(self.body)
+
+  def log_message(self, *args):
+    pass
+
+
+async def load(call, calls:int, concurrency:int) -> float:
+  remaining = calls
+  async def user():
+    nonlocal remaining
+    while remaining > 0:
+      remaining -= 1
+      response = await call()
+      response.raise_for_status()
+  start = time.perf_counter()
+  await asyncio.gather(*[user() for _ in range(concurrency)])
+  return calls / (time.perf_counter() - start)
+
+
+async def run(base:str, calls:int, concurrency:int):
+  async def client_per_call():
+    async with httpx.AsyncClient() as client:
+      return await client.get(f'{base}/data')
+
+  outbound = Outbound()
+  # leave room for the concurrency we're testing
+  settings.outbound_max_connections_per_host = concurrency
+  try:
+    results = {
+      'client per call': await load(client_per_call, calls, concurrency),
+      'shared pool': await load(lambda: outbound.client.get(f'{base}/data'), calls, concurrency),
+      'cached': await load(lambda: outbound.client.get(f'{base}/cacheable'), calls, concurrency),
+    }
+    stats = outbound.stats()
+  finally:
+    await outbound.close()
+  return results, stats
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--calls', type=int, default=2000)
+  parser.add_argument('--concurrency', type=int, default=16)
+  args = parser.parse_args()
+
+  server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  base = f'http://127.0.0.1:{server.server_address[1]}'
+  results, stats = asyncio.run(run(base, args.calls, args.concurrency))
+  server.shutdown()
+
+  print(f'{args.calls} calls, {args.concurrency} at a time')
+  for label, rate in results.items():
+    print(f'{label:16s} {rate:9.1f} calls/s')
+  print(f'connections kept open {stats.connections}, cache hits {stats.cache_hits_total}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,73 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import httpx
+
+from benchmarks.bench_workers import make_paste, start_service
+from benchmarks.synthetic import make_dump
+from service.workers import PROCESSES_ENV
+
+# Latency of a light request (/echo) while heavy ones (/graph on a big dump,
+# /tana-to-code on a big paste) are running, with the heavy work on the event
+# loop (TANA_HELPER_PROCESSES=0, in the threadpool) and in the process pool.
+# Each run gets a fresh service. Needs the webapp built (service/dist).
+#
+#   python -m benchmarks.bench_processpool --nodes 20000 --seconds 10
+
+
+def percentile(values, p):
+  values = sorted(values)
+  return values[min(int(p * len(values)), len(values) - 1)] if values else 0.0
+
+
+async def load(base:str, dump:bytes, paste:str, heavy:int, seconds:float):
+  latencies = []
+  heavy_done = 0
+  deadline = time.perf_counter() + seconds
+  async with httpx.AsyncClient(base_url=base, timeout=300.0) as client:
+    async def heavy_user(n):
+      nonlocal heavy_done
+      while time.perf_counter() < deadline:
+        if n % 2:
+          response = await client.post('/graph', content=dump)
+        else:
+          response = await client.post('/tana-to-code', json=paste)
+        response.raise_for_status()
+        heavy_done += 1
+
+    async def light_user():
+      while time.perf_counter() < deadline:
+        start = time.perf_counter()
+        response = await client.post('/echo', json='ping')
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(0.05)
+
+    await asyncio.gather(light_user(), *[heavy_user(n) for n in range(heavy)])
+  return latencies, heavy_done
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--nodes', type=int, default=20000)
+  parser.add_argument('--heavy', type=int, default=2, help='concurrent heavy requests')
+  parser.add_argument('--seconds', type=float, default=10.0)
+  args = parser.parse_args()
+
+  dump = json.dumps(make_dump(args.nodes)).encode()
+  paste = make_paste(args.nodes // 4)
+  print(f'{os.cpu_count()} cores, {args.nodes} node dump, {args.heavy} concurrent heavy requests')
+  for label, processes in [('event loop', '0'), ('process pool', None)]:
+    env = {PROCESSES_ENV: processes} if processes is not None else {}
+    with start_service(env) as base:
+      latencies, heavy_done = asyncio.run(load(base, dump, paste, args.heavy, args.seconds))
+    print(f'{label:14s} /echo p50 {percentile(latencies, 0.5) * 1000:8.1f} ms  '
+          f'p99 {percentile(latencies, 0.99) * 1000:8.1f} ms  '
+          f'max {max(latencies) * 1000:8.1f} ms   heavy {heavy_done / args.seconds:6.2f}/s')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,71 @@
+import argparse
+import codecs
+import json
+import time
+import tracemalloc
+
+from benchmarks.bench_tanify import legacy_json_to_tana, make_json
+from service.endpoints.proxy import convert
+from service.jsonstream import JSONStream
+
+# Converting a big JSON array response to Tana format, as the proxy does,
+# fed in 64 KB chunks the way it arrives from upstream:
+#
+#   buffered   the original: wait for all of it, json.loads, json_to_tana
+#   streamed   parse as it arrives, converting each element once complete
+#
+# Reports time to the first Tana output, total time and peak memory.
+#
+#   python -m benchmarks.bench_proxy --mb 10 50
+
+CHUNK = 64 * 1024
+
+
+def buffered(chunks):
+  content = b''.join(chunks)
+  yield legacy_json_to_tana(json.loads(content.decode('unicode_escape')))
+
+
+def streamed(chunks):
+  stream = JSONStream()
+  decoder = codecs.getincrementaldecoder('unicode_escape')()
+  for data in chunks:
+    tana_format = convert(stream, decoder, data)
+    if tana_format:
+      yield tana_format
+  yield convert(stream, decoder, b'', True)
+
+
+def measure(proxy, chunks):
+  start = time.perf_counter()
+  first = None
+  for _ in proxy(chunks):
+    # as if sent on
+    first = first or time.perf_counter() - start
+  elapsed = time.perf_counter() - start
+  tracemalloc.start()
+  for _ in proxy(chunks):
+    pass
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return first, elapsed, peak / 1e6
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--mb', type=float, nargs='+', default=[1, 10, 50])
+  args = parser.parse_args()
+
+  for mb in args.mb:
+    content = json.dumps(make_json(int(mb * 1e6))).encode()
+    chunks = [content[i:i + CHUNK] for i in range(0, len(content), CHUNK)]
+    assert ''.join(streamed(chunks)) == ''.join(buffered(chunks))
+    results = [f'{mb:6.1f} MB']
+    for label, proxy in [('buffered', buffered), ('streamed', streamed)]:
+      first, elapsed, peak = measure(proxy, chunks)
+      results.append(f'{label} first {first * 1000:8.1f} ms  total {elapsed:6.2f} s  peak {peak:7.1f} MB')
+    print('   '.join(results))
+
+
+if __name__ == '__main__':
+  main()
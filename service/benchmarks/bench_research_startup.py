@@ -0,0 +1,61 @@
+import argparse
+import asyncio
+import subprocess
+import sys
+import time
+
+# Measure what the research stack costs, and who pays for it:
+#
+#   startup   importing service.main, which no longer imports llama_index
+#   cold      the first research request: import llama_index, build the index
+#   warm      every request after that
+#
+# Needs llama_index and chromadb installed, plus an OpenAI key (settings or
+# OPENAI_API_KEY) for the optional --query.
+#
+#   python -m benchmarks.bench_research_startup
+#   python -m benchmarks.bench_research_startup --query "What did I decide about pricing?"
+
+def subprocess_seconds(code:str) -> float:
+  '''Wall time of running code in a fresh interpreter, less the interpreter itself.'''
+  def run(source):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', source], check=True, capture_output=True)
+    return time.perf_counter() - start
+  return run(code) - run('pass')
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--model', default='openai')
+  parser.add_argument('--query', help='also time a research call, cold and warm')
+  args = parser.parse_args()
+
+  print(f'{"import service.main":36s}{subprocess_seconds("import service.main"):8.3f}s')
+  print(f'{"import service.llamaindex":36s}{subprocess_seconds("import service.llamaindex"):8.3f}s')
+
+  from service.endpoints.research import RESEARCH_FAN_OUT, RESEARCH_RATE_LIMIT, ResearchStack
+  from service.txntimer import StageTimings
+
+  async def load(stack):
+    start = time.perf_counter()
+    module = await stack.load()
+    return module, time.perf_counter() - start
+
+  stack = ResearchStack(model=args.model)
+  module, cold = asyncio.run(load(stack))
+  _, warm = asyncio.run(load(stack))
+  print(f'{"research stack, cold":36s}{cold:8.3f}s  (import {stack.status.import_seconds or 0:.3f}s, '
+        f'index {stack.status.index_seconds or 0:.3f}s)')
+  print(f'{"research stack, warm":36s}{warm:8.3f}s')
+
+  if args.query:
+    for label in ('research call, first', 'research call, second'):
+      timings = StageTimings()
+      start = time.perf_counter()
+      module.research(args.query, args.model, timings, RESEARCH_FAN_OUT, RESEARCH_RATE_LIMIT)
+      print(f'{label:36s}{time.perf_counter() - start:8.3f}s  {timings.server_timing()}')
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+from service.json2tana import json_to_tana, tana_lines
+
+# Time and peak memory of JSON to Tana paste conversion (/tanify, /proxy) on
+# ever bigger JSON arrays, against the original version, which built the
+# paste up by string concatenation, a copy at every level of nesting.
+#
+#   json_to_tana  the lines, joined once
+#   streamed      the lines written to a file as they come, as /tanify does
+#
+#   python -m benchmarks.bench_tanify --mb 1 5 25 50
+
+
+def legacy_code_to_tana(value, indent):
+  line = ''
+  splits = value.split('<br>')
+  for split in splits:
+    if len(split) == 0:
+      # skip the blank entry on the end...
+      continue
+    # count spaces
+    strip = split.lstrip(' ')
+    spaces = len(split) - len(strip)
+    line += ' '*(indent + spaces) + '- ' + strip + '\n'
+  indent -= 2
+  return line
+
+
+def legacy_children_to_tana(objects, initial_indent):
+  tana_format = ''
+
+  for obj in objects:
+    indent = initial_indent
+    children = [] # assume no children initially
+    # do name first. If empty, we're a field with fields...
+    if 'name' in obj and obj['name'] is not None:
+      name = obj['name']
+
+      if '```' in name:
+        # name is in fact code block
+        tana_format += legacy_code_to_tana(name, indent)
+      else:
+        tana_format += ' '*indent + '- ' + name +'\n'
+
+      indent += 2
+
+    for key in obj.keys():
+      line = ''
+      value = obj[key]
+      if key == 'name':
+        continue
+      elif key == 'children':
+        children = value
+        # skip for now
+      else:
+        # do all the fields first
+        if '```' in value:
+          # code block needs special handling
+          line = ' '*indent + '- ' + key + '::\n'
+          line += legacy_code_to_tana(value, indent+2)
+          tana_format += line
+        elif type(value) is list:
+          # multi-valued fields need special handling
+          tana_format += ' '*indent + '- ' + key + '::\n'
+          chunk = legacy_children_to_tana(value, indent+2)
+          tana_format += chunk
+        elif type(value) is str:
+          # just a plain valued field
+          tana_format += ' '*indent + '- ' + key + ':: ' + value + '\n'
+        else:
+          # must be an object type, recurse
+          tana_format += ' '*indent + '- ' + key + '::\n'
+          chunk = legacy_children_to_tana([value], indent+2)
+          tana_format += chunk
+
+    # now do children recursively
+    if len(children) > 0:
+      chunk = legacy_children_to_tana(children, indent)
+      if chunk != '':
+        tana_format += chunk
+
+  return tana_format
+
+
+def legacy_json_to_tana(json_format):
+  # json_to_tana as it was, kept here for comparison
+  tana_format = ''
+  indent = 0
+  if type(json_format) is not list:
+    json_format = [json_format]
+
+  chunk = legacy_children_to_tana(json_format, indent)
+  tana_format += chunk
+
+  return tana_format
+
+
+def make_json(size:int, seed:int=42) -> list:
+  '''An array of records, the kind of thing an API hands the proxy, of about size bytes as JSON.'''
+  rng = random.Random(seed)
+  records = []
+  total = 0
+  while total < size:
+    n = len(records)
+    record = {'name': f'Record {n}', 'Status': rng.choice(['open', 'closed', 'blocked']),
+              'Owner': {'name': f'Person {rng.randrange(100)}', 'Email': f'person{n}@example.com'},
+              'Labels': [{'name': f'label {label}'} for label in range(rng.randrange(4))],
+              'children': [{'name': f'Note {note} on record {n}',
+                            'children': [{'name': 'detail ' * rng.randrange(1, 8)}]}
+                           for note in range(rng.randrange(1, 6))]}
+    if rng.random() < 0.1:
+      record['Snippet'] = '```<br>' + '<br>'.join(f'  line {line}' for line in range(10)) + '<br>```'
+    records.append(record)
+    total += len(json.dumps(record))
+  return records
+
+
+def stream_to_file(json_format):
+  with open(os.devnull, 'w', encoding='utf-8') as f:
+    f.writelines(tana_lines(json_format))
+
+
+def measure(convert, json_format):
+  start = time.perf_counter()
+  convert(json_format)
+  elapsed = time.perf_counter() - start
+  tracemalloc.start()
+  convert(json_format)
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  return elapsed, peak / 1e6
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--mb', type=float, nargs='+', default=[1, 5, 25])
+  args = parser.parse_args()
+
+  sys.setrecursionlimit(max(sys.getrecursionlimit(), 10000))
+  converters = {'legacy': legacy_json_to_tana, 'json_to_tana': json_to_tana, 'streamed': stream_to_file}
+  for mb in args.mb:
+    json_format = make_json(int(mb * 1e6))
+    assert json_to_tana(json_format) == legacy_json_to_tana(json_format)
+    results = [f'{mb:6.1f} MB JSON']
+    for label, convert in converters.items():
+      elapsed, peak = measure(convert, json_format)
+      results.append(f'{label} {elapsed:6.2f} s {mb / elapsed:6.2f} MB/s peak {peak:7.1f} MB')
+    print('   '.join(results))
+
+
+if __name__ == '__main__':
+  main()
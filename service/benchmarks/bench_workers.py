@@ -0,0 +1,105 @@
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator
+
+import httpx
+
+from service.workers import WORKERS_ENV
+
+# Throughput of a CPU bound endpoint (/tana-to-code on a large Tana paste)
+# with 1, 2, ... uvicorn worker processes behind one socket, as
+# myuvicorn.ServiceWorker runs them. With one worker every request queues for
+# the one core the event loop runs on. Needs the webapp built (service/dist).
+#
+#   python -m benchmarks.bench_workers --max-workers 4 --seconds 10
+
+SERVICE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def make_paste(nodes:int) -> str:
+  lines = []
+  for n in range(nodes):
+    depth = n % 4
+    lines.append('  ' * depth + f'- Node {n} with a [[reference^ref{n}]] #tag{n % 7}')
+  return '\n'.join(lines)
+
+
+def free_port() -> int:
+  with socket.socket() as s:
+    s.bind(('127.0.0.1', 0))
+    return s.getsockname()[1]
+
+
+async def load(url:str, body:str, concurrency:int, seconds:float) -> int:
+  done = 0
+  deadline = time.perf_counter() + seconds
+  async with httpx.AsyncClient(timeout=60.0) as client:
+    async def user():
+      nonlocal done
+      while time.perf_counter() < deadline:
+        response = await client.post(url, json=body)
+        response.raise_for_status()
+        done += 1
+    await asyncio.gather(*[user() for _ in range(concurrency)])
+  return done
+
+
+@contextmanager
+def start_service(env:Dict[str, str], workers:int=1) -> Iterator[str]:
+  '''Runs the service with these extra environment variables, giving its base url.'''
+  port = free_port()
+  env = dict(os.environ, **{WORKERS_ENV: str(workers)}, **env)
+  server = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'service.main:app', '--host', '127.0.0.1',
+                             '--port', str(port), '--workers', str(workers), '--log-level', 'warning'],
+                            cwd=SERVICE_DIR, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+  try:
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while True:
+      try:
+        httpx.post(f'{base}/tana-to-code', json='- warm up', timeout=5.0)
+        break
+      except httpx.TransportError:
+        if time.monotonic() > deadline:
+          raise RuntimeError('service did not start')
+        time.sleep(0.2)
+    # let every worker finish starting
+    time.sleep(2.0)
+    yield base
+  finally:
+    server.terminate()
+    server.wait()
+
+
+def run(workers:int, body:str, concurrency:int, seconds:float) -> float:
+  with start_service({}, workers) as base:
+    return asyncio.run(load(f'{base}/tana-to-code', body, concurrency, seconds)) / seconds
+
+
+def main():
+  parser = argparse.ArgumentParser()
+  parser.add_argument('--max-workers', type=int, default=os.cpu_count() or 1)
+  parser.add_argument('--nodes', type=int, default=2000)
+  parser.add_argument('--concurrency', type=int, default=16)
+  parser.add_argument('--seconds', type=float, default=10.0)
+  args = parser.parse_args()
+
+  body = make_paste(args.nodes)
+  print(f'{os.cpu_count()} cores, {args.nodes} node paste, {args.concurrency} concurrent clients')
+  baseline = None
+  workers = 1
+  while workers <= args.max_workers:
+    throughput = run(workers, body, args.concurrency, args.seconds)
+    baseline = baseline or throughput
+    print(f'{workers:3d} workers {throughput:9.1f} requests/s  x{throughput / baseline:.2f}')
+    workers *= 2
+
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,91 @@
+import random
+
+# Synthetic Tana JSON dumps for benchmarking.
+# Mimics the structure tanaparser.NodeIndex expects: supertag definitions
+# with meta nodes and SYS_A13/SYS_T01 tuples, field definitions with
+# SYS_A13/SYS_T02 tuples, tagged data nodes, inline refs, field tuples,
+# child content and a trash node.
+
+def props(name, owner=None, doc_type=None):
+  result = {'created': 1700000000000, 'name': name}
+  if owner:
+    result['_ownerId'] = owner
+  if doc_type:
+    result['_docType'] = doc_type
+  return result
+
+
+def make_dump(nodes=10000, tags=50, fields=20, refs_per_node=2, children_per_node=3, seed=42):
+  rng = random.Random(seed)
+  docs = []
+
+  def add(node_id, name, owner=None, doc_type=None, children=None):
+    doc = {'id': node_id, 'props': props(name, owner, doc_type)}
+    if children:
+      doc['children'] = children
+    docs.append(doc)
+    return doc
+
+  add('SCHEMA', 'Schema')
+  add('LIBRARY', 'Library')
+
+  # field definitions
+  field_ids = [f'field{f}' for f in range(fields)]
+  for field_id in field_ids:
+    add(field_id, f'Field {field_id}', owner='SCHEMA', doc_type='attrDef')
+    add(f'{field_id}_meta', '', owner=field_id, children=[f'{field_id}_tt'])
+    add(f'{field_id}_tt', '', owner=f'{field_id}_meta', doc_type='tuple', children=['SYS_A13', 'SYS_T02'])
+
+  # supertags, each extending an earlier tag now and again,
+  # with a handful of fields and a color
+  tag_ids = [f'tag{t}' for t in range(tags)]
+  for t, tag_id in enumerate(tag_ids):
+    tag_fields = rng.sample(field_ids, min(3, len(field_ids)))
+    field_tuples = [f'{tag_id}_f{f}' for f in range(len(tag_fields))]
+    add(tag_id, f'tag {t}', owner='SCHEMA', doc_type='tagDef', children=field_tuples)
+    for tuple_id, field_id in zip(field_tuples, tag_fields):
+      add(tuple_id, '', owner=tag_id, doc_type='tuple', children=[field_id])
+    add(f'{tag_id}_meta', '', owner=tag_id, children=[f'{tag_id}_tt', f'{tag_id}_ct'])
+    supers = [rng.choice(tag_ids[:t])] if t > 0 and rng.random() < 0.3 else []
+    add(f'{tag_id}_tt', '', owner=f'{tag_id}_meta', doc_type='tuple', children=['SYS_A13', 'SYS_T01'] + supers)
+    add(f'{tag_id}_color', rng.choice(['red', 'green', 'blue', 'violet']))
+    add(f'{tag_id}_ct', '', owner=f'{tag_id}_meta', doc_type='tuple', children=['SYS_A11', f'{tag_id}_color'])
+
+  # data nodes
+  node_ids = [f'n{n}' for n in range(nodes)]
+  for n, node_id in enumerate(node_ids):
+    name = f'Node {n}'
+    for _ in range(rng.randint(0, refs_per_node)):
+      ref = rng.choice(node_ids)
+      name += f' see <span data-inlineref-node="{ref}"></span>'
+
+    children = [f'{node_id}_c{c}' for c in range(rng.randint(0, children_per_node))]
+    tagged = rng.random() < 0.3
+    if tagged:
+      children.append(f'{node_id}_fv')
+    add(node_id, name, owner='LIBRARY', children=children)
+
+    for child_id in children:
+      if child_id.endswith('_fv'):
+        add(child_id, '', owner=node_id, doc_type='tuple', children=[rng.choice(field_ids), f'{child_id}_v'])
+        add(f'{child_id}_v', f'value of {node_id}', owner=child_id)
+      else:
+        add(child_id, f'Child {child_id}', owner=node_id)
+
+    if tagged:
+      add(f'{node_id}_meta', '', owner=node_id, children=[f'{node_id}_tt'])
+      add(f'{node_id}_tt', '', owner=f'{node_id}_meta', doc_type='tuple',
+          children=['SYS_A13'] + rng.sample(tag_ids, min(2, len(tag_ids))))
+
+  # and some trash
+  trashed = rng.sample(node_ids, max(1, nodes // 100))
+  add('ws_TRASH', 'Trash', children=trashed)
+
+  return {
+    'formatVersion': 1,
+    'docs': docs,
+    'editors': [],
+    'workspaces': {},
+    'lastTxid': seed,
+    'currentWorkspaceId': 'ws',
+  }
@@ -12,13 +12,17 @@ if sys.stderr is None:
   sys.stderr = open(os.devnull, "w")
 
 import multiprocessing
-from time import sleep
+import http.client
+import uuid
+from time import sleep, monotonic
 from typing import List, Optional
 from uvicorn import Config, Server
+from uvicorn.supervisors import Multiprocess
 import socket
 from message import message
-# import service.small_main
-import service.main
+from service.workers import BOOT_ID_ENV, CHROMA_DB_PATH, CHROMA_SERVER_ENV, WORKERS_ENV, worker_count
+# service.main is imported by uvicorn in the worker process (see Config below),
+# so the tray app doesn't pay for importing it
 
 STATUS_CHECK_INTERVAL_MS  = 1000
 STATUS_STARTING = b'S'
@@ -26,6 +30,14 @@ STATUS_UP = b'U'
 STATUS_DOWN = b'D'
 STATUS_STOPPING = b'X'
 
+HOST = "127.0.0.1"
+PORT = 8000
+# the Chroma server, when running several workers
+CHROMA_PORT = 8001
+
+# worker processes (set TANA_HELPER_WORKERS), unless ServiceWorker is told otherwise
+DEFAULT_WORKERS = worker_count()
+
 # override the UvicornServer class to add a status flag
 class MyUvicornServer(Server):
 
@@ -52,13 +64,39 @@ class MyUvicornServer(Server):
     message("Server stopped")
     return result
 
+def wait_for_http(host:str, port:int, path:str="/", timeout:float=60.0) -> bool:
+  '''Wait until something answers HTTP requests on host:port.'''
+  deadline = monotonic() + timeout
+  while monotonic() < deadline:
+    try:
+      connection = http.client.HTTPConnection(host, port, timeout=2.0)
+      connection.request("GET", path)
+      connection.getresponse()
+      connection.close()
+      return True
+    except (OSError, http.client.HTTPException):
+      sleep(0.2)
+  return False
+
+
+def run_chroma_server(path:str, host:str, port:int):
+  '''Target for the Chroma server process, as `chroma run` would do it.'''
+  import uvicorn
+  os.environ["IS_PERSISTENT"] = "TRUE"
+  os.environ["PERSIST_DIRECTORY"] = path
+  os.environ["ANONYMIZED_TELEMETRY"] = "False"
+  uvicorn.run("chromadb.app:app", host=host, port=port, log_level="warning", loop="asyncio")
+
+
 # Process wrapper to spawn multiprocessing subprocess
 class ServiceWorker(multiprocessing.Process):
 
-  def __init__(self, status):
+  def __init__(self, status, workers:int=DEFAULT_WORKERS):
     message("UvicornServer created")
     self.status = status
     self.server = None
+    # with more than one, uvicorn worker processes share the listening socket
+    self.workers = max(workers, 1)
     super().__init__()
 
   def stop(self):
@@ -80,8 +118,11 @@ class ServiceWorker(multiprocessing.Process):
   def run(self, *args, **kwargs):
     message("ServiceWorker run() called")
     self.status.value = STATUS_STARTING
+    if self.workers > 1:
+      self.run_workers()
+      return
     try:
-      self.config = Config("service.main:app", host="127.0.0.1", port=8000, log_level="info", loop="asyncio")
+      self.config = Config("service.main:app", host=HOST, port=PORT, log_level="info", loop="asyncio")
       self.server = MyUvicornServer(config=self.config, status=self.status)
       message("calling MyUvicornServer.run()")
       self.server.run()
@@ -89,7 +130,47 @@ class ServiceWorker(multiprocessing.Process):
     except Exception as e:
       message(f"ServiceWorker run() exception: {e}")
       self.status.value = STATUS_DOWN
-    
+
+
+  def run_workers(self):
+    '''Run several uvicorn workers behind one socket, sharing a Chroma server.'''
+    message(f"ServiceWorker starting {self.workers} workers")
+    # the workers inherit these, see service/workers.py
+    os.environ[WORKERS_ENV] = str(self.workers)
+    os.environ[BOOT_ID_ENV] = uuid.uuid4().hex
+    os.environ[CHROMA_SERVER_ENV] = f"{HOST}:{CHROMA_PORT}"
+
+    # the workers all append to the log file, start it afresh
+    from service.logconfig import LOGGER_FILE
+    open(LOGGER_FILE, "w").close()
+
+    chroma = multiprocessing.Process(target=run_chroma_server, args=(CHROMA_DB_PATH, HOST, CHROMA_PORT), daemon=True)
+    supervisor = None
+    try:
+      chroma.start()
+      if not wait_for_http(HOST, CHROMA_PORT, "/api/v1/heartbeat"):
+        raise RuntimeError("Chroma server didn't start")
+
+      self.config = Config("service.main:app", host=HOST, port=PORT, log_level="info", loop="asyncio",
+                           workers=self.workers)
+      self.server = Server(config=self.config)
+      supervisor = Multiprocess(self.config, target=self.server.run, sockets=[self.config.bind_socket()])
+      supervisor.startup()
+      # up once any worker answers
+      if wait_for_http(HOST, PORT):
+        self.status.value = STATUS_UP
+        message("Server started")
+      # until we're terminated
+      supervisor.should_exit.wait()
+    except Exception as e:
+      message(f"ServiceWorker run_workers() exception: {e}")
+    finally:
+      if supervisor is not None:
+        supervisor.shutdown()
+      chroma.terminate()
+      chroma.join()
+      self.status.value = STATUS_DOWN
+      message("Server stopped")
 
 
   def runXX(self, *args, **kwargs):
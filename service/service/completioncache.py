@@ -0,0 +1,121 @@
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from logging import getLogger
+from threading import Lock
+from typing import TYPE_CHECKING, Optional
+
+from pydantic import BaseModel
+
+from service.settings import tana_helper_config_dir
+
+if TYPE_CHECKING:
+  from openai.types.chat import ChatCompletion
+
+logger = getLogger()
+
+# Persistent cache of OpenAI chat completions.
+#
+# Webhook prompts run with temperature=0, and the same content often comes
+# in more than once (an article shared twice, a retried webhook). With
+# temperature 0 the answer is (near enough) deterministic, so we keep
+# completions in sqlite keyed on a hash of the model, rendered prompt and
+# generation parameters, and skip the OpenAI round trip on a repeat.
+# Entries expire after CACHE_TTL, and the least recently used are evicted
+# beyond CACHE_MAX_ENTRIES.
+
+CACHE_TTL = 7 * 24 * 60 * 60
+CACHE_MAX_ENTRIES = 1000
+
+class CacheStats(BaseModel):
+  entries: int = 0
+  hits: int = 0
+  misses: int = 0
+  hit_rate: float = 0.0
+  evictions: int = 0
+
+
+def completion_key(model:str, prompt:str, **params) -> str:
+  '''Cache key for a completion request.'''
+  request = {'model': model, 'prompt': hashlib.sha256(prompt.encode('utf-8')).hexdigest(), 'params': params}
+  return hashlib.sha256(json.dumps(request, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class CompletionCache:
+  def __init__(self, db_path:str, ttl:float=CACHE_TTL, max_entries:int=CACHE_MAX_ENTRIES):
+    self.db_path = db_path
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.db: Optional[sqlite3.Connection] = None
+    self.lock = Lock()
+
+  def _connect(self) -> sqlite3.Connection:
+    if self.db is None:
+      os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+      self.db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+      self.db.execute('PRAGMA journal_mode=WAL')
+      self.db.execute('''CREATE TABLE IF NOT EXISTS completions (
+                          key TEXT PRIMARY KEY, completion TEXT, created REAL, last_used REAL)''')
+      self.db.execute('CREATE INDEX IF NOT EXISTS completions_last_used ON completions (last_used)')
+    return self.db
+
+  def get(self, key:str) -> Optional['ChatCompletion']:
+    # openai is slow to import, so only when first needed
+    from openai.types.chat import ChatCompletion
+    now = time.time()
+    with self.lock:
+      db = self._connect()
+      row = db.execute('SELECT completion, created FROM completions WHERE key=?', (key,)).fetchone()
+      if row is not None and now - row[1] > self.ttl:
+        db.execute('DELETE FROM completions WHERE key=?', (key,))
+        self.evictions += 1
+        row = None
+      if row is None:
+        self.misses += 1
+        return None
+      db.execute('UPDATE completions SET last_used=? WHERE key=?', (now, key))
+      self.hits += 1
+    try:
+      return ChatCompletion.model_validate_json(row[0])
+    except ValueError as e:
+      logger.warning(f'Dropping unreadable cached completion: {e}')
+      self.delete(key)
+      return None
+
+  def put(self, key:str, completion:'ChatCompletion'):
+    now = time.time()
+    with self.lock:
+      db = self._connect()
+      db.execute('INSERT OR REPLACE INTO completions (key, completion, created, last_used) VALUES (?, ?, ?, ?)',
+                 (key, completion.model_dump_json(), now, now))
+      evicted = db.execute('DELETE FROM completions WHERE created < ?', (now - self.ttl,)).rowcount
+      # then the least recently used, beyond max_entries
+      evicted += db.execute('''DELETE FROM completions WHERE key IN (
+                                 SELECT key FROM completions ORDER BY last_used DESC LIMIT -1 OFFSET ?)''',
+                            (self.max_entries,)).rowcount
+      self.evictions += evicted
+
+  def delete(self, key:str):
+    with self.lock:
+      self._connect().execute('DELETE FROM completions WHERE key=?', (key,))
+
+  def clear(self):
+    with self.lock:
+      self._connect().execute('DELETE FROM completions')
+      self.hits = self.misses = self.evictions = 0
+
+  def stats(self) -> CacheStats:
+    with self.lock:
+      entries = self._connect().execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+      lookups = self.hits + self.misses
+      return CacheStats(entries=entries, hits=self.hits, misses=self.misses,
+                        hit_rate=self.hits / lookups if lookups else 0.0, evictions=self.evictions)
+
+
+# shared cache for the whole service
+completion_cache = CompletionCache(os.path.join(tana_helper_config_dir, 'completion_cache.db'))
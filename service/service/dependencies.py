@@ -1,21 +1,24 @@
+import hashlib
 import io
 import os
 import logging
-import httpx
 import pytz
 import json
 
 from datetime import datetime
+from functools import lru_cache
 from logging import getLogger
 from timeit import timeit
-from typing import ForwardRef, List, Optional
+from typing import ForwardRef, Iterator, List, Optional
 from fastapi.concurrency import asynccontextmanager
-from openai import OpenAI
 from pydantic import BaseModel
 from pathlib import Path
 
 
 from .settings import settings
+from .completioncache import completion_cache, completion_key
+from .instrumentation import EMBEDDING, LLM, span
+from .requestcontext import get_openai_api_key
 
 # Load environment variables from .env file
 # load_dotenv()
@@ -153,44 +156,101 @@ class AddToNodeRequest(BaseModel):
   targetNodeId: Optional[str] = None
 
 
-# Utility classes
-
 logger = getLogger()
 
-class TanaInputAPIClient:
-  def __init__(self, base_url: str = "https://europe-west1-tagr-prod.cloudfunctions.net", auth_token: Optional[str] = None):
-    self.base_url = base_url
-    self.client = httpx.Client(verify=True)
-    self.headers = {'Content-Type': 'application/json'}
-    if auth_token:
-      self.headers['Authorization'] = f'Bearer {auth_token}'
+# OpenAI helper functions
 
-  def add_to_inbox(self, request_data: AddToNodeRequest):
-    url = f"{self.base_url}/addToNodeV2"
-    response = self.client.post(url, json=request_data.model_dump(exclude_unset=True), headers=self.headers)
-    return response
+# OpenAI clients are kept per API key, so requests using different keys
+# (x-openai-api-key) can run at the same time, each reusing its own connections
+OPENAI_CLIENT_POOL_SIZE = 32
 
-# OpenAI helper functions
+@lru_cache(maxsize=OPENAI_CLIENT_POOL_SIZE)
+def openai_client_for(api_key:str):
+  # openai is slow to import, so only when first needed
+  from openai import OpenAI
+  return OpenAI(api_key=api_key)
+
+def get_openai_client():
+  '''The shared OpenAI client for the current request's key.'''
+  return openai_client_for(get_openai_api_key())
 
 def get_embedding(req:EmbeddingRequest):
   # get shared client object
-  api_key = settings.openai_api_key
-  openai_client = OpenAI(api_key=api_key)
+  openai_client = get_openai_client()
   content = req.name + req.context 
-  embedding = openai_client.embeddings.create(input=content, model=req.embedding_model)
+  with span(EMBEDDING):
+    embedding = openai_client.embeddings.create(input=content, model=req.embedding_model)
   return embedding.data # type: ignore
 
+def completion_cache_key(req:OpenAICompletion) -> Optional[str]:
+  # only deterministic (temperature 0) completions are worth caching
+  if req.temperature:
+    return None
+  # each OpenAI key has its own cache entries, so one user's key never answers for another's
+  account = hashlib.sha256(get_openai_api_key().encode('utf-8')).hexdigest()[:16]
+  return completion_key(req.model, req.prompt, max_tokens=req.max_tokens, temperature=req.temperature,
+                        account=account)
+
 def get_chatcompletion(req:OpenAICompletion) -> dict:
-  api_key = settings.openai_api_key
-  openai_client = OpenAI(api_key=api_key)
-  completion = openai_client.chat.completions.create(
-                  messages=[{ 'role': 'user', 'content': req.prompt }],
-                  model=req.model, 
-                  max_tokens=req.max_tokens, 
-                  temperature=req.temperature)
+  cache_key = completion_cache_key(req)
+  if cache_key:
+    cached = completion_cache.get(cache_key)
+    if cached is not None:
+      logger.debug('Using cached completion')
+      return cached # type: ignore
+
+  openai_client = get_openai_client()
+  with span(LLM):
+    completion = openai_client.chat.completions.create(
+                    messages=[{ 'role': 'user', 'content': req.prompt }],
+                    model=req.model, 
+                    max_tokens=req.max_tokens, 
+                    temperature=req.temperature)
   
+  # only whole answers. A cut off one (finish_reason 'length') would
+  # be handed back for every repeat of the request
+  if cache_key and completion.choices and completion.choices[0].finish_reason == 'stop':
+    completion_cache.put(cache_key, completion)
   return completion # type: ignore
 
+def get_chatcompletion_stream(req:OpenAICompletion) -> Iterator[str]:
+  '''Like get_chatcompletion, but returns the completion text piece by piece as it arrives.
+  The request is made here, so errors (auth etc) surface before any text is returned.'''
+  cache_key = completion_cache_key(req)
+  if cache_key:
+    cached = completion_cache.get(cache_key)
+    if cached is not None:
+      return iter([cached.choices[0].message.content or ''])
+
+  from openai.types.chat import ChatCompletion, ChatCompletionMessage
+  from openai.types.chat.chat_completion import Choice
+  openai_client = get_openai_client()
+  # only up to the start of the response, the rest is timed by whoever reads the stream
+  with span(LLM):
+    stream = openai_client.chat.completions.create(
+                    messages=[{ 'role': 'user', 'content': req.prompt }],
+                    model=req.model, 
+                    max_tokens=req.max_tokens, 
+                    temperature=req.temperature,
+                    stream=True)
+
+  def tokens():
+    content = []
+    finish_reason = None
+    for chunk in stream:
+      if chunk.choices:
+        finish_reason = chunk.choices[0].finish_reason or finish_reason
+        if chunk.choices[0].delta.content:
+          content.append(chunk.choices[0].delta.content)
+          yield chunk.choices[0].delta.content
+    # cache the whole thing, as if it hadn't been streamed (if it is whole)
+    if cache_key and finish_reason == 'stop':
+      completion_cache.put(cache_key, ChatCompletion(id=chunk.id, created=chunk.created, model=chunk.model,
+                                                     object='chat.completion',
+                                                     choices=[Choice(index=0, finish_reason=finish_reason,
+                                                                     message=ChatCompletionMessage(role='assistant', content=''.join(content)))]))
+  return tokens()
+
 def get_date():
 
   # Set the desired timezone (EST)
@@ -209,16 +269,19 @@ def get_date():
 
 
 # helper function for timing exeuction of various calls
+# timed as a stage of the current request, see instrumentation.py
 class LineTimer:
   def __init__(self, name=None):
-    self.name = " '"  + name + "'" if name else ''
+    self.name = name or 'block'
 
   def __enter__(self):
-    self.start = timeit.default_timer()
+    self.timer = span(self.name)
+    self.span = self.timer.__enter__()
 
   def __exit__(self, exc_type, exc_value, traceback):
-    self.took = (timeit.default_timer() - self.start) * 1000.0
-    logger.info('Code block' + self.name + ' took: ' + str(self.took) + ' ms')
+    self.timer.__exit__(exc_type, exc_value, traceback)
+    self.took = (self.span.duration or 0.0) * 1000.0
+    logger.debug(f"Code block '{self.name}' took: {self.took:.1f} ms")
 
 
 # essentially, context managers are aspect-oriented constructs for python
@@ -1,8 +1,10 @@
-from fastapi import APIRouter, status, Request
+from fastapi import APIRouter, HTTPException, status, Request
 from fastapi.responses import HTMLResponse
 from typing import Dict, List, Optional
-from service.dependencies import ChromaStoreRequest, TanaNodeMetadata, QueueRequest, ChromaRequest, get_embedding, TANA_NODE, TanaInputAPIClient, SuperTag, Node, AddToNodeRequest
+from service.dependencies import ChromaStoreRequest, TanaNodeMetadata, QueueRequest, ChromaRequest, get_embedding, TANA_NODE, SuperTag, Node, AddToNodeRequest
 from service.settings import settings
+from service.tanainput import TanaInputAPIError, tana_input
+from service.instrumentation import TANA_API, VECTOR_STORE, span
 from logging import getLogger
 from ratelimit import limits, RateLimitException, sleep_and_retry
 from functools import lru_cache
@@ -18,6 +20,7 @@ import re
 from snowflake import SnowflakeGenerator
 
 from service.tanaparser import prune_reference_nodes
+from service.workers import CHROMA_DB_PATH, chroma_server
 
 logger = getLogger()
 snowflakes = SnowflakeGenerator(42)
@@ -26,10 +29,16 @@ router = APIRouter()
 
 INBOX_QUEUE = "queue"
 
-db_path = os.path.join(Path.home(), '.chroma.db')
+db_path = CHROMA_DB_PATH
 @lru_cache() # reuse connection to chromadb to avoid connection rate limiting on parallel requests
 def get_chroma():
-  chroma_client = chromadb.PersistentClient(path=db_path, settings=Settings(anonymized_telemetry=False))
+  server = chroma_server()
+  if server:
+    # several worker processes: they share a Chroma server, the only process using the files
+    host, port = server
+    chroma_client = chromadb.HttpClient(host=host, port=port, settings=Settings(anonymized_telemetry=False))
+  else:
+    chroma_client = chromadb.PersistentClient(path=db_path, settings=Settings(anonymized_telemetry=False))
 
   logger.info("Connected to chromadb")
   return chroma_client
@@ -88,7 +97,8 @@ async def chroma_upsert(req: ChromaRequest):
         metadatas=metadata.model_dump(),
       )
       
-    do_upsert()
+    with span(VECTOR_STORE):
+      do_upsert()
 
     return None
 
@@ -226,18 +236,17 @@ def chroma_purge(req: ChromaRequest):
 # into the Tana INBOX
 @router.post("/chroma/enqueue", status_code=status.HTTP_204_NO_CONTENT, tags=["Queue"])
 async def chroma_enqueue(request: Request, req: QueueRequest):
+  # timed by the request span, see instrumentation.py
+  # generate a temporary nodeID
+  node_id = str(next(snowflakes))
+
   async with lock:
-    start_time = time.time()
-    logger.info(f'DO txid={request.headers["x-request-id"]}')
     #embedding = get_embedding(req)
     vector = [0]
     #embedding[0]['embedding']
 
     collection = get_queue_collection()
 
-    # generate a temporary nodeID
-    node_id = str(next(snowflakes))
-
     metadata = {'category': TANA_NODE,
                   'text': req.context}
     
@@ -250,31 +259,28 @@ async def chroma_enqueue(request: Request, req: QueueRequest):
         metadatas=metadata
       )
       
-    do_upsert()
-
-    tana_api_token = settings.tana_api_token
-    print(f"Using Tana API token {tana_api_token}")
-
-    # now push into Tana Inbox via inbox API call
-    # Replace 'your_auth_token' with your actual auth token
-    client = TanaInputAPIClient(auth_token=tana_api_token)
-
-    line_one = req.context.partition('\n')[0]
-    # Create nodes, supertags, and children
-    supertag = SuperTag(id="qf0MJpvP7liP")  # BRETT HARDCOIDEX FIXME
-    main_node = Node(name=f'{node_id}', description=f'{line_one} ...', supertags=[supertag])
-
-    # Prepare request data
-    request_data = AddToNodeRequest(nodes=[main_node], targetNodeId="INBOX")
-
-    # Add node to Tana
-    response = client.add_to_inbox(request_data=request_data)
-    print(response.text)
-
-    process_time = (time.time() - start_time) * 1000
-    formatted_process_time = '{0:.2f}'.format(process_time)
-    logger.info(f'DONE txid={request.headers["x-request-id"]} time={formatted_process_time}')
-    return None
+    with span(VECTOR_STORE):
+      do_upsert()
+
+  # now push into Tana Inbox via inbox API call
+  line_one = req.context.partition('\n')[0]
+  # Create nodes, supertags, and children
+  supertag = SuperTag(id="qf0MJpvP7liP")  # BRETT HARDCOIDEX FIXME
+  main_node = Node(name=f'{node_id}', description=f'{line_one} ...', supertags=[supertag])
+
+  # Prepare request data
+  request_data = AddToNodeRequest(nodes=[main_node], targetNodeId="INBOX")
+
+  # Add node to Tana. Uses the shared client, which sends enqueues
+  # that arrive close together in a single Input API call
+  try:
+    with span(TANA_API):
+      response = await tana_input.add_to_inbox(request_data)
+  except TanaInputAPIError as e:
+    logger.warning(f'Tana input API failed. {e.status_code}. Detail: {e.detail}')
+    raise HTTPException(status_code=e.status_code, detail=e.detail)
+  logger.debug(response.text)
+  return None
 
 
 # dequeue is like query, but gets the node by ID strictly
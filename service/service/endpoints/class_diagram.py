@@ -1,9 +1,11 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Depends, Response
 from fastapi.responses import HTMLResponse
 from pydantic import BaseModel
 from typing import Optional, List
-from service.tana_types import GraphLink, NodeDump, TanaDump, TanaTag, Visualizer
-from service.tanaparser import IS_TAG_SCHEMA_LINK, NodeIndex, add_linkage, patch_node_name
+from service.tana_types import GraphLink, TanaTag, Visualizer
+from service.tanaparser import IS_TAG_SCHEMA_LINK, patch_node_name
+from service.graph_pipeline import TANA_DUMP_BODY, DumpEntry, dump_body, links, load_dump, node_index
+from service.processpool import process_pool, shard_key
 from logging import getLogger
 import re
 
@@ -11,77 +13,89 @@ router = APIRouter()
 
 logger = getLogger()
 
+class TagField(BaseModel):
+  id: str
+  name: str
+  # the supertag that defines this field, if it's inherited
+  inherited_from: Optional[str] = None
+
+class TagClass(TanaTag):
+  # supertag ids
+  extends: List[str] = []
+  fields: List[TagField] = []
+
 class ClassGraph(BaseModel):
   directed: bool = False
   multigraph: bool = False
-  nodes: List[TanaTag] = []
+  nodes: List[TagClass] = []
   links: List[GraphLink] = []
 
-@router.post("/class_diagram", tags=["Visualizer"])
-async def class_diagram(tana_dump:TanaDump):
-
-  links = []  # final results we build into
+# we just want the class heirarchy
+CLASS_CONFIG = Visualizer(include_content_nodes=False, 
+                          include_inline_refs=False,
+                          include_tag_tag_links=True,
+                          include_node_tag_links=False,
+                          include_inline_ref_nodes=False,
+                          include_tag_schema_links=True)
 
-  # we just want the class heirarchy
-  config = Visualizer(include_content_nodes=False, 
-                      include_inline_refs=False,
-                      include_tag_tag_links=True,
-                      include_node_tag_links=False,
-                      include_inline_ref_nodes=False,
-                      include_tag_schema_links=True)
-
-  index = NodeIndex(tana_dump=tana_dump, config=config)
-
-  # build our primary indices first, so we can easily navigate the dump
-  index.build_indices()
-  
-  # OK, now that we have the basic dump indexed...
-  # build a collection of meaningful linkages
-  index.build_master_pairs()
- 
-  # Now that we have the dump converted to a set of directed 
-  # tuples, we can build a graph from it.
-
-  # strip the links down to the unique set
-  candidate_pairs = set(index.master_pairs)
-
-  final_pairs = set()
-
-  # also remove redundant bidirectional links
-  [final_pairs.add((a, b, r)) for (a, b, r) in candidate_pairs
-    if (a, b, r) not in final_pairs and (b, a, r) not in final_pairs]
-
-  # build links
-  for pair in final_pairs:
-    add_linkage(index, links, pair[0], pair[1], pair[2])
+def build_class_graph(entry:DumpEntry) -> ClassGraph:
+  # the indexed dump and its deduped links, shared with the other
+  # graph endpoints. See service/graph_pipeline.py
+  index = node_index(entry)
+  edges = links(entry, CLASS_CONFIG)
 
   # build the return structure...
   graph = ClassGraph()
-
-  count = 0
-  node_ids = []
+  graph.links = [GraphLink(source=source, target=target, reason=reason)
+                 for (source, target, reason) in edges.pairs()]
 
   # only include nodes that are linked
-  for link in links:
-    graph.links.append(link)
-    node_ids.append(link.source)
-    node_ids.append(link.target)
-    count = count + 1
-  
-  node_ids = list(set(node_ids))
-  for node_id in node_ids:
+  for code in edges.linked_nodes().tolist():
+    node_id = edges.node_ids[code]
     node = index.node(node_id)
     # patch up node names
     new_name = patch_node_name(index, node_id)
-    render_node = TanaTag(id=node.id, name=new_name, color=node.color)
+    render_node = TagClass(id=node.id, name=new_name, color=index.color_of(node_id))
+    # the tag schema, collected by build_tag_index
+    render_node.extends = [tag_id for tag_id in index.tags_of(node_id) if index.valid(tag_id)]
+    for (field_id, owner_id) in index.all_tag_fields(node_id):
+      render_node.fields.append(TagField(id=field_id, name=index.field_defs[field_id],
+                                         inherited_from=owner_id if owner_id != node_id else None))
     graph.nodes.append(render_node)
 
   return graph
 
 
-@router.post("/mermaid_classes", response_class=HTMLResponse, tags=["Visualizer"])
-async def mermaid_classes(tana_dump:TanaDump):
-  graph = await class_diagram(tana_dump)
+def class_graph_for(body:bytes) -> ClassGraph:
+  entry = load_dump(body)
+  # cached with the dump, so /mermaid_classes can reuse it
+  return entry.memo('class_graph', lambda: build_class_graph(entry))
+
+
+def class_graph_json(body:bytes) -> bytes:
+  return class_graph_for(body).model_dump_json().encode('utf-8')
+
+
+@router.post("/class_diagram", response_model=ClassGraph, tags=["Visualizer"], openapi_extra=TANA_DUMP_BODY)
+async def class_diagram(body:bytes=Depends(dump_body)):
+  # CPU heavy, so in the process pool
+  content = await process_pool.run(class_graph_json, body, key=shard_key(body))
+  return Response(content=content, media_type='application/json')
+
+
+def mermaid_member(name:str) -> str:
+  # brackets and friends have meaning in mermaid class members
+  return re.sub(r'[(){}<>\[\]~"`]', '', name).strip() or '_'
+
+
+@router.post("/mermaid_classes", response_class=HTMLResponse, tags=["Visualizer"], openapi_extra=TANA_DUMP_BODY)
+async def mermaid_classes(body:bytes=Depends(dump_body)):
+  # CPU heavy, so in the process pool
+  return await process_pool.run(mermaid_for, body, key=shard_key(body))
+
+
+def mermaid_for(body:bytes) -> str:
+  graph = class_graph_for(body)
   # convert graph to mermaid format class diagram
   mermaid = \
     "---\n" +\
@@ -105,7 +119,10 @@ async def mermaid_classes(tana_dump:TanaDump):
     if node.name:
       encoded_name = node.name.replace('"', "#quot;")
       mermaid += f'    class {node.id}["{encoded_name}"]' + ' {\n'
-      # TODO: add all fields of the tag here
+      # inherited fields are implied by the inheritance arrows
+      for field in node.fields:
+        if field.inherited_from is None:
+          mermaid += f'      +{mermaid_member(field.name)}\n'
       mermaid += "    }\n"
   
       
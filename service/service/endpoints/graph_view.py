@@ -1,9 +1,18 @@
-from fastapi import APIRouter
+from enum import Enum
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response, status
 from pydantic import BaseModel
-from typing import Optional, List
-from service.tana_types import GraphLink, NodeDump, TanaDump, Visualizer
-from service.tanaparser import NodeIndex, add_linkage, patch_node_name
+from typing import Optional, List, Tuple
+from service.tana_types import GraphLink, Visualizer
+from service.tanaparser import NodeIndex, patch_node_name
+from service.graphops import (EdgeArrays, degrees, neighborhood, node_mask, pagerank, restrict_to, top_nodes,
+                              collapse_leaves as ops_collapse_leaves)
+from service.graph_pipeline import TANA_DUMP_BODY, dump_body, links, load_dump, node_index
+from service.processpool import process_pool, shard_key
+from service.graphanalytics import GraphAnalytics, analyze
+from service.graphlayout import cached_layout
+from service.graphcodec import GRAPH_MEDIA_TYPE, compress, encode_graph, wants_binary_graph
 from logging import getLogger
+import numpy as np
 import re
 
 router = APIRouter()
@@ -14,6 +23,12 @@ class RenderNode(BaseModel):
   id: str
   name: Optional[str]
   color: Optional[str] = None
+  # number of leaf nodes collapsed into this one (if requested)
+  collapsed: Optional[int] = None
+  # precomputed layout coordinates (if requested)
+  x: Optional[float] = None
+  y: Optional[float] = None
+  z: Optional[float] = None
 
 class DirectedGraph(BaseModel):
   directed: bool = False
@@ -21,61 +36,189 @@ class DirectedGraph(BaseModel):
   nodes: List[RenderNode] = []
   links: List[GraphLink] = []
 
-
-@router.post("/graph", tags=["Visualizer"])
-async def graph(tana_dump:TanaDump):
-
-  links = []  # final results we build into
-
-  config = tana_dump.visualize
+class GraphRank(str, Enum):
+  degree = "degree"
+  pagerank = "pagerank"
+
+
+def filter_graph(index:NodeIndex, edges:EdgeArrays,
+                 tags:Optional[str]=None,
+                 focus:Optional[str]=None,
+                 hops:int=1,
+                 max_nodes:Optional[int]=None,
+                 rank:GraphRank=GraphRank.degree,
+                 collapse_leaves:bool=False) -> Tuple[EdgeArrays, Optional[np.ndarray]]:
+  '''Server side filtering and level of detail for the graph, so we only
+  ship what the browser can actually render.
+
+  Returns the remaining edges and, if collapse_leaves was requested,
+  the number of leaves collapsed into each node.
+  '''
+  if tags:
+    # accept tag names (with or without #) or tag ids, comma separated
+    wanted = set()
+    for tag in tags.split(','):
+      tag = tag.strip().lstrip('#')
+      if tag:
+        wanted.add(index.tags.get(tag, tag))
+    # keep tagged nodes and the tags themselves
+    mask = node_mask(edges)
+    for code in edges.linked_nodes().tolist():
+      node_id = edges.node_ids[code]
+      if node_id in wanted or not wanted.isdisjoint(index.tags_of(node_id)):
+        mask[code] = True
+    edges = restrict_to(edges, mask)
+
+  if focus:
+    if not index.valid(focus):
+      raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f'Focus node {focus} not found')
+    seeds = node_mask(edges, [edges.node_ids.index(focus)])
+    edges = restrict_to(edges, neighborhood(edges, seeds, hops))
+
+  collapsed = None
+  if collapse_leaves:
+    edges, collapsed = ops_collapse_leaves(edges)
+
+  if max_nodes is not None:
+    scores = pagerank(edges) if rank == GraphRank.pagerank else degrees(edges)
+    candidates = node_mask(edges, edges.linked_nodes())
+    edges = restrict_to(edges, top_nodes(scores, candidates, max_nodes))
+
+  return edges, collapsed
+
+
+def render_graph(body:bytes, accept:Optional[str], accept_encoding:Optional[str],
+                 tags:Optional[str]=None,
+                 focus:Optional[str]=None,
+                 hops:int=1,
+                 max_nodes:Optional[int]=None,
+                 rank:GraphRank=GraphRank.degree,
+                 collapse_leaves:bool=False,
+                 layout:Optional[int]=None):
+  '''The /graph response for a dump: content, media type and headers.
+  Runs in the process pool, so the response is encoded there too.'''
+  entry = load_dump(body)
+  config = entry.tana_dump.visualize
   if config is None:
     config = Visualizer()
 
-  index = NodeIndex(tana_dump=tana_dump, config=config)
+  # the indexed dump and its deduped links, shared with the other
+  # graph endpoints. See service/graph_pipeline.py
+  index = node_index(entry)
+  edges = links(entry, config)
 
-  # build our primary indices first, so we can easily navigate the dump
-  index.build_indices()
-  
-  # OK, now that we have the basic dump indexed...
-  # build a collection of meaningful linkages
-  index.build_master_pairs()
- 
-  # Now that we have the dump converted to a set of directed 
-  # tuples, we can build a graph from it.
+  edges, collapsed = filter_graph(index, edges, tags, focus, hops, max_nodes, rank, collapse_leaves)
+
+  # only include nodes that are linked
+  linked = edges.linked_nodes()
+  node_ids = [edges.node_ids[code] for code in linked.tolist()]
+  # patch up node names
+  names = [patch_node_name(index, node_id) for node_id in node_ids]
+  colors = [index.color_of(node_id) for node_id in node_ids]
+  collapsed = collapsed[linked] if collapsed is not None else None
+
+  # links refer to positions in our node table, not index codes
+  source = np.searchsorted(linked, edges.src)
+  target = np.searchsorted(linked, edges.dst)
+
+  positions = None
+  if layout:
+    workspace = entry.tana_dump.currentWorkspaceId or 'default'
+    positions = cached_layout(workspace, node_ids, source, target, layout)
+
+  if wants_binary_graph(accept):
+    extra_arrays = {}
+    if collapsed is not None:
+      extra_arrays['collapsed'] = ('uint32', collapsed)
+    if positions is not None:
+      for axis, name in enumerate('xyz'[:layout]):
+        extra_arrays[name] = ('float32', positions[:, axis])
+    payload = encode_graph(node_ids, names, colors, edges.reasons, source, target, edges.reason,
+                           extra_arrays=extra_arrays)
+    content, encoding = compress(payload, accept_encoding)
+    headers = {'Vary': 'Accept, Accept-Encoding'}
+    if encoding:
+      headers['Content-Encoding'] = encoding
+    return content, GRAPH_MEDIA_TYPE, headers
 
-  # strip the links down to the unique set
-  candidate_pairs = set(index.master_pairs)
-  final_pairs = set()
+  # build the return structure...
+  graph = DirectedGraph(directed=False, multigraph=False)
+  graph.links = [GraphLink(source=source, target=target, reason=reason)
+                 for (source, target, reason) in edges.pairs()]
+  graph.nodes = [RenderNode(id=node_id, name=name, color=color)
+                 for (node_id, name, color) in zip(node_ids, names, colors)]
+  if collapsed is not None:
+    for (render_node, count) in zip(graph.nodes, collapsed.tolist()):
+      render_node.collapsed = count
+  if positions is not None:
+    for (render_node, position) in zip(graph.nodes, positions.tolist()):
+      render_node.x, render_node.y = position[0], position[1]
+      if layout == 3:
+        render_node.z = position[2]
+
+  # leave out optional node fields we didn't fill in, rather than sending
+  # nulls. (A null x or y would pin the node at the origin in the browser)
+  return graph.model_dump_json(exclude_unset=True).encode('utf-8'), 'application/json', {}
+
+
+@router.post("/graph", tags=["Visualizer"], openapi_extra=TANA_DUMP_BODY)
+async def graph(request:Request,
+                body:bytes=Depends(dump_body),
+                tags:Optional[str]=None,
+                focus:Optional[str]=None,
+                hops:int=1,
+                max_nodes:Optional[int]=None,
+                rank:GraphRank=GraphRank.degree,
+                collapse_leaves:bool=False,
+                layout:Optional[int]=Query(None, ge=2, le=3)):
+  '''Build a graph of nodes and links from a Tana dump for the Visualizer.
+
+  Optional query params filter the graph server side:
+  - tags: only nodes with any of these (comma separated) tags
+  - focus, hops: only the k-hop neighborhood of the focus node id
+  - collapse_leaves: fold single-link leaf nodes into their neighbor
+  - max_nodes, rank: keep at most max_nodes, ranked by degree or pagerank
+
+  layout=2 or layout=3 adds precomputed 2D or 3D node coordinates,
+  cached per workspace (see service/graphlayout.py). Graphs too big to
+  lay out in time come back without them
+
+  Returns a DirectedGraph as JSON by default. Clients that send
+  `Accept: application/vnd.tana-helper.graph` get the compact binary
+  encoding described in service/graphcodec.py instead.
+  '''
+  # CPU heavy, so in the process pool
+  result = await process_pool.run(render_graph, body, request.headers.get('accept'),
+                                  request.headers.get('accept-encoding'),
+                                  tags, focus, hops, max_nodes, rank, collapse_leaves, layout,
+                                  key=shard_key(body))
+  content, media_type, headers = result
+  return Response(content=content, media_type=media_type, headers=headers)
+
+
+def graph_analytics_for(body:bytes, limit:int) -> GraphAnalytics:
+  entry = load_dump(body)
+  config = entry.tana_dump.visualize
+  if config is None:
+    config = Visualizer()
 
-  # also remove redundant bidirectional links
-  [final_pairs.add((a, b, r)) for (a, b, r) in candidate_pairs
-    if (a, b, r) not in final_pairs and (b, a, r) not in final_pairs]
+  def compute():
+    return analyze(node_index(entry), links(entry, config), limit)
 
-  # build links
-  for pair in final_pairs:
-    add_linkage(index, links, pair[0], pair[1], pair[2])
+  # cached with the dump
+  return entry.memo(('analytics', config, limit), compute)
 
-  # build the return structure...
-  graph = DirectedGraph()
 
-  count = 0
-  node_ids = []
+def graph_analytics_json(body:bytes, limit:int) -> bytes:
+  return graph_analytics_for(body, limit).model_dump_json().encode('utf-8')
 
-  # only include nodes that are linked
-  for link in links:
-    graph.links.append(link)
-    node_ids.append(link.source)
-    node_ids.append(link.target)
-    count = count + 1
-  
-  node_ids = list(set(node_ids))
-  for node_id in node_ids:
-    node = index.node(node_id)
-    # patch up node names
-    new_name = patch_node_name(index, node_id)
-    render_node = RenderNode(id=node.id, name=new_name, color=node.color)
-    graph.nodes.append(render_node)
-
-
-  return graph
 
+@router.post("/graph/analytics", response_model=GraphAnalytics, tags=["Visualizer"], openapi_extra=TANA_DUMP_BODY)
+async def graph_analytics(body:bytes=Depends(dump_body), limit:int=Query(25, ge=0)):
+  '''Degree distribution, connected components, hubs, PageRank,
+  tag usage and co-occurrence and orphan nodes for a Tana dump.
+  Lists are truncated to the top `limit` entries.
+  '''
+  # CPU heavy, so in the process pool
+  content = await process_pool.run(graph_analytics_json, body, limit, key=shard_key(body))
+  return Response(content=content, media_type='application/json')
@@ -1,14 +1,18 @@
 from fastapi import APIRouter, status, Body, HTTPException
-from fastapi.responses import HTMLResponse
-from service.json2tana import json_to_tana
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from service.json2tana import tana_lines
 from service.settings import settings
+from service.streaming import file_chunks
 from starlette.requests import Request
 from logging import getLogger
 import json
 import os
 import csv
+import tempfile
 
 from service.json2tana import tana_to_json
+from service.processpool import process_pool
 
 router = APIRouter()
 
@@ -20,30 +24,63 @@ def extract_json_from_code_node(payload):
   right = payload.rfind('```\n')
   return payload[left:right]
 
-@router.post("/jsonify", tags=["Conversions"])
-async def jsonify(req:Request, body:str=Body(...)):
+# The conversions are CPU heavy for big pastes, so they run in the
+# process pool, see service/processpool.py
+
+def paste_to_json(body:str):
   tana_format = bytes(body, "utf-8").decode("unicode_escape")  
   object_graph = tana_to_json(tana_format)
   return object_graph
 
-@router.post("/tanify", response_class=HTMLResponse, tags=["Conversions"])
-async def tanify(body:str=Body(...)):
+def paste_to_json_text(body:str) -> str:
+  # as FastAPI would encode it
+  return json.dumps(paste_to_json(body), ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":"))
+
+def body_to_json(body:str):
   raw_body = bytes(body, "utf-8").decode("unicode_escape")
   if raw_body.startswith('```json'):
     # this is a code node full of json
     raw_body = extract_json_from_code_node(raw_body)
-  json_format = json.loads(raw_body)
-  tana_format = json_to_tana(json_format)
-  return tana_format
-
-@router.post("/tana-to-code", response_class=HTMLResponse, tags=["Conversions"])
-async def tana_to_code(body:str=Body(...)):
-  tana_format = bytes(body, "utf-8").decode("unicode_escape")  
-  object_graph = tana_to_json(tana_format)
+  return json.loads(raw_body)
+
+def body_to_tana_file(body:str) -> str:
+  '''The Tana paste for a JSON body, written out line by line to a temporary
+  file rather than built up in memory. Returns the path of the file.'''
+  json_format = body_to_json(body)
+  os.makedirs(settings.temp_files, exist_ok=True)
+  fd, path = tempfile.mkstemp(prefix='tanify-', suffix='.txt', dir=settings.temp_files)
+  try:
+    with open(fd, 'w', encoding='utf-8') as f:
+      f.writelines(tana_lines(json_format))
+  except BaseException:
+    os.remove(path)
+    raise
+  return path
+
+def paste_to_code(body:str) -> str:
+  object_graph = paste_to_json(body)
   json_format = json.dumps(object_graph, indent=2)
   result_format = '```json\n'+json_format+'\n```\n'
   return result_format
 
+@router.post("/jsonify", tags=["Conversions"])
+async def jsonify(req:Request, body:str=Body(...)):
+  content = await process_pool.run(paste_to_json_text, body)
+  return Response(content=content, media_type='application/json')
+
+@router.post("/tanify", response_class=HTMLResponse, tags=["Conversions"])
+async def tanify(body:str=Body(...)):
+  # converted to a file, so any error is still an error status, then
+  # streamed from there. Big conversions are never all in memory at once.
+  # The file is removed by a background task, which runs however the response
+  # ends, even if the client goes before the streaming starts
+  path = await process_pool.run(body_to_tana_file, body)
+  return StreamingResponse(file_chunks(path), media_type='text/html', background=BackgroundTask(os.remove, path))
+
+@router.post("/tana-to-code", response_class=HTMLResponse, tags=["Conversions"])
+async def tana_to_code(body:str=Body(...)):
+  return await process_pool.run(paste_to_code, body)
+
 @router.post("/code-to-json", tags=["Conversions"])
 async def code_to_json(body:str=Body(...)):
   tana_format = bytes(body, "utf-8").decode("unicode_escape").rstrip()
@@ -60,7 +97,7 @@ async def export_to_file(req:Request, filename:str, format='json',
     raise HTTPException(detail = 'Invalid filename', status_code=status.HTTP_403_FORBIDDEN)
 
   # first build an object graph from input Tana data
-  object_graph = await jsonify(req, body)
+  object_graph = await process_pool.run(paste_to_json, body)
 
   path = settings.export_path
   filepath = f'{path}/{filename}.{format}'
@@ -103,8 +140,7 @@ async def echo(body:str=Body(...)):
 
 @router.post("/childless", response_class=HTMLResponse, tags=["Conversions"])
 async def childless(req:Request, body:str=Body(...)):
-  tana_format = bytes(body, "utf-8").decode("unicode_escape")  
-  object_graph = tana_to_json(tana_format)
+  object_graph = await process_pool.run(paste_to_json, body)
   empty_nodes = []
   # start with the root node of the context
   root_list = object_graph[0]['children']
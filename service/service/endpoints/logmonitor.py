@@ -1,11 +1,10 @@
 import asyncio
-import aiofiles
-from fastapi import APIRouter, Request, Response, WebSocket, status
-from fastapi.responses import HTMLResponse
-from fastapi.templating import Jinja2Templates
-import os
+import json
+from typing import List, Optional
+from fastapi import APIRouter, HTTPException, Query, WebSocket, WebSocketDisconnect, status
+from starlette.websockets import WebSocketState
 from service.logconfig import get_logger_config
-from service.settings import settings
+from service.loghub import LogEntry, log_hub, parse_level
 from logging import getLogger
 
 router = APIRouter()
@@ -14,38 +13,80 @@ router = APIRouter()
 log_config, log_filename = get_logger_config()
 
 logger = getLogger()
-# log_file = log_config.logger_file
 
-# TODO: rework this to use the logging stream instead of reading the file
-# also don't capture rendered logs - capture raw logs and then 
-# render them via Rich Console here ... 
-# This will allow us to resize the virtual Console based on the actual client
-# console size - we will need to pass this information over the websocket
-# and also support re-rendering the whole log, etc. etc.
+# how many of the most recent records a new client gets, unless it asks otherwise
+LOG_REPLAY = 500
+
+# Logs are pushed to clients as they are logged, from the in-process log_hub
+# (see service/loghub.py), rather than by tailing the log file.
+# With format=text (the default) each message is a rendered log line for a
+# terminal. With format=json it is a JSON list of records.
+
+# TODO: render with Rich here, sized to the client's terminal - we will need
+# to pass the console size over the websocket
 
 @router.websocket("/ws/log")
-async def websocket_endpoint_log(websocket: WebSocket) -> None:
+async def websocket_endpoint_log(websocket: WebSocket, replay:int=LOG_REPLAY, level:str='DEBUG',
+                                 txid:Optional[str]=None, format:str='text') -> None:
   """WebSocket endpoint for client connections
 
   Args:
       websocket (WebSocket): WebSocket request from client.
+      replay: how many recent records to send first
+      level: only send records at this level and above
+      txid: only send records for this transaction id
+      format: text or json
   """
-  await websocket.accept()
+  try:
+    levelno = parse_level(level)
+  except ValueError as e:
+    await websocket.close(code=status.WS_1008_POLICY_VIOLATION, reason=str(e))
+    return
+
+  # we never expect anything from the client, but listening tells us when it goes away
+  async def until_disconnected():
+    while (await websocket.receive())['type'] != 'websocket.disconnect':
+      pass
+  disconnected = None
 
   try:
-    # TODO: instead of reading the file, tap into the logging stream before it goes to the file
-    async with aiofiles.open(f"{log_filename}", "r") as file:
-      # read n lines from the file
+    # subscribe before accepting, so a client sees everything logged once it's connected
+    with log_hub.subscribe(replay, levelno, txid) as subscription:
+      await websocket.accept()
+      disconnected = asyncio.create_task(until_disconnected())
       while True:
-        line = await file.readline()
-        if line != '':
-          await websocket.send_text(line)
-        else:
-          # TODO: how to make the readline() block until there is a line?
-          await asyncio.sleep(2)
-
+        records = asyncio.create_task(subscription.get())
+        await asyncio.wait([records, disconnected], return_when=asyncio.FIRST_COMPLETED)
+        if not records.done():
+          records.cancel()
+          break
+        dropped = subscription.take_dropped()
+        await websocket.send_text(render(records.result(), dropped, format))
+  except WebSocketDisconnect:
+    pass
   except Exception as e:
     logger.exception(e)
   finally:
-    await websocket.close()
+    if disconnected is not None:
+      disconnected.cancel()
+    if websocket.client_state == WebSocketState.CONNECTED:
+      await websocket.close()
 
+
+def render(records:List[LogEntry], dropped:int, format:str) -> str:
+  if format == 'json':
+    return json.dumps({'dropped': dropped, 'records': [record.model_dump() for record in records]})
+  text = f'... {dropped} log records dropped, client too slow\n' if dropped else ''
+  text += ''.join(record.render() for record in records)
+  # the log page is an xterm, which doesn't return to column 0 on a bare \n
+  return text.replace('\n', '\r\n')
+
+
+@router.get("/log/recent", response_model=List[LogEntry], tags=["Logs"])
+def recent_logs(count:int=Query(LOG_REPLAY, ge=0), level:str='DEBUG', txid:Optional[str]=None):
+  '''The most recent log records, optionally only those at or above level or for one txid'''
+  try:
+    levelno = parse_level(level)
+  except ValueError as e:
+    raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+  return log_hub.recent(count, levelno, txid)
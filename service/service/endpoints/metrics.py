@@ -0,0 +1,38 @@
+from typing import List
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from service.instrumentation import LatencySummary, metrics
+from service.outbound import OutboundStats, outbound
+from logging import getLogger
+
+logger = getLogger()
+
+router = APIRouter()
+
+# Request and stage latencies, as recorded by the spans in instrumentation.py,
+# and the outbound connection pool (see outbound.py)
+
+@router.get("/metrics", response_class=PlainTextResponse, tags=["Metrics"])
+async def prometheus_metrics():
+  '''Latency histograms per route and stage, and outbound pool stats, in Prometheus text format'''
+  # async, so the outbound stats are read on the event loop that updates them
+  return PlainTextResponse(metrics.prometheus() + outbound.prometheus(),
+                           media_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@router.get("/metrics/latency", response_model=List[LatencySummary], tags=["Metrics"])
+def latency_summary():
+  '''Latency percentiles per route and stage, in seconds'''
+  return metrics.summaries()
+
+
+@router.get("/metrics/outbound", response_model=OutboundStats, tags=["Metrics"])
+async def outbound_stats():
+  '''Calls out to other services: connections, hosts in use and the response cache'''
+  return outbound.stats()
+
+
+@router.delete("/metrics", status_code=204, tags=["Metrics"])
+def reset_metrics():
+  '''Start the latency histograms again from empty'''
+  metrics.reset()
@@ -10,6 +10,7 @@ import asyncio
 import time
 
 from service.tanaparser import prune_reference_nodes
+from service.instrumentation import VECTOR_STORE, span
 
 logger = getLogger()
 
@@ -70,9 +71,7 @@ lock = asyncio.Lock()
 @router.post("/pinecone/upsert", status_code=status.HTTP_204_NO_CONTENT, tags=["Pinecone"])
 async def upsert(request: Request, req: PineconeRequest):
   async with lock:
-    start_time = time.time()
-    logger.info(f'DO txid={request.headers["x-request-id"]}')
-
+    # timed by the request span, see instrumentation.py
     pruned_content = prune_reference_nodes(req.context)
     req.context = pruned_content
 
@@ -93,10 +92,8 @@ async def upsert(request: Request, req: PineconeRequest):
     def do_upsert():
       index.upsert(vectors=vectors, namespace=TANA_NAMESPACE)
     
-    do_upsert()
-    process_time = (time.time() - start_time) * 1000
-    formatted_process_time = '{0:.2f}'.format(process_time)
-    logger.info(f'DONE txid={request.headers["x-request-id"]} time={formatted_process_time}')
+    with span(VECTOR_STORE):
+      do_upsert()
     return None
 
 @router.post("/pinecone/delete", status_code=status.HTTP_204_NO_CONTENT, tags=["Pinecone"])
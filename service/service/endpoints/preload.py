@@ -5,6 +5,7 @@ import tempfile
 from logging import getLogger
 
 from fastapi import APIRouter, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.encoders import jsonable_encoder
 from typing import List, Tuple
 
@@ -22,7 +23,7 @@ from service.dependencies import (
 )
 
 from service.endpoints.chroma import chroma_upsert
-from service.endpoints.topics import TanaDocument, extract_topics
+from service.endpoints.topics import TanaDocument, topics_from_dump
 from service.tana_types import TanaDump
 
 logger = getLogger()
@@ -170,7 +171,7 @@ async def chroma_preload(request: Request, tana_dump:TanaDump, model:str="openai
   async with lock:
     messages = []
     async with capture_logs(logger) as logs:
-      result = await extract_topics(tana_dump, 'JSON') # type: ignore
+      result = await run_in_threadpool(topics_from_dump, tana_dump, 'JSON')
       logger.info('Extracted topics from Tana dump')
 
       # save output to a temporary file
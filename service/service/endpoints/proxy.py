@@ -1,11 +1,18 @@
 from enum import Enum
 from starlette.requests import Request
-from fastapi import APIRouter, Response
-from fastapi.responses import HTMLResponse
-from service.json2tana import json_to_tana
+from fastapi import APIRouter, HTTPException, status
+from fastapi.responses import HTMLResponse, StreamingResponse
+from service.json2tana import tana_lines
+from service.jsonstream import JSONStream
+from service.outbound import outbound
+from service.settings import settings
+from starlette.concurrency import run_in_threadpool
 from starlette.requests import Request
 from logging import getLogger
-import json
+from typing import AsyncIterator
+import asyncio
+import codecs
+import time
 import httpx
 
 from service.json2tana import tana_to_json
@@ -14,7 +21,14 @@ router = APIRouter()
 
 logger = getLogger()
 
-client = httpx.AsyncClient()
+# The response is converted as it arrives. The JSON is parsed incrementally
+# (see service/jsonstream.py) and, for the usual top-level array, each
+# element goes out in Tana format as soon as it is complete. Responses
+# bigger than settings.proxy_max_bytes, or slower than
+# settings.proxy_timeout, are cut off.
+
+# how much of the response to quote back if it can't be converted
+ERROR_CONTEXT = 1000
 
 class BodyVerb(str, Enum):
   POST = "POST"
@@ -39,67 +53,113 @@ async def make_proxy_request(method:str, path: str, req:Request, body=None):
   new_headers[b'accept-encoding'] = b'identity'
 
   # TODO: follow redirects, etc ...
-  # rp_resp:httpx.Response = None
-  if method == 'POST':
-    # build a request and pass on all headers
-    rp_resp = await client.post(url=target_url,
-                                  headers=new_headers,
-                                  json=body)
-  elif method == 'PUT':
-    rp_resp = await client.put(url=target_url,
-                                  headers=new_headers,
-                                  json=body)
-  elif method == 'PATCH':
-    rp_resp = await client.patch(url=target_url,
-                                  headers=new_headers,
-                                  json=body)
-  elif method == 'GET':
-    rp_resp = await client.get(url=target_url,
-                                  headers=new_headers)
-  elif method == 'DELETE':
-    rp_resp = await client.delete(url=target_url,
-                                  headers=new_headers)
-  else:
-    rp_resp = None
-
-  # now convert the response back to Tana paste format
-  tana_format = None
-  if rp_resp is not None:
+  # build a request and pass on all headers
+  client = outbound.client
+  rp_req = client.build_request(method, url=target_url, headers=new_headers, json=body)
+
+  deadline = time.monotonic() + settings.proxy_timeout
+  try:
+    rp_resp = await asyncio.wait_for(client.send(rp_req, stream=True), settings.proxy_timeout)
+  except asyncio.TimeoutError:
+    raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                        detail=f'No response from {target_url} within {settings.proxy_timeout} seconds')
+
+  # the start of the response, for errors
+  head = bytearray()
+  chunks = tana_chunks(rp_resp, deadline, settings.proxy_max_bytes, head)
+
+  # wait for the first of it, so if it can't be converted at all we can say so
+  try:
+    first = await anext(chunks, '')
+  except HTTPException:
+    raise
+  except Exception as e:
+    logger.error(f'Exception converting response to Tana format: {e}')
+    return HTMLResponse(f"Exception converting response to Tana format. Response was {quote(head)}",
+                        status_code=rp_resp.status_code)
+
+  async def rest():
+    yield first
+    # too late for an error status from here on, some of it has gone already
     try:
-      rp_body = rp_resp.content.decode("unicode_escape")
-      json_format = json.loads(rp_body)
-      tana_format = json_to_tana(json_format)
+      async for chunk in chunks:
+        yield chunk
+    except HTTPException as e:
+      logger.warning(f'Proxy response cut off: {e.detail}')
+      yield f"- Response cut off: {e.detail}\n"
     except Exception as e:
       logger.error(f'Exception converting response to Tana format: {e}')
-      tana_format = f"Exception converting response to Tana format. Response was {rp_resp.content}"
-  return (tana_format, rp_resp.status_code)
+      yield f"Exception converting response to Tana format. Response was {quote(head)}"
+    finally:
+      # if the caller went away, we're done with the upstream response too
+      await chunks.aclose()
+
+  return StreamingResponse(rest(), status_code=rp_resp.status_code, media_type='text/html')
+
+
+def quote(head:bytearray) -> str:
+  return f'{bytes(head[:ERROR_CONTEXT])}' + ('...' if len(head) > ERROR_CONTEXT else '')
+
+
+def convert(stream:JSONStream, decoder:codecs.IncrementalDecoder, data:bytes, final:bool=False) -> str:
+  '''Tana format for the values completed by the next bit of the response.'''
+  values = stream.feed(decoder.decode(data, final=final))
+  if final:
+    values += stream.close()
+  return ''.join(tana_lines(values))
+
+
+async def tana_chunks(rp_resp:httpx.Response, deadline:float, max_bytes:int, head:bytearray) -> AsyncIterator[str]:
+  '''The response in Tana format, as it arrives.'''
+  stream = JSONStream()
+  decoder = codecs.getincrementaldecoder('unicode_escape')()
+  received = 0
+  try:
+    data_chunks = rp_resp.aiter_bytes()
+    while True:
+      try:
+        data = await asyncio.wait_for(anext(data_chunks, None), deadline - time.monotonic())
+      except asyncio.TimeoutError:
+        raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                            detail=f'Response from {rp_resp.url} took over {settings.proxy_timeout} seconds')
+      if data is None:
+        break
+      received += len(data)
+      if received > max_bytes:
+        raise HTTPException(status_code=status.HTTP_502_BAD_GATEWAY,
+                            detail=f'Response from {rp_resp.url} is over {max_bytes} bytes')
+      if len(head) <= ERROR_CONTEXT:
+        head += data[:ERROR_CONTEXT + 1 - len(head)]
+      # CPU bound for big elements, so off the event loop
+      tana_format = await run_in_threadpool(convert, stream, decoder, data)
+      if tana_format:
+        yield tana_format
+    tana_format = await run_in_threadpool(convert, stream, decoder, b'', True)
+    if tana_format:
+      yield tana_format
+  finally:
+    await rp_resp.aclose()
 
 
 # Make a GET request to a JSON endpoint and return result in Tana format
 @router.get("/proxy/GET/{path:path}", response_class=HTMLResponse, tags=["Proxy"])
-async def proxy_get(req:Request, path, response:Response):
+async def proxy_get(req:Request, path):
   # NO BODY
-  (tana_format, status) = await make_proxy_request('GET', path, req)
-  response.status_code = status
-  return tana_format
+  return await make_proxy_request('GET', path, req)
 
 @router.post("/proxy/DELETE/{path:path}", response_class=HTMLResponse, tags=["Proxy"])
-async def proxy_delete(req:Request, path:str, response:Response):
+async def proxy_delete(req:Request, path:str):
   # NO BODY
-  (tana_format, status) = await make_proxy_request('DELETE', path, req)
-  response.status_code = status
-  return tana_format
+  return await make_proxy_request('DELETE', path, req)
 
 # For HTTP methods that accept bodies, take input in Tana format, and return 
 # result in Tana format, but call intermediate service in between with JSON format
 @router.post("/proxy/{verb}/{path:path}", response_class=HTMLResponse, tags=["Proxy"])
-async def proxy_bodyverb(req:Request, path:str, verb:BodyVerb, response:Response):
+async def proxy_bodyverb(req:Request, path:str, verb:BodyVerb):
   # convert the body to JSON
   body = await req.body()
   tana_format = body.decode("unicode_escape")  
   object_graph = tana_to_json(tana_format)
   # extract object within the wrapped array
   object_graph = object_graph[0]
-  (tana_format, status) = await make_proxy_request(verb, path, req, object_graph)
-  response.status_code = status
-  return tana_format
+  return await make_proxy_request(verb, path, req, object_graph)
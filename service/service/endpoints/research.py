@@ -1,71 +1,28 @@
 import asyncio
-import json
-import os
-import tempfile
+import importlib
 import time
-from functools import lru_cache
 from logging import getLogger
-from pathlib import Path
+from types import ModuleType
+from typing import Optional
 
-from fastapi import APIRouter, Request, status
-from fastapi.encoders import jsonable_encoder
+from fastapi import APIRouter, Query, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import HTMLResponse
-from typing import List, Dict, Any
-from pydantic import Field, validator
+from pydantic import BaseModel
 
-# This is here to satisfy runtime import needs 
-# that pyinstaller appears to miss
-
-from llama_index.node_parser import SentenceSplitter
-from llama_index.schema import TextNode, NodeRelationship, RelatedNodeInfo, MetadataMode, NodeWithScore
-from llama_index.callbacks import CallbackManager, LlamaDebugHandler, OpenInferenceCallbackHandler
-from llama_index.embeddings import OpenAIEmbedding, OllamaEmbedding
-from llama_index.indices.query.query_transform import HyDEQueryTransform
-from llama_index.query_pipeline import QueryPipeline
-from llama_index.llms import OpenAI, Ollama
-from llama_index.llms.base import BaseLLM
-from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index import LLMPredictor, PromptTemplate, VectorStoreIndex, Document, StorageContext, ServiceContext, download_loader
-from llama_index.callbacks import CallbackManager, LlamaDebugHandler
-from llama_index.embeddings import OpenAIEmbedding
-from llama_index.llms import OpenAI
-from llama_index.vector_stores.chroma import ChromaVectorStore
-from llama_index import VectorStoreIndex, Document, StorageContext, ServiceContext, download_loader
-from llama_index.callbacks import CallbackManager, LlamaDebugHandler
-from llama_index.indices.query.query_transform.base import DecomposeQueryTransform
-from llama_index import ServiceContext
-from llama_index.postprocessor import CohereRerank
-from llama_index.response_synthesizers import TreeSummarize
-from llama_index.postprocessor import PrevNextNodePostprocessor, LLMRerank
-from llama_index.storage.docstore import SimpleDocumentStore
-from llama_index.query_pipeline import CustomQueryComponent, InputKeys, OutputKeys
-from llama_index.postprocessor.types import BaseNodePostprocessor
-from llama_index.vector_stores.types import BasePydanticVectorStore
-
-from llama_index.indices.vector_store.retrievers import VectorIndexAutoRetriever, VectorIndexRetriever
-
-from llama_index.vector_stores.types import MetadataInfo, VectorStoreInfo
-
-from snowflake import SnowflakeGenerator
-
-from service.dependencies import (
-    TANA_NODE,
-    TANA_TEXT,
-    LlamaindexAsk,
-    TanaNodeMetadata,
-)
-from service.endpoints.chroma import get_collection, get_tana_nodes_by_id
-
-from service.endpoints.topics import TanaDocument, extract_topics, is_reference_content, tana_node_ids_from_text
-from service.llamaindex import DecomposeQueryWithNodeContext, WidenNodeWindowPostProcessor, create_index, get_index
-from service.tana_types import TanaDump
+from service.dependencies import LlamaindexAsk
+from service.streaming import stream_response
+from service.txntimer import StageTimings
 
 logger = getLogger()
-snowflakes = SnowflakeGenerator(42)
 
 router = APIRouter()
 
-minutes = 1000 * 60
+# The research endpoints are backed by llama_index (see service/llamaindex.py),
+# which takes several seconds to import, and more to build the index. So the
+# research stack is loaded as a plugin: on first use (or POST /llamaindex/warmup),
+# in a background task running in a worker thread. Startup of the service
+# itself doesn't pay for it at all.
 
 # TODO: Add header support throughout so we can pass Tana API key and OpenAPI Key as headers
 # NOTE: we already have this in the main.py middleware wrapper, but it would be better
@@ -73,210 +30,122 @@ minutes = 1000 * 60
 # x_tana_api_token: Annotated[str | None, Header()] = None
 # x_openai_api_key: Annotated[str | None, Header()] = None
 
-
-# enrich our retriever with knowledge of our metadata
-def get_auto_retriever(index:VectorStoreIndex):
-  vector_store_info = VectorStoreInfo(
-    content_info="My Tana Notebook. Comprises many Tana nodes with text and metadata fields.",
-    metadata_info=[
-        MetadataInfo(
-            name="category",
-            type="str",
-            description=(
-                "One of TANA_NODE or TANA_TEXT\n"
-                "TANA_NODE means that this is a top-level topic in my Tana notebook\n"
-                "TANA_TEXT means this is detailed information as part of a topic, identfied by topic_id metadata.\n"
-                "Do NOT use category to query the index. Only use category to enrich your understanding of the result.\n"
-                "DO NOT reference category in your responses.\n"
-            ),
-        ),
-        MetadataInfo(
-            name="topic_id",
-            type="str",
-            description=(
-                "Identifies the Tana Notebook Node that this text is part of. Should be used as a reference to the notebook entry.\n"
-                "Only use topic_id to query the index when you want a single specific node by reference.\n"
-                "You can use topic_id when referencing a Tana Notebook Node in your responses.\n"
-            ),
-        ),
-        MetadataInfo(
-            name="tana_id",
-            type="str",
-            description=(
-                "The Tana Notebook Node for this piece of text. Should be used a reference to the notebook entry.\n"
-                "Only use topic_id to query the index when you want a single specific node by reference.\n"
-                "You can use tana_id when referencing a Tana Notebook Node in your responses.\n"
-            ),
-        ),
-        MetadataInfo(
-            name="supertag",
-            type="str",
-            description=(
-                "One or more optional GENERAL semantic ontology tags for this Tana Notebook Node.\n"
-                "Delimited by spaces (NOT a LIST. Do not use IN operator to test membership)\n"
-                "Example: \n"
-                "{ supertag:  #task #topic #person #meeting }\n"
-                "Do NOT use supertags to query the index. Only use supertags to enrich your understanding of the result.\n"
-            ),
-        ),
-      ],
-  )
-
-  # THIS doesn't work at all well with GPT 3
-  # and only works sometimes with GPT4. Problem is that it becomes fixated on the 
-  # use of metadata to filter results, overly constraining relevance.
-  # retriever = VectorIndexAutoRetriever(
-  #     index, 
-  #     vector_store_info=vector_store_info, 
-  #     similarity_top_k=10
-  # )
-
-  retriever = VectorIndexRetriever(index=index, similarity_top_k=10)
-  return retriever
+# research questions are looked into in parallel, this many at a time
+RESEARCH_FAN_OUT = 4
+# and at most this many retrieval / LLM calls are started per second
+RESEARCH_RATE_LIMIT = 4.0
+
+COLD = 'cold'
+LOADING = 'loading'
+READY = 'ready'
+FAILED = 'failed'
+
+class ResearchStatus(BaseModel):
+  state: str = COLD
+  # how long the import, and building the index, took
+  import_seconds: Optional[float] = None
+  index_seconds: Optional[float] = None
+  error: Optional[str] = None
+
+
+class ResearchStack:
+  '''Loads the research stack module on first use, off the event loop.'''
+
+  def __init__(self, module:str='service.llamaindex', model:str='openai'):
+    self.module_name = module
+    self.model = model
+    self.module: Optional[ModuleType] = None
+    self.task: Optional[asyncio.Task] = None
+    self.status = ResearchStatus()
+
+  def _load(self) -> ModuleType:
+    start = time.perf_counter()
+    module = importlib.import_module(self.module_name)
+    self.status.import_seconds = time.perf_counter() - start
+    logger.info(f'Imported research stack in {self.status.import_seconds:.1f}s')
+
+    # the index can fail to build (Chroma, OpenAI key). Requests will try again
+    start = time.perf_counter()
+    try:
+      module.warm_up(self.model)
+      self.status.index_seconds = time.perf_counter() - start
+      logger.info(f'Built research index in {self.status.index_seconds:.1f}s')
+    except Exception as e:
+      logger.warning(f'Failed to warm up research index: {e}')
+    return module
+
+  async def _run(self) -> ModuleType:
+    self.status.state = LOADING
+    try:
+      self.module = await asyncio.to_thread(self._load)
+      self.status.state = READY
+      return self.module
+    except Exception as e:
+      self.status.state = FAILED
+      self.status.error = str(e)
+      logger.exception(f'Failed to load research stack: {e}')
+      raise
+
+  def warm_up(self) -> asyncio.Task:
+    '''Start loading in the background, if not already loaded or loading.'''
+    if self.task is None or (self.task.done() and self.module is None):
+      self.task = asyncio.create_task(self._run())
+    return self.task
+
+  async def load(self) -> ModuleType:
+    if self.module is not None:
+      return self.module
+    # shield, so a cancelled request doesn't cancel the load for everyone else
+    return await asyncio.shield(self.warm_up())
+
+
+research_stack = ResearchStack()
+
+
+@router.get("/llamaindex/status", response_model=ResearchStatus, tags=["research"])
+async def llamaindex_status():
+  '''Whether the research stack is loaded yet, and how long loading took'''
+  return research_stack.status
+
+
+@router.post("/llamaindex/warmup", response_model=ResearchStatus, tags=["research"])
+async def llamaindex_warmup():
+  '''Start loading the research stack in the background, ahead of the first question'''
+  research_stack.warm_up()
+  return research_stack.status
 
 
 @router.post("/llamaindex/ask", response_class=HTMLResponse, tags=["research"])
-def llamaindex_ask(req: LlamaindexAsk, model:str):
-  '''Ask a question of the Llamaindex and return the top results
+async def llamaindex_ask(request: Request, req: LlamaindexAsk, model:str, stream:bool=False):
+  '''Ask a question of the Llamaindex and return the top results.
+  With stream=true, the answer is returned as it is generated.
   '''
+  timings = StageTimings()
+  with timings.stage('load'):
+    llamaindex = await research_stack.load()
 
-  (index, service_context, vector_store, llm) = get_index(model=model)
-
-  query_engine=index.as_query_engine(similarity_top_k=20, stream=False)
-
-  logger.info(f'Querying LLamaindex with {req.query}')
-  response = query_engine.query(req.query)
-  return str(response)
+  with timings.stage('ask'):
+    answer = await run_in_threadpool(llamaindex.ask, req.query, model, stream)
+  if stream:
+    return stream_response(request, answer)
+  return HTMLResponse(content=answer, headers={'Server-Timing': timings.server_timing()})
 
 
-summary_tmpl = PromptTemplate(
-    "You are an expert Q&A system that is trusted around the world.\n"
-    "TASK\n"
-    "Summarize the following CONTEXT in order to best answer the QUERY.\n"
-    "Answer the QUERY using the provided CONTEXT information, and not prior knowledge.\n"
-    "Some rules to follow:\n"
-    "1. Avoid statements like 'Based on the context, ...' or 'The context information ...' or anything along those lines.\n"
-    "2. The CONTEXT contais references to many Tana Notebook Nodes. Nodes have both metadata and text content\n"
-    "3. Whenever your summary needs to reference Tana Notebook Nodes from the CONTEXT, use proper Tana node reference format as follows:\n"
-    "  the characters '[[' + '^' + tana_id metadata and then the characters ']]'.\n"
-    "  E.g. to reference the Tana context node titled 'Recipe for making icecream' with tana_id: xghysd76 use this format:\n"
-    "    [[^xghysd76]]\n"
-    "5. Try to avoid making many redundant references to the same Tana node in your summary. Use footnote style if you really need to do this.\n"
-    "\n"
-    "QUERY: {query_str}\n"
-    "-----\n"
-    "CONTEXT:\n"
-    "{context_str}\n"
-    "END_CONTEXT\n"
-    "-----\n"
-  )
-
 #TODO: Move model out of POST body and into query params perhaps?
 @router.post("/llamaindex/research", response_class=HTMLResponse, tags=["research"])
-def llama_ask_custom_pipeline(req: LlamaindexAsk, model:str):
-  '''Research a question using Llamaindex and return the top results.'''
-  (index, service_context, storage_context, llm) = get_index(model, observe=True)
-
-  logger.info(f'Researching LLamaindex with {req.query}')
-
-  # first, build up a set of research questions
-  decompose_transform = DecomposeQueryWithNodeContext(llm=llm)
-  p1 = QueryPipeline(chain=[decompose_transform])
-  questions = p1.run(query=req.query)
-  
- 
-  retriever = get_auto_retriever(index)
-  # and preprocess the result nodes to make use of next/previous
-  prevnext = WidenNodeWindowPostProcessor(storage_context=storage_context, num_nodes=5, mode="both")
-  summarizer = TreeSummarize(summary_template=summary_tmpl, service_context=service_context)
-
-  # for each question, do a fetch against Chroma to find potentially relevant nodes
-  results = []
-  for question in questions:
-    if question == '':
-      continue
-
-    logger.info(f'Question: {question}')
-    # use our metadata aware auto-retriever to fetch from Chroma
-    q1 = QueryPipeline(chain=[retriever, prevnext])
-    nodes = q1.run(input=question)
-    # nodes = retriever.retrieve(question)
-    # logger.info(f'Nodes:\n{nodes}')
-
-    # clean up the redudant metadata (TANA_TEXT node metadata is less useful here)
-    new_nodes = []
-    if nodes:
-      for node in nodes:
-        new_node = node
-        if node.metadata['category'] == TANA_TEXT:
-          # copy the outer NodeWithScore and the inner TextNode objects
-          new_text_node = TextNode(**node.node.dict())
-          # wipe out the metadata
-          new_text_node.metadata = {}
-          new_node = NodeWithScore(node=new_text_node, score=node.score)
-
-        new_nodes.append(new_node)
-
-    research = '\n'.join([node.get_content(metadata_mode=MetadataMode.LLM) for node in new_nodes])
-    logger.info(f'Nodes:\n{research}')
-
-    # tailor the summarizer prompt
-    sum_result = summarizer.as_query_component().run_component(nodes=new_nodes, query_str=question)
-    summary = sum_result['output'].response
-    logger.info(f'Summary:\n{summary}')
-
-    result = {'question': question,
-              'answers': nodes,
-              'summary': summary}
-    results.append(result)
-
-  # now build up the context from the result nodes
-  context = []
-  for result in results:
-    question = result['question']
-    answer = result['answers']
-    summary = result['summary']
-    context.append(f'QUESTION: {question}\n')
-
-    #context.append('RESEARCH:\n')
-    # TODO: instead of dumping all nodes into the primary context
-    # we should prepare an answer to each question and then use that
-    # node:TextNode
-    # for node in answer:
-    #   context.append(node.get_content(metadata_mode=MetadataMode.LLM)+'\n')
-    
-    context.append('ANSWER:\n')
-    context.append(summary+'\n')
-
-    context.append('\n')
-
-  # now combine all that research 
-  prompt_tmpl = PromptTemplate(
-    "You are an expert Q&A system that is trusted around the world.\n"
-    "Always answer the question using the provided context information, and not prior knowledge.\n"
-    "Some rules to follow:\n"
-    "1. Avoid statements like 'Based on the context, ...' or 'The context information ...' or anything along those lines.\n"
-    "2. You will be given CONTEXT information in the form of one or more related QUESTIONS and the ANSWERS to those questions.\n"
-    "3. For each ANSWER, there may be many Tana Notebook Nodes. Nodes have both metadata and text content\n"
-    "4. Whenever your response needs to reference Tana Notebook Nodes from the context, use proper Tana node reference format as follows:\n"
-    "  the characters '[[' + '^' + tana_id metadata and then the characters ']]'.\n"
-    "  E.g. to reference the Tana context node titled 'Recipe for making icecream' with tana_id: xghysd76 use this format:\n"
-    "    [[^xghysd76]]\n"
-    "5. Try to avoid making many redundant references to the same Tana node in your response. Use footnote style if you really need to do this.\n"
-    "\n"
-    "QUERY: {query}\n"
-    "-----\n"
-    "CONTEXT:\n"
-    "{context}\n"
-    "END_CONTEXT\n"
-    "-----\n"
-  )
-
-  p2 = QueryPipeline(chain=[prompt_tmpl, llm])
-  response = p2.run(query=req.query, context='\n'.join(context))
-  return response.message.content
-
-# attempt to paralleize non-async code
-# see https://github.com/tiangolo/fastapi/discussions/6347
-lock = asyncio.Lock()
-
+async def llama_ask_custom_pipeline(request: Request, req: LlamaindexAsk, model:str, stream:bool=False,
+                                    fan_out:int=Query(RESEARCH_FAN_OUT, ge=1, le=16),
+                                    rate_limit:float=Query(RESEARCH_RATE_LIMIT, gt=0)):
+  '''Research a question using Llamaindex and return the top results.
+  Research questions are looked into fan_out at a time, starting at most rate_limit LLM calls per second.
+  With stream=true, the answer is returned as it is generated.'''
+  # the load stage shows whether this request had to wait for the research stack
+  timings = StageTimings()
+  with timings.stage('load'):
+    llamaindex = await research_stack.load()
+
+  if stream:
+    return stream_response(request, llamaindex.stream_research(req.query, model, timings, fan_out, rate_limit))
+
+  answer = await run_in_threadpool(llamaindex.research, req.query, model, timings, fan_out, rate_limit)
+  return HTMLResponse(content=answer, headers={'Server-Timing': timings.server_timing()})
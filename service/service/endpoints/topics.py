@@ -1,12 +1,16 @@
 import re
+import numpy as np
 from logging import getLogger
 from typing import Optional, List, Tuple
 
-from fastapi import APIRouter
-from pydantic import BaseModel
+from fastapi import APIRouter, Depends, Response
+from pydantic import BaseModel, TypeAdapter
 from service.dependencies import TANA_NODE, TanaNodeMetadata
 
 from service.tana_types import GraphLink, NodeDump, TanaDocument, TanaDump, TanaField, TanaTag, Visualizer
+from service.graphops import EdgeArrays, dedupe_edges, encode_pairs
+from service.graph_pipeline import TANA_DUMP_BODY, dump_body, links, load_dump, node_index
+from service.processpool import process_pool, shard_key
 from service.tanaparser import IS_CHILD_CONTENT_LINK, IS_TAG_LINK, NodeIndex, patch_node_name, prune_reference_nodes
 
 router = APIRouter()
@@ -19,8 +23,8 @@ class DocumentDump(BaseModel):
   links: List[GraphLink] = []
 
 
-@router.post("/topics", tags=["Extractor"])
-async def extract_topics(tana_dump:TanaDump, format:str='TANA') -> List[TanaDocument]:
+@router.post("/topics", response_model=List[TanaDocument], tags=["Extractor"], openapi_extra=TANA_DUMP_BODY)
+async def extract_topics(body:bytes=Depends(dump_body), format:str='TANA'):
   '''Given a Tana dump JSON payload, return a list of topics and their content.
 
   Topics are defined as nodes that are tagged with a supertag.
@@ -30,17 +34,31 @@ async def extract_topics(tana_dump:TanaDump, format:str='TANA') -> List[TanaDocu
 
   See the RAG articles by Prince 
   '''
+  # CPU heavy, so in the process pool
+  content = await process_pool.run(topics_json, body, format, key=shard_key(body))
+  return Response(content=content, media_type='application/json')
+
+
+# we just want top level tagged nodes and their child contents
+# TODO: figure out what we weant to do with fields
+TOPICS_CONFIG = Visualizer(include_content_nodes=True, 
+                           include_inline_refs=False,
+                           include_tag_tag_links=False,
+                           include_node_tag_links=True,
+                           include_inline_ref_nodes=False)
 
-  
-  # we just want top level tagged nodes and their child contents
-  # TODO: figure out what we weant to do with fields
-  config = Visualizer(include_content_nodes=True, 
-                      include_inline_refs=False,
-                      include_tag_tag_links=False,
-                      include_node_tag_links=True,
-                      include_inline_ref_nodes=False)
 
-  index = NodeIndex(tana_dump=tana_dump, config=config)
+def topics_json(body:bytes, format:str) -> bytes:
+  # the indexed dump and its deduped links, shared with the graph
+  # endpoints. See service/graph_pipeline.py
+  entry = load_dump(body)
+  index = node_index(entry)
+  edges = links(entry, TOPICS_CONFIG)
+  return TypeAdapter(List[TanaDocument]).dump_json(topics_from_index(index, edges, format))
+
+
+def topics_from_dump(tana_dump:TanaDump, format:str='TANA') -> List[TanaDocument]:
+  index = NodeIndex(tana_dump=tana_dump, config=TOPICS_CONFIG)
 
   # build our primary indices first, so we can easily navigate the dump
   index.build_indices()
@@ -52,14 +70,13 @@ async def extract_topics(tana_dump:TanaDump, format:str='TANA') -> List[TanaDocu
   # Now that we have the dump converted to a set of directed 
   # tuples, we can build a graph from it.
 
-  # strip the links down to the unique set
-  candidate_pairs = set(master_pairs)
-  final_pairs = set()
+  # strip the links down to the unique set, also
+  # removing redundant bidirectional links
+  edges = dedupe_edges(encode_pairs(master_pairs, index.index))
+  return topics_from_index(index, edges, format)
 
-  # also remove redundant bidirectional links
-  [final_pairs.add((a, b, r)) for (a, b, r) in candidate_pairs
-    if (a, b, r) not in final_pairs and (b, a, r) not in final_pairs]
-  
+
+def topics_from_index(index:NodeIndex, edges:EdgeArrays, format:str='TANA') -> List[TanaDocument]:
   # start from the top and only
   # iterate nodes that are tagged. We call these "topics"
   # For each topic, we want the fields and tags of the node
@@ -67,73 +84,73 @@ async def extract_topics(tana_dump:TanaDump, format:str='TANA') -> List[TanaDocu
   # direct children of the topic node. We call these "content"
   
   # remap the final pairs to a list of topics
-  sources = set([(source_id, reason) for (source_id, _, reason) in final_pairs])
+  tag_link = edges.reason_code(IS_TAG_LINK)
+  sources = np.unique(edges.src[edges.reason == tag_link]).tolist() if tag_link >= 0 else []
   topics = []
-  for (source_id, reason) in sources:
-    if reason == IS_TAG_LINK:
-      node = index.node(source_id)
-      topic_name = patch_node_name(index, source_id)
-      topic = TanaDocument(id=source_id, 
-                          name=topic_name,
-                          description=node.props.description,
-                          fields=[],
-                          tags = tag_list(index, node.tags)
-                          # content
-                          )
-      
-      topics.append(topic)
-      
-      topic.content = [(source_id, False, '- '+topic_name)]
-
-      # add all the tag names as structured elems 
-      # for tag_id in node.tags:
-      #   topic.tags.append(index.node(tag_id).props.name)
-
-      # add all the field names and values
-      for field_dict in node.fields:
-        field_id = field_dict['field']
-        field_name=index.node(field_id).props.name
-        value_ids = field_dict['values']
-                
-        value_contents = []
-        for value_id in value_ids:
-          if not index.valid(value_id):
-            logger.warning(f'Invalid field value_id: {value_id} for field: {field_id}. Presumably trashed node.')
-            continue
-          
-          value_node = index.node(value_id)
-          if len(value_node.tags) > 0:
-            # if it's tagged, again assume it's a ref, not an inline content node
-            value = '[['+patch_node_name(index, value_id)+'^'+value_id+']]'+add_tags(index, index.node(value_id).tags)
-          else:
-            value = patch_node_name(index, value_id)
-
-          value_contents += [value]
-
-          # so how do we want to represent fields?
-          if format == 'JSON':
-            # structure fields as metadata, but skip if empty
-            if value != "":
-              field = TanaField(field_id=field_id,
-                                value_id=value_id,
-                                name=index.node(field_id).props.name,
-                                value=value)
-            
-              topic.fields.append(field) # type: ignore
+  for source_code in sources:
+    source_id = edges.node_ids[source_code]
+    node = index.node(source_id)
+    topic_name = patch_node_name(index, source_id)
+    topic = TanaDocument(id=source_id, 
+                        name=topic_name,
+                        description=node.props.description,
+                        fields=[],
+                        tags = tag_list(index, index.tags_of(source_id))
+                        # content
+                        )
+    
+    topics.append(topic)
+    
+    topic.content = [(source_id, False, '- '+topic_name)]
+
+    # add all the tag names as structured elems 
+    # for tag_id in node.tags:
+    #   topic.tags.append(index.node(tag_id).props.name)
+
+    # add all the field names and values
+    for field_dict in index.fields_of(source_id):
+      field_id = field_dict['field']
+      field_name=index.node(field_id).props.name
+      value_ids = field_dict['values']
+              
+      value_contents = []
+      for value_id in value_ids:
+        if not index.valid(value_id):
+          logger.warning(f'Invalid field value_id: {value_id} for field: {field_id}. Presumably trashed node.')
+          continue
         
-        #TODO: redo all ths code to use field value_ids instead of ''
-        if format == 'TANA':
-          # structure fields in Tana paste format
-          if len(value_contents) > 0 and len(value_contents[0]) > 0:
-            topic.content.append((None, False, f"  - {field_name}:: {value_contents[0]}"))
-            for value in value_contents[1:]:
-              topic.content.append((None, False, f"    - {value}"))
-          # and remove any structured fields
-          topic.fields = None
-
-      # recursively build up child content for "sentence splitting"
-      topic.content += recurse_content(index, source_id)
+        if len(index.tags_of(value_id)) > 0:
+          # if it's tagged, again assume it's a ref, not an inline content node
+          value = '[['+patch_node_name(index, value_id)+'^'+value_id+']]'+add_tags(index, index.tags_of(value_id))
+        else:
+          value = patch_node_name(index, value_id)
+
+        value_contents += [value]
+
+        # so how do we want to represent fields?
+        if format == 'JSON':
+          # structure fields as metadata, but skip if empty
+          if value != "":
+            field = TanaField(field_id=field_id,
+                              value_id=value_id,
+                              name=index.node(field_id).props.name,
+                              value=value)
+          
+            topic.fields.append(field) # type: ignore
       
+      #TODO: redo all ths code to use field value_ids instead of ''
+      if format == 'TANA':
+        # structure fields in Tana paste format
+        if len(value_contents) > 0 and len(value_contents[0]) > 0:
+          topic.content.append((None, False, f"  - {field_name}:: {value_contents[0]}"))
+          for value in value_contents[1:]:
+            topic.content.append((None, False, f"    - {value}"))
+        # and remove any structured fields
+        topic.fields = None
+
+    # recursively build up child content for "sentence splitting"
+    topic.content += recurse_content(index, source_id)
+    
   return topics
 
 def indent(depth:int) -> str:
@@ -181,19 +198,17 @@ def tana_node_ids_from_text(text:str) -> List[str]:
 # TODO: now that we "prune" reference nodes, do we need depth_limit?
 
 def recurse_content(index:NodeIndex, parent_id:str, depth_limit=10) -> list[tuple[str|None, bool, str]]:
-  parent_node = index.node(parent_id)
   content = []
 
-  for content_id in parent_node.content:
-    content_node = index.node(content_id)
+  for content_id in index.content_of(parent_id):
     reason = index.get_linkage_reason(parent_id, content_id)
     if reason is IS_CHILD_CONTENT_LINK:
-      if len(content_node.tags) > 0:
+      if len(index.tags_of(content_id)) > 0:
         # this is a tagged topic in it's own right, don't recurse
         # and treat it like a referenced node. (Yes, this isn't Tana's way
         # but we want to reduce redundant content and Day nodes mess with this
         # concept rather badly)
-        content.append((content_id, True, indent(11 - depth_limit)+'- [['+patch_node_name(index, content_id)+'^'+content_id+']]'+add_tags(index, content_node.tags)))
+        content.append((content_id, True, indent(11 - depth_limit)+'- [['+patch_node_name(index, content_id)+'^'+content_id+']]'+add_tags(index, index.tags_of(content_id))))
       else:
         # this is a regular text node, untagged and not a reference
 
@@ -205,7 +220,7 @@ def recurse_content(index:NodeIndex, parent_id:str, depth_limit=10) -> list[tupl
           content += recurse_content(index, content_id, depth_limit - 1)
     else:
       # this is a Tana reference link, so don't recurse
-      content.append((content_id, True, indent(11 - depth_limit)+'- [['+patch_node_name(index, content_id)+'^'+content_id+']]'+add_tags(index, content_node.tags)))
+      content.append((content_id, True, indent(11 - depth_limit)+'- [['+patch_node_name(index, content_id)+'^'+content_id+']]'+add_tags(index, index.tags_of(content_id))))
 
   return content
 
@@ -10,6 +10,7 @@ import asyncio
 import time
 
 from service.tanaparser import prune_reference_nodes
+from service.instrumentation import VECTOR_STORE, span
 
 logger = getLogger()
 
@@ -78,9 +79,7 @@ lock = asyncio.Lock()
 @router.post("/weaviate/upsert", status_code=status.HTTP_204_NO_CONTENT, tags = ['Weaviate'])
 async def weaviate_upsert(request: Request, req: WeaviateRequest):
   async with lock:
-    start_time = time.time()
-    logger.info(f'DO txid={request.headers["x-request-id"]}')
-
+    # timed by the request span, see instrumentation.py
     pruned_content = prune_reference_nodes(req.context)
     req.context = pruned_content
 
@@ -112,10 +111,8 @@ async def weaviate_upsert(request: Request, req: WeaviateRequest):
         # no node yet. create it
         client.data_object.create(data_object=metadata, class_name="TanaNode", vector=vector)
 
-    do_upsert()
-    process_time = (time.time() - start_time) * 1000
-    formatted_process_time = '{0:.2f}'.format(process_time)
-    logger.info(f'DONE txid={request.headers["x-request-id"]} time={formatted_process_time}')
+    with span(VECTOR_STORE):
+      do_upsert()
     return None
 
 @router.post("/weaviate/delete", status_code=status.HTTP_204_NO_CONTENT, tags = ['Weaviate'])
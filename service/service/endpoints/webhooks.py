@@ -1,14 +1,21 @@
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse
 from fastapi import APIRouter, status, Body, HTTPException
-from jinja2 import Environment, FileSystemLoader, TemplateNotFound
-from service.dependencies import OpenAICompletion, get_chatcompletion, LineTimer
-from service.settings import settings
+from fastapi.concurrency import iterate_in_threadpool, run_in_threadpool
+from jinja2 import TemplateSyntaxError
+from service.completioncache import CacheStats, completion_cache
+from service.dependencies import OpenAICompletion, completion_cache_key, get_chatcompletion, get_chatcompletion_stream
+from service.instrumentation import TANA_API, span
+from service.streaming import StreamEvent, stream_response
+from service.settings import settings, tana_helper_config_dir
+from service.webhookjobs import SchemaMetrics, WebhookJob, WebhookJobQueue
+from service.webhookschemas import SchemaRegistry, SchemaSettings
+from service.tanainput import TanaInputAPIError, tana_input
 from starlette.requests import Request
 from logging import getLogger
-import httpx
+from typing import Dict, List, Optional
 import json
-import re
 import os
+import re
 
 router = APIRouter()
 
@@ -16,9 +23,16 @@ logger = getLogger()
 
 path = settings.webhook_template_path
 
-environment = Environment(loader=FileSystemLoader(path))
-# pattern to strip URLs out of incoming 
-pattern = re.compile(r'\(?"?http[^\t ")]*"?\)?')
+# compiled templates and settings for every schema, see service/webhookschemas.py
+schemas = SchemaRegistry(path)
+schemas.refresh()
+
+def get_schema(schema:str):
+  webhook_schema = schemas.get(schema)
+  if webhook_schema is None:
+    logger.warning(f'Failed to find template {schemas.template_file(schema)}')
+    raise HTTPException(detail=f'Schema {schema} not found. Upload first', status_code=status.HTTP_400_BAD_REQUEST)
+  return webhook_schema
 
 # Schema upload handlers
 
@@ -32,41 +46,47 @@ async def add_template(req:Request,
   '''
   # create file from body
   try:
-    if not os.path.exists(path):
-      os.makedirs(path, exist_ok=True)
-    with open(f'{path}/{schema}.jn2', 'w') as template_file:
-      print(body, file=template_file)
-      logger.debug(f'Saved template {path}/{schema}.jn2')
+    schemas.save_template(schema, body)
+    logger.debug(f'Saved template {schemas.template_file(schema)}')
+  except TemplateSyntaxError as e:
+    raise HTTPException(detail=f'Invalid template: {e}', status_code=status.HTTP_400_BAD_REQUEST)
   except IOError as e:
     raise HTTPException(detail = e.strerror, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
   return f'{req.base_url}webhook/{schema}'
 
-@router.get("/schema", tags=["Webhooks"])
+@router.get("/schema", response_model=List[str], tags=["Webhooks"])
 async def get_schemas():
   '''
   Retrieve a list of all existing webhook schemas (for configuration)
   '''
-  try:
-      directory = os.listdir(path)
-      files = [f for f in directory if os.path.isfile(path+'/'+f)] #Filtering only the files.
-      schemas = [s.split('.jn2')[0] for s in files if '.jn2' in s]
-      return schemas
-  except IOError as e:
-    logger.warning(f'Failed to read directory {path}')
-    raise HTTPException(detail = e.strerror, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
+  return schemas.names()
 
 @router.get("/template/{schema}", response_class=HTMLResponse, tags=["Webhooks"])
 async def get_template(schema:str):
   '''
   Retrieves the OpenAI Prompt template for the given Tana schema.
   '''
+  return get_schema(schema).source
+
+@router.get("/schema/{schema}/settings", response_model=SchemaSettings, tags=["Webhooks"])
+async def get_schema_settings(schema:str):
+  '''
+  Retrieves the settings (OpenAI model, max tokens, ...) used for the given Tana schema.
+  '''
+  return get_schema(schema).settings
+
+@router.put("/schema/{schema}/settings", response_model=SchemaSettings, tags=["Webhooks"])
+async def set_schema_settings(schema:str, schema_settings:SchemaSettings):
+  '''
+  Change the settings (OpenAI model, max tokens, ...) used for the given Tana schema.
+  '''
+  get_schema(schema)
   try:
-      with open(f'{path}/{schema}.jn2', 'r') as template_file:
-        body = template_file.read()
-      return body
+    return schemas.save_settings(schema, schema_settings).settings
+  except re.error as e:
+    raise HTTPException(detail=f'Invalid url_pattern: {e}', status_code=status.HTTP_400_BAD_REQUEST)
   except IOError as e:
-    logger.warning(f'Failed to read file {path}/{schema}.jn2')
     raise HTTPException(detail = e.strerror, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
@@ -101,75 +121,169 @@ async def delete(schema:str):
   Remove the webhook endpoints for a Tana schema previously registered.
   '''
   try:
-    if not os.path.exists(path):
-      os.mkdir(path)
-    os.remove(f'{path}/{schema}.jn2')
-    logger.debug(f'Removed template file {path}/{schema}.jn2')
+    schemas.remove(schema)
+    logger.debug(f'Removed template file {schemas.template_file(schema)}')
   except IOError as e:
     raise HTTPException(detail = e.strerror, status_code=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
   return None
 
+OPENAI_ERROR = "OpenAI Authentication Error. Did you pass your OpenAI API Key in X-OpenAI-API-Key header or set your service env variable?"
+
+def completion_request(schema:str, body:str) -> OpenAICompletion:
+  webhook_schema = get_schema(schema)
+  # strip all URLs, trim and stuff the body into the OpenAI prompt template
+  prompt = webhook_schema.render(body)
+  return OpenAICompletion(prompt=prompt,
+                          max_tokens=webhook_schema.settings.max_tokens, 
+                          temperature=0, 
+                          model=webhook_schema.settings.model
+                          )
+
+def parse_completion(completion:str, cache_key:Optional[str]=None) -> dict:
+  # the prompt ends with the opening brace
+  jsonstring = '{' + completion
+  try:
+    return json.loads(jsonstring)
+  except json.JSONDecodeError as e:
+    # don't answer the same payload with the same unusable completion again
+    if cache_key:
+      completion_cache.delete(cache_key)
+    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                        detail=f'Could not parse the OpenAI completion as JSON. {e}')
+
+async def add_to_tana(completion:str, cache_key:Optional[str]=None):
+  tana_node = parse_completion(completion, cache_key)
+
+  # into the Inbox, via the shared (batching, rate limited) Input API client
+  try:
+    with span(TANA_API):
+      tana_result = await tana_input.add_nodes([tana_node])
+  except TanaInputAPIError as e:
+    logger.warning(f'Tana input API failed. {e.status_code}. Detail: {e.detail}')
+    raise HTTPException(status_code=e.status_code, detail=e.detail)
+  except Exception as e:
+    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
+
+  return tana_result.content
+
 # workhorse function for processing webhooks
 async def do_webhook(schema: str, body: str):
-  # strip all URLs and take first 6000 chars
-  body = re.sub(pattern, '', body)
-  body = body[0:6000]
-  
-  # stuff the body into the OpenAI prompt template
-  try:
-    temp = environment.get_template(schema+".jn2")
-    prompt = temp.render({"context": body})
-  except TemplateNotFound:
-    logger.warning(f'Failed to find template {path}/{schema}.jn2')
-    raise HTTPException(detail=f'Schema {schema} not found. Upload first', status_code=status.HTTP_400_BAD_REQUEST)
-  
+  request = completion_request(schema, body)
   try:
     # ask OpenAI to turn trash into gold
-    completion_request = OpenAICompletion(prompt=prompt,
-                                          max_tokens=1000, 
-                                          temperature=0, 
-                                          model='gpt-4'
-                                          )
-    with LineTimer('openai'):
-      completion = get_chatcompletion(completion_request)
+    # the OpenAI client is synchronous, keep it off the event loop
+    completion = await run_in_threadpool(get_chatcompletion, request)
     logger.debug(f'Result from OpenAI: {completion}')
 
   except Exception as e:
-    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="OpenAI Authentication Error. Did you pass your OpenAI API Key in X-OpenAI-API-Key header or set your service env variable?")
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=OPENAI_ERROR)
 
-  jsonstring = '{' + completion['choices'][0].message.content
-  tana_payload = { 'nodes': [json.loads(jsonstring)] }
-
-  callback_url = "https://europe-west1-tagr-prod.cloudfunctions.net/addToNodeV2"
-  headers = {'Authorization': 'Bearer ' + settings.tana_api_token}
+  return await add_to_tana(completion.choices[0].message.content, completion_cache_key(request))
 
+# streaming variant: forward the completion as it arrives, then add it to Tana
+async def stream_webhook(req:Request, schema: str, body: str):
+  request = completion_request(schema, body)
+  # worked out now, while we have the request's OpenAI key
+  cache_key = completion_cache_key(request)
   try:
-    with LineTimer('tana-input'):
-      tana_result = httpx.post(callback_url, json=tana_payload, headers=headers)
+    tokens = await run_in_threadpool(get_chatcompletion_stream, request)
   except Exception as e:
-    raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=e)
+    raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail=OPENAI_ERROR)
 
-  if tana_result.is_error:
-    logger.warning(f'Tana input API failed. {tana_result.status_code}. Detail: {tana_result.text}')
-    raise HTTPException(status_code=tana_result.status_code, detail=tana_result.text)
+  async def chunks():
+    completion = []
+    yield '{'
+    async for token in iterate_in_threadpool(tokens):
+      completion.append(token)
+      yield token
+    logger.debug(f'Result from OpenAI: {"".join(completion)}')
+    try:
+      result = await add_to_tana(''.join(completion), cache_key)
+      yield StreamEvent('done', result.decode('utf-8', errors='replace'))
+    except HTTPException as e:
+      logger.warning(f'Failed to add streamed webhook result to Tana: {e.detail}')
+      yield StreamEvent('error', str(e.detail))
 
-  return tana_result.content
+  return stream_response(req, chunks())
 
 
 # Webhook request handlers
 
+# background processing of webhooks, see service/webhookjobs.py
+jobs = WebhookJobQueue(os.path.join(tana_helper_config_dir, 'webhook_jobs.db'), do_webhook, workers=4)
+
+# run by the lazy router (see service/lazyrouter.py) once we're loaded
+async def startup():
+  # keep webhook schemas in step with their template files
+  await schemas.start()
+  # pick up any webhook jobs left over from last time
+  await jobs.start()
+
+async def shutdown():
+  await jobs.stop()
+  await schemas.stop()
+
+async def dispatch_webhook(req:Request, schema:str, body:str, background:bool, stream:bool):
+  if background and stream:
+    raise HTTPException(detail='Use either background or stream, not both', status_code=status.HTTP_400_BAD_REQUEST)
+  if stream:
+    return await stream_webhook(req, schema, body)
+  if not background:
+    return await do_webhook(schema, body)
+
+  # fail fast on unknown schemas, rather than in the job
+  get_schema(schema)
+  job = await jobs.submit(schema, body)
+  status_url = f'{req.base_url}webhook/jobs/{job.id}'
+  return JSONResponse(status_code=status.HTTP_202_ACCEPTED,
+                      content={'job_id': job.id, 'status': job.status, 'status_url': status_url},
+                      headers={'Location': status_url})
+
 # Accept query params /webhook?schema=<schema_name>
+# Add background=true to get a 202 and job id back immediately
+# or stream=true to get the OpenAI result as it arrives
 @router.post("/webhook", tags=["Webhooks"])
-async def webhook(schema:str, body:str=Body(...)):
-  return await do_webhook(schema, body)
+async def webhook(req:Request, schema:str, body:str=Body(...), background:bool=False, stream:bool=False):
+  return await dispatch_webhook(req, schema, body, background, stream)
    
 # Accept path parm /webhook/<schema>
 @router.post("/webhook/{schema}", tags=["Webhooks"])
-async def webhook_alt(schema:str, body:str=Body(...)):
-  return await do_webhook(schema, body)
+async def webhook_alt(req:Request, schema:str, body:str=Body(...), background:bool=False, stream:bool=False):
+  return await dispatch_webhook(req, schema, body, background, stream)
+
+@router.get("/webhook/jobs/{job_id}", response_model=WebhookJob, tags=["Webhooks"])
+async def webhook_job(job_id:str):
+  '''
+  Status (and result, once done) of a background webhook job
+  '''
+  job = jobs.get(job_id)
+  if job is None:
+    raise HTTPException(detail=f'Job {job_id} not found', status_code=status.HTTP_404_NOT_FOUND)
+  return job
+
+@router.get("/webhook/metrics", response_model=Dict[str, SchemaMetrics], tags=["Webhooks"])
+async def webhook_metrics():
+  '''
+  Per schema throughput and latency of background webhook jobs since startup
+  '''
+  return jobs.metrics()
+
+@router.get("/webhook/cache", response_model=CacheStats, tags=["Webhooks"])
+async def webhook_cache():
+  '''
+  Size and hit rate of the OpenAI completion cache used by webhooks
+  '''
+  return completion_cache.stats()
+
+@router.delete("/webhook/cache", response_model=CacheStats, tags=["Webhooks"])
+async def clear_webhook_cache():
+  '''
+  Empty the OpenAI completion cache, so repeated webhook payloads go to OpenAI again
+  '''
+  completion_cache.clear()
+  return completion_cache.stats()
 
- 
 # Accept path parm /webhook/<schema>
 @router.get("/webhooks", tags=["Webhooks"])
 async def webhook_configuration():
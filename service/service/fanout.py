@@ -0,0 +1,40 @@
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Iterator, TypeVar
+
+# Running a slow, I/O bound step (LLM and vector store round trips) over
+# several items side by side, as /llamaindex/research does per research
+# question. Kept apart from service/llamaindex.py so it can be used, and
+# tested, without importing llama_index.
+
+Item = TypeVar('Item')
+Result = TypeVar('Result')
+
+
+class RateLimiter:
+  '''Spaces out calls from many threads to at most rate per second.'''
+  def __init__(self, rate:float):
+    self.interval = 1.0 / rate
+    self.next_call = 0.0
+    self.lock = threading.Lock()
+
+  def wait(self):
+    with self.lock:
+      now = time.monotonic()
+      start = max(now, self.next_call)
+      self.next_call = start + self.interval
+    if start > now:
+      time.sleep(start - now)
+
+
+def ordered_map(step:Callable[[Item], Result], items:Iterable[Item], workers:int) -> Iterator[Result]:
+  '''step(item) for each item, up to workers at a time in threads.
+  Yields the results in the order of items, each as soon as it and those
+  before it are done. Each step runs in a copy of the caller's context, so
+  it keeps the request's txid and current span.'''
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    futures = [pool.submit(contextvars.copy_context().run, step, item) for item in items]
+    for future in futures:
+      yield future.result()
@@ -0,0 +1,170 @@
+import hashlib
+import numpy as np
+from collections import OrderedDict
+from logging import getLogger
+from threading import Lock, RLock
+from typing import Any, Callable, Hashable, Set
+
+from fastapi import Request
+from fastapi.exceptions import RequestValidationError
+from pydantic import ValidationError
+
+from service.graphops import EdgeArrays, dedupe_edges, encode_pairs
+from service.tana_types import TanaDump, Visualizer
+from service.tanaparser import (IS_CHILD_CONTENT_LINK, IS_CHILD_REF_LINK, IS_FIELD_CONTENT_LINK,
+                                IS_INDIRECT_REF_LINK, IS_INLINE_REF_LINK, IS_TAG_LINK,
+                                IS_TAG_SCHEMA_LINK, IS_TAG_TAG_LINK, NodeIndex)
+
+logger = getLogger()
+
+# Shared graph pipeline for the Visualizer endpoints.
+#
+# /graph, /graph/analytics, /class_diagram and /mermaid_classes all go
+# through the same stages: parse the dump, index it, build the linkage pairs,
+# then dedupe them. Parsing a big dump is by far the slowest part, and it's
+# common to POST the same dump several times (class diagram then mermaid,
+# or the Visualizer with different configs). So each stage is memoized:
+#
+#   parse    keyed by a hash of the request body
+#   index    one NodeIndex per dump, built with every linkage type turned
+#            on (except content, which is an optional second pass). The
+#            Visualizer config only decides which linkages we keep, so one
+#            index serves every config
+#   links    deduped EdgeArrays per (dump, Visualizer config), selected from
+#            the full set by linkage reason
+#
+# Endpoints can memoize their own results on the dump too, see DumpEntry.memo.
+#
+# The endpoints run all of this in the process pool (service/processpool.py),
+# keyed by the dump, so a dump POSTed again lands in the process that has it
+# cached.
+
+# how many parsed dumps to keep around. They're big, so not many
+DUMP_CACHE_SIZE = 2
+
+# every linkage except content, which is added lazily when a config asks
+PIPELINE_CONFIG = Visualizer(include_tag_tag_links=True,
+                             include_node_tag_links=True,
+                             include_inline_refs=True,
+                             include_inline_ref_nodes=True,
+                             include_content_nodes=False,
+                             include_tag_schema_links=True)
+
+# the pipeline endpoints read the raw body themselves, so describe it for the docs
+TANA_DUMP_BODY = {
+  'requestBody': {
+    'required': True,
+    'content': {'application/json': {'schema': {'$ref': '#/components/schemas/TanaDump'}}},
+  }
+}
+
+
+class DumpEntry:
+  '''A parsed dump and everything we have worked out from it so far.'''
+
+  def __init__(self, key:str, tana_dump:TanaDump):
+    self.key = key
+    self.tana_dump = tana_dump
+    self.results = {}
+    # stages may run in the threadpool, and call each other
+    self.lock = RLock()
+
+  def memo(self, key:Hashable, compute:Callable[[], Any]) -> Any:
+    '''Result of compute(), computed at most once for this dump.'''
+    with self.lock:
+      if key not in self.results:
+        self.results[key] = compute()
+      return self.results[key]
+
+
+dump_cache:OrderedDict[str, DumpEntry] = OrderedDict()
+dump_cache_lock = Lock()
+
+
+def parse_dump(body:bytes) -> DumpEntry:
+  '''Parse stage. Returns the cached entry if we've seen this body before.'''
+  key = hashlib.sha1(body).hexdigest()
+  with dump_cache_lock:
+    if key in dump_cache:
+      dump_cache.move_to_end(key)
+      return dump_cache[key]
+
+  entry = DumpEntry(key, TanaDump.model_validate_json(body))
+
+  with dump_cache_lock:
+    # someone else may have parsed it meanwhile. Keep theirs
+    entry = dump_cache.setdefault(key, entry)
+    dump_cache.move_to_end(key)
+    while len(dump_cache) > DUMP_CACHE_SIZE:
+      dump_cache.popitem(last=False)
+  return entry
+
+
+def load_dump(body:bytes) -> DumpEntry:
+  '''parse_dump, with a bad dump reported as a bad request.'''
+  try:
+    return parse_dump(body)
+  except ValidationError as e:
+    raise RequestValidationError(e.errors(include_url=False))
+
+
+async def dump_body(request:Request) -> bytes:
+  '''FastAPI dependency: the Tana dump in the request body, unparsed. For
+  endpoints that parse it in the process pool, see service/processpool.py'''
+  return await request.body()
+
+
+def node_index(entry:DumpEntry) -> NodeIndex:
+  '''Index stage. The NodeIndex (and master pairs) for a dump.'''
+  def compute():
+    index = NodeIndex(tana_dump=entry.tana_dump, config=PIPELINE_CONFIG)
+    # build our primary indices first, so we can easily navigate the dump
+    index.build_indices()
+    # OK, now that we have the basic dump indexed...
+    # build a collection of meaningful linkages
+    index.build_master_pairs()
+    return index
+  return entry.memo('index', compute)
+
+
+def included_reasons(config:Visualizer) -> Set[str]:
+  '''The linkage reasons NodeIndex would produce for this config.'''
+  reasons = set()
+  if config.include_tag_tag_links:
+    reasons.add(IS_TAG_TAG_LINK)
+  if config.include_tag_schema_links:
+    reasons.add(IS_TAG_SCHEMA_LINK)
+  if config.include_node_tag_links:
+    reasons.add(IS_TAG_LINK)
+  if config.include_inline_refs:
+    reasons.add(IS_INDIRECT_REF_LINK)
+    if config.include_inline_ref_nodes:
+      reasons.add(IS_INLINE_REF_LINK)
+  if config.include_content_nodes:
+    reasons.update((IS_FIELD_CONTENT_LINK, IS_CHILD_REF_LINK, IS_CHILD_CONTENT_LINK))
+  return reasons
+
+
+def all_links(entry:DumpEntry, with_content:bool=False) -> EdgeArrays:
+  '''Every deduped link in the dump, optionally including content links.'''
+  with entry.lock:
+    index = node_index(entry)
+    if with_content:
+      entry.memo('content', index.build_content_pairs)
+    # master_pairs only ever grows (with content), so its length
+    # tells us which set of pairs we have deduped
+    return entry.memo(('all_links', len(index.master_pairs)),
+                      lambda: dedupe_edges(encode_pairs(index.master_pairs, index.index)))
+
+
+def links(entry:DumpEntry, config:Visualizer) -> EdgeArrays:
+  '''Links stage. The deduped links for a Visualizer config.
+
+  Deduping treats each reason separately, so selecting by reason after
+  deduping gives the same links as deduping just the selected pairs.
+  '''
+  def compute():
+    edges = all_links(entry, config.include_content_nodes)
+    codes = [edges.reason_code(reason) for reason in included_reasons(config)]
+    return edges.subset(np.isin(edges.reason, codes))
+  return entry.memo(('links', config), compute)
@@ -0,0 +1,136 @@
+import numpy as np
+from logging import getLogger
+from pydantic import BaseModel
+from typing import Dict, List, Optional
+
+from service.graphops import EdgeArrays, connected_components, cooccurrence, degrees, pagerank
+from service.tanaparser import IS_TAG_LINK, NodeIndex, patch_node_name
+
+logger = getLogger()
+
+# Whole-graph statistics over the deduplicated links built by NodeIndex,
+# all computed with array operations over EdgeArrays so they stay
+# fast on workspaces with millions of links.
+
+class RankedNode(BaseModel):
+  id: str
+  name: Optional[str]
+  degree: int = 0
+  score: Optional[float] = None
+
+class DegreeStats(BaseModel):
+  min: int = 0
+  max: int = 0
+  mean: float = 0.0
+  median: float = 0.0
+  # degree -> number of linked nodes with that degree
+  histogram: Dict[int, int] = {}
+
+class GraphComponent(BaseModel):
+  size: int
+  links: int
+  # best connected node in the component
+  hub: RankedNode
+
+class TagCount(BaseModel):
+  id: str
+  name: Optional[str]
+  count: int
+
+class TagPair(BaseModel):
+  source: str
+  target: str
+  source_name: Optional[str]
+  target_name: Optional[str]
+  count: int
+
+class GraphAnalytics(BaseModel):
+  node_count: int = 0
+  link_count: int = 0
+  degrees: DegreeStats = DegreeStats()
+  component_count: int = 0
+  components: List[GraphComponent] = []
+  hubs: List[RankedNode] = []
+  pagerank: List[RankedNode] = []
+  tags: List[TagCount] = []
+  tag_cooccurrence: List[TagPair] = []
+  orphan_count: int = 0
+  orphans: List[RankedNode] = []
+
+
+def _top(values:np.ndarray, candidates:np.ndarray, limit:int) -> np.ndarray:
+  '''Codes of the highest valued candidates, best first.'''
+  if limit <= 0 or len(candidates) == 0:
+    return candidates[:0]
+  if len(candidates) > limit:
+    candidates = candidates[np.argpartition(-values[candidates], limit - 1)[:limit]]
+  return candidates[np.argsort(-values[candidates], kind='stable')]
+
+
+def _orphan_candidate(node_id:str, index:NodeIndex) -> bool:
+  # plain, named nodes. Not tuples, metanodes, system nodes and so on
+  node = index.node(node_id)
+  return 'SYS' not in node_id and node.props.docType is None and bool(node.props.name)
+
+
+def analyze(index:NodeIndex, edges:EdgeArrays, limit:int=25) -> GraphAnalytics:
+  '''Compute degree, component, centrality, tag and orphan statistics.
+  edges must use the index as node table, see encode_pairs().'''
+  node_ids = edges.node_ids
+
+  def ranked(code:int, degree:np.ndarray, score:Optional[float]=None) -> RankedNode:
+    node_id = node_ids[code]
+    return RankedNode(id=node_id, name=patch_node_name(index, node_id), degree=int(degree[code]), score=score)
+
+  analytics = GraphAnalytics()
+  degree = degrees(edges)
+  linked = np.flatnonzero(degree)
+  analytics.node_count = len(linked)
+  analytics.link_count = len(edges)
+  if len(linked):
+    linked_degree = degree[linked]
+    values, counts = np.unique(linked_degree, return_counts=True)
+    analytics.degrees = DegreeStats(min=int(linked_degree.min()), max=int(linked_degree.max()),
+                                    mean=float(linked_degree.mean()), median=float(np.median(linked_degree)),
+                                    histogram=dict(zip(values.tolist(), counts.tolist())))
+
+  # connected components of the linked nodes
+  labels = connected_components(edges)
+  roots, component, sizes = np.unique(labels[linked], return_inverse=True, return_counts=True)
+  analytics.component_count = len(roots)
+  links_per_component = np.bincount(component[np.searchsorted(linked, edges.src)], minlength=len(roots))
+  # best connected node per component: sort by (component, -degree) and take the first
+  order = np.lexsort((-degree[linked], component))
+  firsts = np.flatnonzero(np.r_[True, component[order][1:] != component[order][:-1]])
+  component_hubs = linked[order[firsts]]
+  for c in _top(sizes, np.arange(len(roots)), limit).tolist():
+    analytics.components.append(GraphComponent(size=int(sizes[c]), links=int(links_per_component[c]),
+                                               hub=ranked(int(component_hubs[c]), degree)))
+
+  analytics.hubs = [ranked(code, degree) for code in _top(degree, linked, limit).tolist()]
+  scores = pagerank(edges)
+  analytics.pagerank = [ranked(code, degree, float(scores[code])) for code in _top(scores, linked, limit).tolist()]
+
+  # tag usage and co-occurrence, from the node -> tag links
+  tag_link = edges.reason_code(IS_TAG_LINK)
+  if tag_link >= 0:
+    tagged = edges.reason == tag_link
+    owners, tags = edges.src[tagged], edges.dst[tagged]
+    usage = np.bincount(tags, minlength=len(node_ids))
+    for code in _top(usage, np.flatnonzero(usage), limit).tolist():
+      analytics.tags.append(TagCount(id=node_ids[code], name=index.node(node_ids[code]).props.name, count=int(usage[code])))
+    first, second, counts = cooccurrence(owners, tags)
+    for i in _top(counts, np.arange(len(counts)), limit).tolist():
+      source, target = node_ids[first[i]], node_ids[second[i]]
+      analytics.tag_cooccurrence.append(TagPair(source=source, target=target,
+                                                source_name=index.node(source).props.name,
+                                                target_name=index.node(target).props.name,
+                                                count=int(counts[i])))
+
+  # orphans: ordinary nodes that nothing links to or from
+  unlinked = np.flatnonzero(degree == 0)
+  orphans = [code for code in unlinked.tolist() if _orphan_candidate(node_ids[code], index)]
+  analytics.orphan_count = len(orphans)
+  analytics.orphans = [ranked(code, degree) for code in orphans[:limit]]
+
+  return analytics
@@ -0,0 +1,119 @@
+import gzip
+import json
+import struct
+import numpy as np
+from logging import getLogger
+from typing import List, Optional, Tuple
+
+logger = getLogger()
+
+# brotli is optional. If it's installed, we prefer it over gzip
+try:
+  import brotli # type: ignore
+except ImportError:
+  brotli = None
+
+# Compact binary encoding of a graph for the Visualizer webapp.
+#
+# JSON graphs repeat the string node ids in every link and pay for a pydantic
+# object per node and link. This format sends each string once, in a string
+# table, and the links as integer indices into that table using typed arrays.
+#
+# Layout (all little-endian):
+#
+#   magic     4 bytes   b'TGRF'
+#   version   uint32
+#   length    uint32    length of the JSON header in bytes (padded to 4)
+#   header    JSON      directed, multigraph, node_count, link_count,
+#                       string tables (ids, names, colors, reasons) and
+#                       an 'arrays' list of {name, type, length} entries
+#   arrays    bytes     each typed array in 'arrays' order, every one
+#                       starting on a 4 byte boundary
+#
+# Standard arrays are 'source' and 'target' (uint32 node indices) and
+# 'reason' (uint8 index into the reasons table). Decoders should find arrays
+# by name and ignore any they don't know, so we can add more later.
+#
+# See webapp/src/components/graphcodec.tsx for the matching decoder.
+
+GRAPH_MEDIA_TYPE = 'application/vnd.tana-helper.graph'
+GRAPH_MAGIC = b'TGRF'
+GRAPH_VERSION = 1
+
+ARRAY_TYPES = {
+  'uint8': np.dtype('<u1'),
+  'uint32': np.dtype('<u4'),
+  'float32': np.dtype('<f4'),
+}
+
+def wants_binary_graph(accept:Optional[str]) -> bool:
+  '''Does the Accept header ask for the binary graph format?'''
+  return accept is not None and GRAPH_MEDIA_TYPE in accept
+
+
+def _pad(length:int) -> int:
+  return (4 - length % 4) % 4
+
+
+def encode_graph(ids:List[str], names:List[Optional[str]], colors:List[Optional[str]],
+                 reasons:List[str], source:np.ndarray, target:np.ndarray, reason:np.ndarray,
+                 directed=False, multigraph=False, extra_arrays:Optional[dict]=None) -> bytes:
+  '''Encode a graph into the binary format.
+
+  source and target are indices into ids, reason indexes into reasons.
+  extra_arrays maps array name to (type name, ndarray) for optional arrays.
+  '''
+  arrays = [('source', 'uint32', source), ('target', 'uint32', target), ('reason', 'uint8', reason)]
+  if extra_arrays:
+    arrays += [(name, type_name, values) for name, (type_name, values) in extra_arrays.items()]
+
+  header = {
+    'directed': directed,
+    'multigraph': multigraph,
+    'node_count': len(ids),
+    'link_count': len(source),
+    'ids': ids,
+    'names': names,
+    'colors': colors,
+    'reasons': reasons,
+    'arrays': [{'name': name, 'type': type_name, 'length': len(values)} for name, type_name, values in arrays],
+  }
+  header_bytes = json.dumps(header, separators=(',', ':')).encode('utf-8')
+  header_bytes += b' ' * _pad(len(header_bytes))
+
+  chunks = [GRAPH_MAGIC, struct.pack('<II', GRAPH_VERSION, len(header_bytes)), header_bytes]
+  for _, type_name, values in arrays:
+    data = np.ascontiguousarray(values, dtype=ARRAY_TYPES[type_name]).tobytes()
+    chunks.append(data)
+    chunks.append(b'\0' * _pad(len(data)))
+  return b''.join(chunks)
+
+
+def compress(payload:bytes, accept_encoding:Optional[str]) -> Tuple[bytes, Optional[str]]:
+  '''Compress payload with the best encoding the client accepts.
+  Returns the (possibly) compressed payload and the Content-Encoding to use.'''
+  accepted = [part.split(';')[0].strip() for part in (accept_encoding or '').split(',')]
+  if brotli is not None and 'br' in accepted:
+    return brotli.compress(payload, quality=5), 'br'
+  if 'gzip' in accepted:
+    # favor speed over ratio, the payload is mostly integer arrays anyway
+    return gzip.compress(payload, compresslevel=5), 'gzip'
+  return payload, None
+
+
+def decode_graph(payload:bytes) -> Tuple[dict, dict]:
+  '''Decode the binary format (uncompressed) into the JSON header and
+  a dict of NumPy arrays by name. Mostly useful for tests and tools.'''
+  if payload[0:4] != GRAPH_MAGIC:
+    raise ValueError('Not a binary graph payload')
+  _, header_length = struct.unpack_from('<II', payload, 4)
+  offset = 12
+  header = json.loads(payload[offset:offset + header_length])
+  offset += header_length
+  arrays = {}
+  for spec in header['arrays']:
+    dtype = ARRAY_TYPES[spec['type']]
+    arrays[spec['name']] = np.frombuffer(payload, dtype=dtype, count=spec['length'], offset=offset)
+    size = spec['length'] * dtype.itemsize
+    offset += size + _pad(size)
+  return header, arrays
@@ -0,0 +1,297 @@
+import hashlib
+import os
+import numpy as np
+from collections import OrderedDict
+from logging import getLogger
+from threading import Lock
+from typing import List, Optional, Tuple
+
+from service.settings import settings
+
+logger = getLogger()
+
+# Server side force directed layout for the Visualizer.
+#
+# The browser's force simulation takes tens of seconds to settle on a big
+# workspace graph, every time it's loaded. Instead we can run a vectorized
+# Fruchterman-Reingold style layout here, once, and cache the coordinates.
+#
+# Repulsion uses a Barnes-Hut style approximation: nodes are binned into a
+# uniform grid every iteration and each node is repelled by the mass centroid
+# of every other cell rather than by every other node. For the node's own
+# cell we use the centroid of the other nodes in that cell. This makes an
+# iteration roughly O(n * cells) instead of O(n^2).
+#
+# Layouts are cached per workspace, the last few for each, since filtered
+# views of one workspace are different graphs. An unchanged graph gets the
+# cached coordinates back. A changed graph is warm started from the cached
+# layout it shares most nodes with, so nodes that were there before stay
+# (roughly) where they were and the layout only needs a fraction of the
+# iterations to settle.
+#
+# Layouts run in the process pool, within its task timeout. Big graphs get
+# fewer iterations to stay within LAYOUT_WORK_BUDGET, and graphs too big for
+# even MIN_ITERATIONS get no layout, leaving it to the browser.
+
+# ideal link length, in the same units 3d-force-graph uses
+LINK_LENGTH = 30.0
+
+# grid cells per axis are capped so memory stays bounded on big graphs
+MAX_CELLS = {2: 32, 3: 10}
+
+# nodes per chunk when computing far field repulsion
+CHUNK_SIZE = 2048
+
+# most work for one layout, as nodes x grid cells summed over the iterations.
+# Roughly 20s on a laptop, well inside processpool.TASK_TIMEOUT.
+# See benchmarks/bench_layout.py
+LAYOUT_WORK_BUDGET = 400_000_000
+
+# fewer iterations than this don't settle into a useful layout
+MIN_ITERATIONS = 20
+
+
+def _grid_size(n:int, dim:int) -> int:
+  # aim for about sqrt(n) cells in total
+  per_axis = int(round(n ** (0.5 / dim)))
+  return max(1, min(per_axis, MAX_CELLS[dim]))
+
+
+def affordable_iterations(n:int, dim:int, iterations:int) -> int:
+  '''How many of the iterations of force_layout fit the work budget for
+  n nodes. 0 if too few to be worth doing.'''
+  per_iteration = max(n * _grid_size(n, dim) ** dim, 1)
+  affordable = min(iterations, LAYOUT_WORK_BUDGET // per_iteration)
+  return affordable if affordable >= MIN_ITERATIONS else 0
+
+
+def _repulsion(pos:np.ndarray, k2:float) -> np.ndarray:
+  '''Approximate repulsive displacement k^2 / d for every node.'''
+  n, dim = pos.shape
+  grid = _grid_size(n, dim)
+  lo = pos.min(axis=0)
+  span = np.maximum(pos.max(axis=0) - lo, 1e-6)
+  cell_xyz = np.minimum(((pos - lo) / span * grid).astype(np.int64), grid - 1)
+  cell = np.ravel_multi_index(tuple(cell_xyz.T), (grid,) * dim)
+
+  # only keep occupied cells
+  occupied, cell = np.unique(cell, return_inverse=True)
+  cells = len(occupied)
+  mass = np.bincount(cell, minlength=cells).astype(pos.dtype)
+  centroid = np.stack([np.bincount(cell, weights=pos[:, d], minlength=cells) for d in range(dim)], axis=1) / mass[:, None]
+  centroid = centroid.astype(pos.dtype)
+
+  eps = np.asarray(1e-2, dtype=pos.dtype)
+  disp = np.zeros_like(pos)
+  for start in range(0, n, CHUNK_SIZE):
+    stop = min(start + CHUNK_SIZE, n)
+    delta = pos[start:stop, None, :] - centroid[None, :, :]
+    dist2 = (delta * delta).sum(axis=2) + eps
+    weight = mass[None, :] / dist2
+    # own cell is handled separately below
+    weight[np.arange(stop - start), cell[start:stop]] = 0
+    disp[start:stop] = (delta * weight[:, :, None]).sum(axis=1)
+
+  # own cell: centroid of the other nodes in the same cell
+  own_mass = mass[cell] - 1
+  has_others = own_mass > 0
+  others = (centroid[cell] * mass[cell][:, None] - pos)
+  others[has_others] /= own_mass[has_others][:, None]
+  delta = pos - others
+  dist2 = (delta * delta).sum(axis=1) + eps
+  own = np.where(has_others, own_mass / dist2, 0)
+  disp += delta * own[:, None]
+
+  return disp * k2
+
+
+def force_layout(src:np.ndarray, dst:np.ndarray, n:int, dim:int=3,
+                 iterations:int=120, initial:Optional[np.ndarray]=None,
+                 temperature:Optional[float]=None, seed:int=0) -> np.ndarray:
+  '''Lay out n nodes linked by the (src, dst) edge arrays.
+
+  Returns an (n, dim) float32 array of coordinates centered on the origin.
+  If initial positions are given they are used as the starting point,
+  and a lower starting temperature is appropriate.
+  '''
+  if n == 0:
+    return np.zeros((0, dim), dtype=np.float32)
+
+  k = LINK_LENGTH
+  side = k * max(n, 1) ** (1.0 / dim)
+  if initial is None:
+    rng = np.random.default_rng(seed)
+    pos = rng.uniform(-side / 2, side / 2, (n, dim)).astype(np.float32)
+  else:
+    pos = initial.astype(np.float32, copy=True)
+  if temperature is None:
+    temperature = side / 10
+
+  src = np.asarray(src, dtype=np.int64)
+  dst = np.asarray(dst, dtype=np.int64)
+  # a gentle pull towards the center keeps disconnected components around
+  gravity = 1.0 / side
+
+  for step in range(iterations):
+    disp = _repulsion(pos, k * k)
+
+    # attraction d^2 / k along every link
+    delta = pos[src] - pos[dst]
+    dist = np.sqrt((delta * delta).sum(axis=1)) + 1e-6
+    pull = delta * (dist / k)[:, None]
+    for d in range(dim):
+      disp[:, d] -= np.bincount(src, weights=pull[:, d], minlength=n)
+      disp[:, d] += np.bincount(dst, weights=pull[:, d], minlength=n)
+
+    disp -= pos * (gravity * k)
+
+    # move, but never further than the current temperature
+    length = np.sqrt((disp * disp).sum(axis=1)) + 1e-6
+    t = temperature * (1.0 - step / iterations)
+    pos += disp * (np.minimum(length, t) / length)[:, None]
+
+  pos -= pos.mean(axis=0)
+  return pos.astype(np.float32)
+
+
+def _warm_start(node_ids:List[str], src:np.ndarray, dst:np.ndarray, dim:int,
+                previous_ids:List[str], previous:np.ndarray, seed:int=0) -> Tuple[np.ndarray, float]:
+  '''Initial positions from a previous layout. Returns positions and the
+  fraction of nodes that were already placed.'''
+  n = len(node_ids)
+  lookup = {node_id: code for code, node_id in enumerate(previous_ids)}
+  old = np.fromiter((lookup.get(node_id, -1) for node_id in node_ids), dtype=np.int64, count=n)
+  known = old >= 0
+  rng = np.random.default_rng(seed)
+  side = LINK_LENGTH * max(n, 1) ** (1.0 / dim)
+  pos = rng.uniform(-side / 2, side / 2, (n, dim)).astype(np.float32)
+  pos[known] = previous[old[known]]
+
+  # new nodes start near the mean of their already placed neighbors
+  placed_src = known[src] & ~known[dst]
+  placed_dst = known[dst] & ~known[src]
+  count = np.bincount(dst[placed_src], minlength=n) + np.bincount(src[placed_dst], minlength=n)
+  near = count > 0
+  if near.any():
+    for d in range(dim):
+      total = np.bincount(dst[placed_src], weights=pos[src[placed_src], d], minlength=n) \
+        + np.bincount(src[placed_dst], weights=pos[dst[placed_dst], d], minlength=n)
+      pos[near, d] = total[near] / count[near]
+    pos[near] += rng.normal(0, LINK_LENGTH / 3, (int(near.sum()), dim)).astype(np.float32)
+
+  return pos, float(known.mean())
+
+
+def graph_hash(node_ids:List[str], src:np.ndarray, dst:np.ndarray, dim:int) -> str:
+  '''Identity of a graph's structure, for layout caching.'''
+  digest = hashlib.sha1()
+  digest.update(str(dim).encode())
+  digest.update('\0'.join(node_ids).encode('utf-8'))
+  digest.update(np.ascontiguousarray(src, dtype=np.int64).tobytes())
+  digest.update(np.ascontiguousarray(dst, dtype=np.int64).tobytes())
+  return digest.hexdigest()
+
+
+# layouts kept for each workspace (and dimensions)
+LAYOUTS_PER_WORKSPACE = 4
+
+LayoutEntry = Tuple[str, List[str], np.ndarray]
+
+class LayoutCache:
+  '''Most recent layouts per (workspace, dimensions), newest first, kept in
+  memory with a copy on disk under settings.temp_files so they survive restarts.'''
+
+  def __init__(self, max_entries:int=8, per_workspace:int=LAYOUTS_PER_WORKSPACE):
+    self.max_entries = max_entries
+    self.per_workspace = per_workspace
+    self.entries = OrderedDict()
+    self.lock = Lock()
+
+  def _path(self, key:str) -> str:
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(settings.temp_files, 'graph_layouts', f'{name}.npz')
+
+  def get(self, key:str) -> List[LayoutEntry]:
+    with self.lock:
+      if key in self.entries:
+        self.entries.move_to_end(key)
+        return self.entries[key]
+    path = self._path(key)
+    if not os.path.exists(path):
+      return []
+    try:
+      with np.load(path, allow_pickle=False) as saved:
+        layouts = [(str(saved[f'hash{i}']), saved[f'node_ids{i}'].tolist(), saved[f'positions{i}'])
+                   for i in range(int(saved['count']))]
+    except Exception as e:
+      logger.warning(f'Ignoring unreadable layout cache {path}: {e}')
+      return []
+    self._remember(key, layouts)
+    return layouts
+
+  def put(self, key:str, entry:LayoutEntry):
+    graph_id = entry[0]
+    layouts = [entry] + [layout for layout in self.get(key) if layout[0] != graph_id]
+    layouts = layouts[:self.per_workspace]
+    self._remember(key, layouts)
+    path = self._path(key)
+    try:
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      arrays = {'count': np.array(len(layouts))}
+      for i, (graph_id, node_ids, positions) in enumerate(layouts):
+        arrays[f'hash{i}'] = np.array(graph_id)
+        arrays[f'node_ids{i}'] = np.array(node_ids, dtype=str)
+        arrays[f'positions{i}'] = positions
+      np.savez(path, **arrays)
+    except Exception as e:
+      logger.warning(f'Unable to save layout cache {path}: {e}')
+
+  def _remember(self, key:str, layouts:List[LayoutEntry]):
+    with self.lock:
+      self.entries[key] = layouts
+      self.entries.move_to_end(key)
+      while len(self.entries) > self.max_entries:
+        self.entries.popitem(last=False)
+
+
+layout_cache = LayoutCache()
+
+
+def cached_layout(workspace:str, node_ids:List[str], src:np.ndarray, dst:np.ndarray,
+                  dim:int=3, iterations:int=120) -> Optional[np.ndarray]:
+  '''Layout for the graph, reusing or warm starting from a cached
+  layout for this workspace. src and dst index into node_ids.
+  None if the graph is too big to lay out in time.'''
+  key = f'{workspace}:{dim}'
+  graph_id = graph_hash(node_ids, src, dst, dim)
+  layouts = layout_cache.get(key)
+  for cached in layouts:
+    if cached[0] == graph_id:
+      logger.info(f'Reusing cached {dim}D layout for {len(node_ids)} nodes')
+      return cached[2]
+
+  n = len(node_ids)
+  affordable = affordable_iterations(n, dim, iterations)
+  if affordable == 0:
+    logger.info(f'Too many nodes ({n}) for a {dim}D layout in time, leaving it to the client')
+    return None
+  if affordable < iterations:
+    logger.info(f'Cutting {dim}D layout for {n} nodes to {affordable} iterations')
+    iterations = affordable
+
+  if layouts:
+    # from the layout with most of this graph's nodes already placed
+    wanted = set(node_ids)
+    cached = max(layouts, key=lambda layout: len(wanted.intersection(layout[1])))
+    initial, reused = _warm_start(node_ids, src, dst, dim, cached[1], cached[2])
+    # the more of the graph we already had, the less work to do
+    warm_iterations = max(int(iterations * (1.0 - reused)), iterations // 5)
+    logger.info(f'Warm starting {dim}D layout for {n} nodes ({reused:.0%} placed), {warm_iterations} iterations')
+    positions = force_layout(src, dst, n, dim, warm_iterations, initial=initial,
+                             temperature=LINK_LENGTH * 2)
+  else:
+    logger.info(f'Computing {dim}D layout for {n} nodes')
+    positions = force_layout(src, dst, n, dim, iterations)
+
+  layout_cache.put(key, (graph_id, node_ids, positions))
+  return positions
@@ -0,0 +1,269 @@
+import numpy as np
+from itertools import chain, repeat
+from operator import itemgetter
+from logging import getLogger
+from typing import Iterable, List, Optional, Tuple
+
+logger = getLogger()
+
+# Array based graph operations over the linkage tuples built by NodeIndex.
+#
+# NodeIndex produces master_pairs as a list of (source_id, target_id, reason)
+# string tuples. That's convenient to build, but slow to post-process at scale
+# since every set / membership operation works on Python objects.
+# Here we integer-encode the pairs once into parallel NumPy arrays and do
+# the heavy lifting (dedupe, canonicalization) with vectorized sort / unique.
+
+class EdgeArrays:
+  '''Integer encoded edge list.
+
+  node_ids[i] is the Tana node id for node code i, reasons[r] is the
+  linkage reason string for reason code r. src, dst and reason are parallel
+  arrays with one entry per edge.
+  '''
+  def __init__(self, node_ids:List[str], reasons:List[str], src:np.ndarray, dst:np.ndarray, reason:np.ndarray):
+    self.node_ids = node_ids
+    self.reasons = reasons
+    self.src = src
+    self.dst = dst
+    self.reason = reason
+
+  def __len__(self):
+    return len(self.src)
+
+  def subset(self, selector) -> 'EdgeArrays':
+    '''Return a new EdgeArrays with only the selected edges (mask or indices).
+    The node and reason tables are shared, not copied.'''
+    return EdgeArrays(self.node_ids, self.reasons, self.src[selector], self.dst[selector], self.reason[selector])
+
+  def reason_code(self, reason:str) -> int:
+    '''Code for the given reason, or -1 if no edge has that reason.'''
+    try:
+      return self.reasons.index(reason)
+    except ValueError:
+      return -1
+
+  def linked_nodes(self) -> np.ndarray:
+    '''Sorted codes of all nodes that appear at either end of an edge.'''
+    return np.unique(np.concatenate((self.src, self.dst)))
+
+  def pairs(self) -> List[Tuple[str, str, str]]:
+    '''Decode back into (source_id, target_id, reason) tuples.'''
+    node_ids = self.node_ids
+    reasons = self.reasons
+    return [(node_ids[s], node_ids[t], reasons[r])
+            for (s, t, r) in zip(self.src.tolist(), self.dst.tolist(), self.reason.tolist())]
+
+
+def encode_pairs(pairs:List[Tuple[str, str, str]], node_ids:Optional[Iterable[str]]=None) -> EdgeArrays:
+  '''Integer encode a list of (source_id, target_id, reason) tuples.
+
+  If node_ids is given (e.g. the keys of NodeIndex.index) it is used as the
+  node table and any pair with an endpoint not in it is dropped. This is the
+  vectorized equivalent of the index.valid() check done by add_linkage.
+  Otherwise, the node table is built from the pairs themselves.
+  '''
+  count = len(pairs)
+  if count == 0:
+    empty = np.zeros(0, dtype=np.int64)
+    return EdgeArrays(list(node_ids) if node_ids is not None else [], [], empty, empty, np.zeros(0, dtype=np.uint8))
+
+  # keep the per-edge work in C: dict lookups driven by map() over each
+  # column. (zip(*pairs) is much slower since it creates millions of tuples)
+  def sources(): return map(itemgetter(0), pairs)
+  def targets(): return map(itemgetter(1), pairs)
+  def reason_names(): return map(itemgetter(2), pairs)
+
+  if node_ids is not None:
+    table = list(node_ids)
+    lookup = {node_id: code for code, node_id in enumerate(table)}
+    # unknown ids map to -1 and get filtered below
+    src = np.fromiter(map(lookup.get, sources(), repeat(-1)), dtype=np.int64, count=count)
+    dst = np.fromiter(map(lookup.get, targets(), repeat(-1)), dtype=np.int64, count=count)
+  else:
+    # first-seen order, so codes are stable for a given input
+    table = list(dict.fromkeys(chain(sources(), targets())))
+    lookup = {node_id: code for code, node_id in enumerate(table)}
+    src = np.fromiter(map(lookup.__getitem__, sources()), dtype=np.int64, count=count)
+    dst = np.fromiter(map(lookup.__getitem__, targets()), dtype=np.int64, count=count)
+
+  # there are only a handful of distinct reasons
+  reasons = list(dict.fromkeys(reason_names()))
+  reason_lookup = {reason: code for code, reason in enumerate(reasons)}
+  reason = np.fromiter(map(reason_lookup.__getitem__, reason_names()), dtype=np.uint8, count=count)
+
+  edges = EdgeArrays(table, reasons, src, dst, reason)
+  if node_ids is not None:
+    valid = (src >= 0) & (dst >= 0)
+    if not valid.all():
+      edges = edges.subset(valid)
+  return edges
+
+
+def canonical_keys(edges:EdgeArrays) -> np.ndarray:
+  '''Pack each edge into a single uint64 key of (min(src, dst), max(src, dst), reason)
+  so that (a, b, r) and (b, a, r) map to the same key.'''
+  lo = np.minimum(edges.src, edges.dst).astype(np.uint64)
+  hi = np.maximum(edges.src, edges.dst).astype(np.uint64)
+  node_bits = max(int(len(edges.node_ids)).bit_length(), 1)
+  reason_bits = max(int(len(edges.reasons)).bit_length(), 1)
+  if 2 * node_bits + reason_bits > 64:
+    raise OverflowError(f'Too many nodes ({len(edges.node_ids)}) to pack edge keys')
+  return (lo << np.uint64(node_bits + reason_bits)) \
+    | (hi << np.uint64(reason_bits)) \
+    | edges.reason.astype(np.uint64)
+
+
+def dedupe_edges(edges:EdgeArrays) -> EdgeArrays:
+  '''Strip edges down to the unique set, also removing redundant
+  bidirectional links, i.e. (b, a, r) when (a, b, r) is present.
+
+  The first occurrence of each undirected (a, b, r) is kept, with its original
+  direction, and edges stay in their original relative order.
+  '''
+  if len(edges) == 0:
+    return edges
+  keys = canonical_keys(edges)
+  _, first = np.unique(keys, return_index=True)
+  first.sort()
+  return edges.subset(first)
+
+
+def unique_undirected_pairs(pairs:List[Tuple[str, str, str]]) -> List[Tuple[str, str, str]]:
+  '''Convenience wrapper for tuple based callers. See dedupe_edges()'''
+  return dedupe_edges(encode_pairs(pairs)).pairs()
+
+
+# Node level operations. These all work in terms of node codes, i.e.
+# positions in edges.node_ids, and treat links as undirected.
+
+def node_mask(edges:EdgeArrays, codes=None) -> np.ndarray:
+  '''Boolean mask over the node table, optionally with the given codes set.'''
+  mask = np.zeros(len(edges.node_ids), dtype=bool)
+  if codes is not None:
+    mask[codes] = True
+  return mask
+
+
+def degrees(edges:EdgeArrays) -> np.ndarray:
+  '''Undirected degree of every node in the node table.'''
+  return np.bincount(np.concatenate((edges.src, edges.dst)), minlength=len(edges.node_ids))
+
+
+def restrict_to(edges:EdgeArrays, mask:np.ndarray) -> EdgeArrays:
+  '''Keep only the edges with both endpoints in the node mask.'''
+  return edges.subset(mask[edges.src] & mask[edges.dst])
+
+
+def neighborhood(edges:EdgeArrays, seeds:np.ndarray, hops:int=1) -> np.ndarray:
+  '''Node mask of everything within the given number of hops of the seed mask.'''
+  reached = seeds.copy()
+  for _ in range(hops):
+    frontier = reached[edges.src] | reached[edges.dst]
+    expanded = reached.copy()
+    expanded[edges.src[frontier]] = True
+    expanded[edges.dst[frontier]] = True
+    if (expanded == reached).all():
+      break
+    reached = expanded
+  return reached
+
+
+def pagerank(edges:EdgeArrays, damping:float=0.85, iterations:int=100, tol:float=1.0e-6) -> np.ndarray:
+  '''PageRank of every node over the undirected link graph, by power iteration.
+  Nodes without links get a rank of zero.'''
+  n = len(edges.node_ids)
+  src = np.concatenate((edges.src, edges.dst))
+  dst = np.concatenate((edges.dst, edges.src))
+  out_degree = np.bincount(src, minlength=n).astype(np.float64)
+  linked = out_degree > 0
+  count = int(linked.sum())
+  if count == 0:
+    return np.zeros(n)
+
+  # every linked node has out links (undirected), so no dangling mass to handle
+  rank = np.where(linked, 1.0 / count, 0.0)
+  for _ in range(iterations):
+    share = np.divide(rank, out_degree, out=np.zeros(n), where=linked)
+    updated = np.bincount(dst, weights=share[src], minlength=n) * damping
+    updated[linked] += (1.0 - damping) / count
+    delta = np.abs(updated - rank).sum()
+    rank = updated
+    if delta < tol:
+      break
+  return rank
+
+
+def top_nodes(scores:np.ndarray, candidates:np.ndarray, limit:int) -> np.ndarray:
+  '''Node mask of the highest scoring candidates, at most limit of them.'''
+  codes = np.flatnonzero(candidates)
+  if len(codes) <= limit:
+    return candidates.copy()
+  if limit <= 0:
+    return np.zeros_like(candidates)
+  best = codes[np.argpartition(-scores[codes], limit - 1)[:limit]]
+  mask = np.zeros_like(candidates)
+  mask[best] = True
+  return mask
+
+
+def collapse_leaves(edges:EdgeArrays) -> Tuple[EdgeArrays, np.ndarray]:
+  '''Drop leaf nodes (a single link) hanging off a non-leaf node.
+
+  Returns the remaining edges and, for every node, how many leaves
+  were collapsed into it.
+  '''
+  n = len(edges.node_ids)
+  degree = degrees(edges)
+  src_leaf = (degree[edges.src] == 1) & (degree[edges.dst] > 1)
+  dst_leaf = (degree[edges.dst] == 1) & (degree[edges.src] > 1)
+  collapsed = np.bincount(edges.dst[src_leaf], minlength=n) \
+    + np.bincount(edges.src[dst_leaf], minlength=n)
+  return edges.subset(~(src_leaf | dst_leaf)), collapsed
+
+
+def connected_components(edges:EdgeArrays) -> np.ndarray:
+  '''Component label for every node in the node table (the smallest node
+  code in its component). Nodes without links are their own component.
+
+  Hooks component roots onto smaller neighboring roots, then flattens the
+  label trees by pointer jumping, until every link is inside one component.
+  '''
+  labels = np.arange(len(edges.node_ids))
+  while True:
+    source_labels = labels[edges.src]
+    target_labels = labels[edges.dst]
+    differ = source_labels != target_labels
+    if not differ.any():
+      return labels
+    lo = np.minimum(source_labels[differ], target_labels[differ])
+    hi = np.maximum(source_labels[differ], target_labels[differ])
+    # labels only ever point to smaller codes, so no cycles
+    np.minimum.at(labels, hi, lo)
+    while True:
+      jumped = labels[labels]
+      if (jumped == labels).all():
+        break
+      labels = jumped
+
+
+def cooccurrence(owners:np.ndarray, items:np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+  '''Count how often each pair of items shares an owner, e.g. two tags on the
+  same node. Returns parallel arrays (item_a, item_b, count) with item_a < item_b.'''
+  if len(owners) == 0:
+    empty = np.zeros(0, dtype=np.int64)
+    return empty, empty, empty
+  # unique (owner, item) pairs, grouped by owner with items in order.
+  # Packed into single integer keys, which is much faster than unique rows
+  span = int(items.max()) + 1
+  keys = np.unique(owners.astype(np.int64) * span + items)
+  owners, items = keys // span, keys % span
+  starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+  sizes = np.diff(np.r_[starts, len(owners)])
+  # pair every entry with each later entry in its group
+  later = np.repeat(starts + sizes, sizes) - np.arange(len(owners)) - 1
+  left = np.repeat(np.arange(len(owners)), later)
+  offsets = np.arange(len(left)) - np.repeat(np.cumsum(later) - later, later)
+  right = left + 1 + offsets
+  pairs, counts = np.unique(items[left] * span + items[right], return_counts=True)
+  return pairs // span, pairs % span, counts
@@ -0,0 +1,81 @@
+import argparse
+import subprocess
+import sys
+from typing import Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+# Startup import profiler.
+#
+# Imports a module in a fresh interpreter with python -X importtime and
+# reports where the time went: per top level package (summing each module's
+# own import time, so nothing is counted twice) and per service module
+# (cumulative, so including whatever that module drags in).
+#
+#   python -m service.importprofile                # profiles service.main
+#   python -m service.importprofile tanahelper --top 30
+
+class ImportCost(BaseModel):
+  name: str
+  # microseconds, as reported by -X importtime
+  self_us: int = 0
+  cumulative_us: int = 0
+
+
+def parse_importtime(output:str) -> List[ImportCost]:
+  '''Parse the stderr of python -X importtime, in import order.'''
+  costs = []
+  for line in output.splitlines():
+    if not line.startswith('import time:') or 'self [us]' in line:
+      continue
+    # import time:       412 |        412 |   encodings.aliases
+    try:
+      self_us, cumulative_us, name = line[len('import time:'):].split('|')
+      costs.append(ImportCost(name=name.strip(), self_us=int(self_us), cumulative_us=int(cumulative_us)))
+    except ValueError:
+      continue
+  return costs
+
+
+def profile_imports(module:str='service.main', python:Optional[str]=None) -> List[ImportCost]:
+  result = subprocess.run([python or sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                          capture_output=True, text=True)
+  costs = parse_importtime(result.stderr)
+  if result.returncode != 0:
+    # still worth seeing how far it got
+    print(result.stderr.strip().splitlines()[-1], file=sys.stderr)
+  return costs
+
+
+def by_package(costs:List[ImportCost]) -> List[Tuple[str, int]]:
+  '''Total import time per top level package, most expensive first.'''
+  totals: Dict[str, int] = {}
+  for cost in costs:
+    package = cost.name.split('.')[0]
+    totals[package] = totals.get(package, 0) + cost.self_us
+  return sorted(totals.items(), key=lambda item: -item[1])
+
+
+def main():
+  parser = argparse.ArgumentParser(description='Report the import cost of a module, per package')
+  parser.add_argument('module', nargs='?', default='service.main')
+  parser.add_argument('--top', type=int, default=20)
+  args = parser.parse_args()
+
+  costs = profile_imports(args.module)
+  total = sum(cost.self_us for cost in costs)
+  print(f'import {args.module}: {total / 1000.0:.0f} ms, {len(costs)} modules\n')
+
+  print('by package')
+  for package, micros in by_package(costs)[:args.top]:
+    print(f'  {package:40s}{micros / 1000.0:9.1f} ms {100.0 * micros / total:5.1f}%')
+
+  print('\nservice modules (including what they import)')
+  service_costs = sorted((cost for cost in costs if cost.name.startswith('service')),
+                         key=lambda cost: -cost.cumulative_us)
+  for cost in service_costs[:args.top]:
+    print(f'  {cost.name:40s}{cost.cumulative_us / 1000.0:9.1f} ms')
+
+
+if __name__ == '__main__':
+  main()
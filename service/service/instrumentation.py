@@ -0,0 +1,253 @@
+import math
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging import getLogger
+from threading import Lock
+from time import perf_counter
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from pydantic import BaseModel
+
+logger = getLogger()
+
+# Request tracing and latency histograms.
+#
+# span(name) times a block of code. Spans nest, via a context variable, so the
+# stages of a request (embedding, vector store write, LLM call, Tana API call)
+# are children of that request's span, including those run in the threadpool.
+# When the request finishes, its duration and the duration of each stage are
+# recorded in in-memory histograms, labelled with the request's route. Spans
+# outside any request (background jobs) are recorded with an empty route.
+#
+# Histograms are HDR style: log-linear buckets with a fixed relative error, so
+# recording is a dict increment and percentiles are accurate at any scale.
+# They're served in Prometheus text format at /metrics.
+
+REQUEST_SECONDS = 'tana_helper_request_seconds'
+STAGE_SECONDS = 'tana_helper_stage_seconds'
+
+HELP = {
+  REQUEST_SECONDS: 'Time from receiving a request to sending the last of the response',
+  STAGE_SECONDS: 'Time spent in each stage of handling a request',
+}
+
+# stage names used across the service
+EMBEDDING = 'embedding'
+VECTOR_STORE = 'vector_store_write'
+LLM = 'llm'
+TANA_API = 'tana_api'
+PROCESS_POOL = 'process_pool'
+
+# bucket boundaries (seconds) for the Prometheus exposition
+EXPORT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# 2^SUB_BUCKET_BITS buckets per power of two, so values are within 1/16 (6.25%)
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+def bucket_index(micros:int) -> int:
+  if micros < SUB_BUCKETS:
+    return max(micros, 0)
+  shift = micros.bit_length() - SUB_BUCKET_BITS - 1
+  return (shift + 1) * SUB_BUCKETS + (micros >> shift) - SUB_BUCKETS
+
+def bucket_range(index:int) -> Tuple[int, int]:
+  '''The microsecond values [low, high) recorded in bucket index.'''
+  if index < SUB_BUCKETS:
+    return index, index + 1
+  shift = index // SUB_BUCKETS - 1
+  mantissa = index % SUB_BUCKETS + SUB_BUCKETS
+  return mantissa << shift, (mantissa + 1) << shift
+
+
+class Histogram:
+  '''Latencies in seconds, kept to microsecond resolution.'''
+
+  def __init__(self):
+    self.buckets: Dict[int, int] = {}
+    self.count = 0
+    self.sum = 0.0
+    self.max = 0.0
+
+  def record(self, seconds:float):
+    index = bucket_index(int(seconds * 1_000_000))
+    self.buckets[index] = self.buckets.get(index, 0) + 1
+    self.count += 1
+    self.sum += seconds
+    self.max = max(self.max, seconds)
+
+  def quantile(self, q:float) -> float:
+    if self.count == 0:
+      return 0.0
+    rank = max(math.ceil(q * self.count), 1)
+    seen = 0
+    for index in sorted(self.buckets):
+      seen += self.buckets[index]
+      if seen >= rank:
+        low, high = bucket_range(index)
+        return min((low + high) / 2.0 / 1_000_000, self.max)
+    return self.max
+
+  def count_below(self, seconds:float) -> int:
+    '''How many values were <= seconds, to within the bucket resolution.'''
+    limit = seconds * 1_000_000
+    return sum(count for index, count in self.buckets.items() if bucket_range(index)[1] <= limit + 1)
+
+
+class LatencySummary(BaseModel):
+  name: str
+  labels: Dict[str, str]
+  count: int
+  mean: float
+  p50: float
+  p90: float
+  p99: float
+  max: float
+
+
+Labels = Tuple[Tuple[str, str], ...]
+
+class Metrics:
+  def __init__(self):
+    self.histograms: Dict[Tuple[str, Labels], Histogram] = {}
+    self.lock = Lock()
+
+  def observe(self, name:str, seconds:float, **labels:str):
+    key = (name, tuple(sorted(labels.items())))
+    with self.lock:
+      histogram = self.histograms.get(key)
+      if histogram is None:
+        histogram = self.histograms[key] = Histogram()
+      histogram.record(seconds)
+
+  def histogram(self, name:str, **labels:str) -> Optional[Histogram]:
+    return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+  def reset(self):
+    with self.lock:
+      self.histograms.clear()
+
+  def summaries(self) -> List[LatencySummary]:
+    with self.lock:
+      return [LatencySummary(name=name, labels=dict(labels), count=h.count, mean=h.sum / h.count,
+                             p50=h.quantile(0.5), p90=h.quantile(0.9), p99=h.quantile(0.99), max=h.max)
+              for (name, labels), h in sorted(self.histograms.items()) if h.count]
+
+  def prometheus(self) -> str:
+    '''All histograms in Prometheus text exposition format.'''
+    lines = []
+    with self.lock:
+      names = sorted({name for name, _ in self.histograms})
+      for name in names:
+        lines.append(f'# HELP {name} {HELP.get(name, name)}')
+        lines.append(f'# TYPE {name} histogram')
+        for (metric, labels), histogram in sorted(self.histograms.items()):
+          if metric != name:
+            continue
+          label_text = ','.join(f'{key}="{escape(value)}"' for key, value in labels)
+          prefix = label_text + ',' if label_text else ''
+          for bound in EXPORT_BUCKETS:
+            lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {histogram.count_below(bound)}')
+          lines.append(f'{name}_bucket{{{prefix}le="+Inf"}} {histogram.count}')
+          suffix = '{' + label_text + '}' if label_text else ''
+          lines.append(f'{name}_sum{suffix} {histogram.sum:.6f}')
+          lines.append(f'{name}_count{suffix} {histogram.count}')
+    return '\n'.join(lines) + '\n'
+
+
+def escape(value:str) -> str:
+  return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# the metrics for the whole service
+metrics = Metrics()
+
+
+class Span:
+  def __init__(self, name:str, parent:Optional['Span']=None, **attributes):
+    self.name = name
+    self.parent = parent
+    self.attributes = attributes
+    self.children: List['Span'] = []
+    self.duration: Optional[float] = None
+
+  def root(self) -> 'Span':
+    span = self
+    while span.parent is not None:
+      span = span.parent
+    return span
+
+  def walk(self) -> Iterator['Span']:
+    for child in self.children:
+      yield child
+      yield from child.walk()
+
+  def server_timing(self) -> str:
+    '''Total time per stage of this span, as a Server-Timing header.'''
+    totals: Dict[str, float] = {}
+    for child in self.walk():
+      if child.duration is not None:
+        totals[child.name] = totals.get(child.name, 0.0) + child.duration
+    return ', '.join(f'{name};dur={seconds * 1000.0:.1f}' for name, seconds in totals.items())
+
+
+current_span: ContextVar[Optional[Span]] = ContextVar('current_span', default=None)
+
+
+@contextmanager
+def span(name:str, **attributes) -> Iterator[Span]:
+  '''Time a stage. Recorded when the request it's part of finishes.'''
+  parent = current_span.get()
+  this = Span(name, parent, **attributes)
+  if parent is not None:
+    parent.children.append(this)
+  token = current_span.set(this)
+  start = perf_counter()
+  try:
+    yield this
+  finally:
+    this.duration = perf_counter() - start
+    try:
+      current_span.reset(token)
+    except ValueError:
+      # a generator held the span open across a yield and was resumed in
+      # another context (iterate_in_threadpool copies it for every step).
+      # Our set only ever applied to the context it was made in
+      pass
+    root = this.root()
+    if parent is None:
+      finish(this)
+    elif root.duration is not None:
+      # the request already responded (a streamed body, say)
+      metrics.observe(STAGE_SECONDS, this.duration, route=root.attributes.get('route', ''), stage=name)
+
+
+def finish(root:Span):
+  route = root.attributes.get('route', '')
+  if root.name == 'request':
+    metrics.observe(REQUEST_SECONDS, root.duration or 0.0, route=route,
+                    method=root.attributes.get('method', ''), status=str(root.attributes.get('status', '')))
+    logger.debug(f"txid={root.attributes.get('txid')} {route} took {(root.duration or 0.0) * 1000.0:.1f}ms "
+                 f"({root.server_timing()})")
+  else:
+    metrics.observe(STAGE_SECONDS, root.duration or 0.0, route=route, stage=root.name)
+  for child in root.walk():
+    if child.duration is not None:
+      metrics.observe(STAGE_SECONDS, child.duration, route=route, stage=child.name)
+
+
+# endpoint function -> route path, e.g. /webhook/{schema}
+route_paths: Dict[object, str] = {}
+
+def route_path(scope) -> str:
+  '''The path template of the route that handled a request, or '' if none did.'''
+  endpoint = scope.get('endpoint')
+  if endpoint is None:
+    return ''
+  path = route_paths.get(endpoint)
+  if path is None:
+    # routes can be added after startup (see lazyrouter.py), so look each one up when first seen
+    router = scope['app'].router
+    path = next((route.path for route in router.routes if getattr(route, 'endpoint', None) is endpoint), '')
+    route_paths[endpoint] = path
+  return path
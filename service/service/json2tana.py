@@ -3,27 +3,80 @@
 # and turns into logically equivalent JSON object tree.
 # Child nodes are represented as 'children': [child, child, child]
 
-# Strategy: 
-# Build an initial tree of nodes using 'children' arrays, marking those that are fields vs. those that are plain
-# then, walk the tree again, hoisting up any children of field nodes to be the value of the node 
-# instead of being 'children'
-
-# TODO: pull this out into sep file
-
-def tana_to_json(tana_format):
-
-  def add_child(obj, child):
+# Strategy: a single pass over the lines, with no recursion, so big pastes
+# are fast and deep outlines don't hit the recursion limit.
+# Indentation tells us where each node goes, keeping a stack of its
+# ancestors. Plain nodes are added to their parent's 'children' straight
+# away. A field is 'hoisted' up to be a value of its parent (its children
+# being the value, if it has any) once it can't get any more children, that
+# is when a line at the same or a lower level comes along.
+#
+# This builds each parent up in the same order as walking the finished tree
+# would, which is how it used to be done (a second, recursive pass). That
+# keeps every quirk of the output the same: key order, fields named 'name'
+# or 'children' and all. Errors are raised as they were then, too: those
+# from the indentation first, then the first one building the tree in that
+# order. (Adding a child can only fail after a field named 'children', so
+# such a failure is held back until the child is done.)
+
+
+def _add_child(parent, node):
+  # nodes are lists: [JSON object, parent node, field name or None, value, has children]
+  if parent[2] is not None and not parent[4]:
+    # fields with fields are special...
+    if parent[3] is None:
+      parent[3] = {}
+    parent[0]['value'] = parent[3]
+  parent[4] = True
+  if node[2] is None:
+    obj = parent[0]
     if 'children' not in obj:
       obj['children'] = []
-    obj['children'].append(child)
+    obj['children'].append(node[0])
+
+
+def _hoist_field(node):
+  obj = node[0]
+  if not node[4]:
+    obj['value'] = node[3]
+  value = obj['value']
+  if 'children' in obj:
+    children = obj['children']
+    # if value is non-null and children is non-null, we have a problem
+    if value and children:
+      raise TypeError('Field with both value and children is not supported')
+    if children:
+      value = children
+  parent = node[1]
+  # a field's fields go in its value
+  value_node = parent[0] if parent[2] is None else parent[3]
+  value_node[node[2]] = value
 
-  stack = []
-  top = { 'name': 'ROOT', 'is_field': False}
-  current = top
-  stack.append(top)
+
+def tana_to_json(tana_format):
+  root = [{'name': 'ROOT'}, None, None, None, False]
+  # ancestors of the current node. The root is in twice if the paste starts indented
+  stack = [root]
+  current = root
   current_level = 1
-  in_code_block = False
-  code_block = ""
+  # lines of the code block we're in, if any
+  code_block = None
+  # the first error building the tree. Raised once all the lines are read
+  error = None
+  # errors adding nodes to their parent, by node, until the node is done
+  held = {}
+
+  def add_child(parent, node):
+    try:
+      _add_child(parent, node)
+    except Exception as e:
+      held[id(node)] = e
+
+  def done_with(node):
+    if node[2] is not None:
+      _hoist_field(node)
+    elif held and id(node) in held:
+      raise held.pop(id(node))
 
   for line in tana_format.split('\n'):
 
@@ -31,107 +84,94 @@ def tana_to_json(tana_format):
     if line == '' or line == '-':
       continue
 
-    if in_code_block:
-      code_block += line +'\n'
-      if '```' in line and line[0:3] == '```':
-        in_code_block = False
-        if current['is_field']:
-          current['value'] = code_block
+    if code_block is not None:
+      code_block.append(line)
+      if line.startswith('```'):
+        block = '\n'.join(code_block) + '\n'
+        code_block = None
+        if current[2] is not None:
+          current[3] = block
         else:
           # code block is sibling
-          newobj = { 'name': code_block, 'is_field': False, 'field': None, 'value': None  }
-          add_child(stack[-1], newobj)
-          current = newobj
+          if error is None:
+            try:
+              done_with(current)
+            except Exception as e:
+              error = e
+          current = [{'name': block}, stack[-1], None, None, False]
+          if error is None:
+            add_child(stack[-1], current)
       continue
 
-    if '-' not in line:
+    dash = line.find('-')
+    if dash < 0:
       # this could be a code block or other multi-line value
       if '```' in line:
-        code_block = line + '\n'
-        in_code_block = True
+        code_block = [line]
         continue
+      dash = len(line)
 
     # count leading spaces
-    leader = line.split('-')[0]
-    level = int(len(leader) / 2) + 1
+    level = dash // 2 + 1
 
     line = line.lstrip(' -')
 
-    field = None
-    value = None
-
-    is_field = '::' in line
-
-    if is_field:
-      fields = line.split('::')
-      field = fields[0].strip()
-      if fields[1].strip() != '':
-        value = fields[1].strip()
+    if '::' in line:
+      field, _, rest = line.partition('::')
+      field = field.strip()
+      node = [{'field': field}, None, field, rest.partition('::')[0].strip() or None, False]
+    else:
+      node = [{'name': line}, None, None, None, False]
 
-    newobj = { 'name': line, 'is_field': is_field, 'field': field, 'value': value  }
+    # the nodes that won't get any more children
+    done = ()
     if level < current_level:  #exdent
       # pop off as many as needed
-      stack = stack[0:level - current_level]
-      add_child(stack[-1], newobj)
-      current = newobj
+      done = stack[level - current_level:]
+      del stack[level - current_level:]
+      parent = stack[-1]
       current_level = level
-
     elif level > current_level:
       # indent, means child of current
-      add_child(current, newobj)
+      parent = current
       stack.append(current)
-      current = newobj
       current_level = level
     else:
       # same level, means add as child to same parent
-      add_child(stack[-1], newobj)
-      current = newobj
-
-  def hoist_field(node, parent):
-    value = node['value']
-    if 'children' in node:
-      children = node['children']
-      # if value is non-null and children is non-null, we have a problem
-      if value and children:
-        raise TypeError('Field with both value and children is not supported')
-      if children:
-        value = children
-    parent[node['field']] = value
-
-  def process_node(node):
-    is_field = False
-    if 'is_field' in node and node['is_field']:
-      is_field = True
-      newnode = {'field': node['field'], 'value': node['value']}
-    else:
-      newnode = { 'name': node['name']}
-
-    if 'children' in node:
-      value_node = newnode
-      # fields with fields are special...
-      if is_field:
-        if node['value'] is None:
-          node['value'] = {}
-        value_node = node['value']
-        newnode['value'] = value_node
-
-      for child in node['children']:
-        newchild = process_node(child)
-        if child['is_field']:
-          hoist_field(newchild, value_node)
-        else:
-          add_child(newnode, newchild)
-    return newnode
-
-  # now, reprocess tree, 'hoisting' children of fields and dropping is_field flags
-  # print(top)
-  result = process_node(top)
-  # print(result)
-  return result['children']
-
-
-def code_to_tana(value, indent):
-  line = ''
+      parent = stack[-1]
+    node[1] = parent
+
+    if error is None:
+      try:
+        if parent is not current:
+          # nothing to do for most nodes, so check before calling
+          if current[2] is not None or held:
+            done_with(current)
+          for done_node in reversed(done):
+            if done_node[2] is not None or held:
+              done_with(done_node)
+        add_child(parent, node)
+      except Exception as e:
+        error = e
+    current = node
+
+  if error is None:
+    try:
+      for done_node in [current] + stack[::-1]:
+        done_with(done_node)
+    except Exception as e:
+      error = e
+  if error is not None:
+    raise error
+  return root[0]['children']
+
+
+# JSON to Tana is the other way round. The lines are generated one at a
+# time, walking the tree with a stack rather than recursing, so they can be
+# streamed out (or written to a file) as they're made and the whole paste
+# never has to be built up in memory. json_to_tana joins them, once.
+
+def _code_lines(value, indent):
   splits = value.split('<br>')
   for split in splits:
     if len(split) == 0:
@@ -140,74 +180,93 @@ def code_to_tana(value, indent):
     # count spaces
     strip = split.lstrip(' ')
     spaces = len(split) - len(strip)
-    line += ' '*(indent + spaces) + '- ' + strip + '\n'
-  indent -= 2
-  return line
-
+    yield ' '*(indent + spaces) + '- ' + strip + '\n'
+
+
+def _children_lines(objects, initial_indent):
+  # frames on the stack are either (objects, indent), a list of objects
+  # we're working through, or [object, keys, indent, children], an object
+  # whose fields we're part way through, having gone down into one
+  stack = [(iter(objects), initial_indent)]
+  while stack:
+    frame = stack[-1]
+
+    if len(frame) == 2:
+      objects, indent = frame
+      obj = next(objects, _END)
+      if obj is _END:
+        stack.pop()
+        continue
+      # do name first. If empty, we're a field with fields...
+      if 'name' in obj and obj['name'] is not None:
+        name = obj['name']
 
-def children_to_tana(objects, initial_indent):
-  tana_format = ''
-
-  for obj in objects:
-    indent = initial_indent
-    children = [] # assume no children initially
-    # do name first. If empty, we're a field with fields...
-    if 'name' in obj and obj['name'] is not None:
-      name = obj['name']
-
-      if '```' in name:
-        # name is in fact code block
-        tana_format += code_to_tana(name, indent)
-      else:
-        tana_format += ' '*indent + '- ' + name +'\n'
+        if '```' in name:
+          # name is in fact code block
+          yield from _code_lines(name, indent)
+        else:
+          yield ' '*indent + '- ' + name +'\n'
 
-      indent += 2
+        indent += 2
+      # assume no children initially. Only stacked if we go down a level
+      frame = [obj, iter(obj.keys()), indent, []]
 
-    for key in obj.keys():
-      line = ''
+    obj, keys, indent, _ = frame
+    for key in keys:
       value = obj[key]
       if key == 'name':
         continue
       elif key == 'children':
-        children = value
+        frame[3] = value
         # skip for now
       else:
         # do all the fields first
         if '```' in value:
           # code block needs special handling
-          line = ' '*indent + '- ' + key + '::\n'
-          line += code_to_tana(value, indent+2)
-          tana_format += line
+          yield ' '*indent + '- ' + key + '::\n'
+          yield from _code_lines(value, indent+2)
         elif type(value) is list:
           # multi-valued fields need special handling
-          tana_format += ' '*indent + '- ' + key + '::\n'
-          chunk = children_to_tana(value, indent+2)
-          tana_format += chunk
+          yield ' '*indent + '- ' + key + '::\n'
+          if stack[-1] is not frame:
+            stack.append(frame)
+          stack.append((iter(value), indent+2))
+          break
         elif type(value) is str:
           # just a plain valued field
-          tana_format += ' '*indent + '- ' + key + ':: ' + value + '\n'
+          yield ' '*indent + '- ' + key + ':: ' + value + '\n'
         else:
-          # must be an object type, recurse
-          tana_format += ' '*indent + '- ' + key + '::\n'
-          chunk = children_to_tana([value], indent+2)
-          tana_format += chunk
+          # must be an object type, go down into it
+          yield ' '*indent + '- ' + key + '::\n'
+          if stack[-1] is not frame:
+            stack.append(frame)
+          stack.append((iter([value]), indent+2))
+          break
+    else:
+      # fields all done, now do children
+      if stack[-1] is frame:
+        stack.pop()
+      children = frame[3]
+      if len(children) > 0:
+        stack.append((iter(children), indent))
 
-    # now do children recursively
-    if len(children) > 0:
-      chunk = children_to_tana(children, indent)
-      if chunk != '':
-        tana_format += chunk
+_END = object()
 
-  return tana_format
 
+def code_to_tana(value, indent):
+  return ''.join(_code_lines(value, indent))
 
-def json_to_tana(json_format):
-  tana_format = ''
-  indent = 0
+
+def children_to_tana(objects, initial_indent):
+  return ''.join(_children_lines(objects, initial_indent))
+
+
+def tana_lines(json_format):
+  '''The Tana paste for a JSON object (or list of them), a line at a time.'''
   if type(json_format) is not list:
     json_format = [json_format]
+  return _children_lines(json_format, 0)
 
-  chunk = children_to_tana(json_format, indent)
-  tana_format += chunk
 
-  return tana_format
\ No newline at end of file
+def json_to_tana(json_format):
+  return ''.join(tana_lines(json_format))
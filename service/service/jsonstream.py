@@ -0,0 +1,127 @@
+from json import JSONDecodeError, JSONDecoder
+from json.decoder import WHITESPACE
+from typing import Any, List
+
+# Incremental JSON parsing, for responses we'd rather not wait for (or hold)
+# in full. See the streaming proxy in service/endpoints/proxy.py
+#
+# Text is fed in as it arrives. If the document is an array, each element
+# comes out as soon as it is complete, so a long list of records can be
+# handled one by one. Anything else comes out once it has all arrived.
+#
+# An element that hasn't all arrived yet is tried again only once the text
+# waiting has doubled, so a huge element costs a few attempts, not one per
+# chunk, and the whole thing stays linear.
+
+_decoder = JSONDecoder()
+
+_NUMBER = '0123456789.eE+-'
+
+
+def _more_number(value, text:str, end:int) -> bool:
+  # a number cut off part way through, 12. or 1e say, parses as a shorter one
+  return type(value) in (int, float) and not text[end:].lstrip(_NUMBER)
+
+
+class JSONStream:
+  '''Parses a JSON document fed to it a piece at a time.'''
+
+  def __init__(self):
+    # text we're working through, and how far through it we are
+    self.text = ''
+    self.pos = 0
+    # text fed since, not looked at yet
+    self.pending = []
+    self.pending_length = 0
+    # how much unparsed text to wait for before trying again
+    self.retry_at = 0
+    # None until we know, then 'array' or 'document'. 'done' after the array
+    self.kind = None
+    # in an array, whether a value (rather than , or ]) comes next
+    self.value_next = True
+    self.first = True
+
+  def feed(self, text:str) -> List[Any]:
+    '''Adds text, returning any values now complete.'''
+    self.pending.append(text)
+    self.pending_length += len(text)
+    if self.kind == 'document' or len(self.text) - self.pos + self.pending_length < self.retry_at:
+      return []
+    return self._parse(final=False)
+
+  def close(self) -> List[Any]:
+    '''The end of the text. Returns the last values, raising
+    JSONDecodeError if the document is incomplete or invalid.'''
+    values = self._parse(final=True)
+    rest = self.text[self.pos:]
+    if self.kind == 'document':
+      values.append(_decoder.decode(rest))
+      self.pos = len(self.text)
+    elif self.kind is None:
+      # nothing but whitespace
+      _decoder.decode(rest)
+    elif self.kind == 'array':
+      raise JSONDecodeError('Unterminated array', self.text, self.pos)
+    elif rest.strip(' \t\n\r'):
+      raise JSONDecodeError('Extra data', self.text, self.pos)
+    return values
+
+  def _parse(self, final:bool) -> List[Any]:
+    # drop what's done with and pick up what's pending
+    self.text = self.text[self.pos:] + ''.join(self.pending)
+    self.pos = 0
+    self.pending = []
+    self.pending_length = 0
+    self.retry_at = 0
+
+    values = []
+    text = self.text
+    while True:
+      pos = WHITESPACE.match(text, self.pos).end()
+      if pos == len(text):
+        break
+      self.pos = pos
+
+      if self.kind is None:
+        if text[pos] == '[':
+          self.kind = 'array'
+          self.pos = pos + 1
+        else:
+          # the whole thing, once it's all here
+          self.kind = 'document'
+        continue
+      if self.kind != 'array':
+        break
+
+      char = text[pos]
+      if not self.value_next:
+        if char == ',':
+          self.value_next = True
+          self.pos = pos + 1
+        elif char == ']':
+          self.kind = 'done'
+          self.pos = pos + 1
+        else:
+          raise JSONDecodeError("Expecting ',' delimiter", text, pos)
+        continue
+      if char == ']' and self.first:
+        self.kind = 'done'
+        self.pos = pos + 1
+        continue
+
+      try:
+        value, end = _decoder.raw_decode(text, pos)
+      except JSONDecodeError:
+        if final:
+          raise
+        end = len(text)
+      if not final and (end == len(text) or (text[end] in _NUMBER and _more_number(value, text, end))):
+        # incomplete, or maybe a number with more of it to come
+        self.retry_at = 2 * (len(text) - pos)
+        break
+      values.append(value)
+      self.pos = end
+      self.value_next = False
+      self.first = False
+
+    return values
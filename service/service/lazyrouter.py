@@ -0,0 +1,146 @@
+import asyncio
+import contextvars
+import importlib
+import time
+from logging import getLogger
+from types import ModuleType
+from typing import Dict, List, Optional, Tuple
+
+from fastapi import FastAPI
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import JSONResponse
+from starlette.routing import BaseRoute, Match, NoMatchFound
+from starlette.types import Receive, Scope, Send
+from starlette.websockets import WebSocketClose
+
+logger = getLogger()
+
+# Lazily loaded endpoint modules.
+#
+# Some endpoint modules pull in heavy libraries (chromadb, weaviate, openai)
+# that take seconds to import, which the tray app pays for on every start.
+# Instead of importing them in main.py, we register a LazyRoute stub per
+# module that matches the module's path prefixes. The first request that
+# hits a stub imports the module (in a worker thread), puts its routes in the
+# stub's place and hands the request on to them.
+#
+# A lazily loaded module can define async startup() and shutdown() functions,
+# which are run after it is loaded and when the service stops.
+
+class LazyRoute(BaseRoute):
+  def __init__(self, app:FastAPI, module:str, prefixes:List[str]):
+    self.app = app
+    self.module_name = module
+    self.prefixes = prefixes
+    self.module: Optional[ModuleType] = None
+    self.lock = asyncio.Lock()
+    # how long the import took, once loaded
+    self.import_seconds: Optional[float] = None
+
+  def matches(self, scope:Scope) -> Tuple[Match, Dict]:
+    if scope['type'] in ('http', 'websocket'):
+      path = scope['path']
+      for prefix in self.prefixes:
+        if path == prefix or path.startswith(prefix.rstrip('/') + '/'):
+          return Match.FULL, {}
+    return Match.NONE, {}
+
+  def url_path_for(self, name:str, /, **path_params):
+    raise NoMatchFound(name, path_params)
+
+  def _import(self) -> ModuleType:
+    start = time.perf_counter()
+    module = importlib.import_module(self.module_name)
+    self.import_seconds = time.perf_counter() - start
+    logger.info(f'Loaded {self.module_name} in {self.import_seconds * 1000.0:.0f} ms')
+    return module
+
+  def _install(self, module:ModuleType):
+    '''Swap this stub for the module's routes, keeping their place in the route order.'''
+    if self.module is not None:
+      return
+    self.module = module
+    routes = self.app.router.routes
+    count = len(routes)
+    self.app.include_router(module.router)
+    added = routes[count:]
+    del routes[count:]
+    index = routes.index(self)
+    routes[index:index + 1] = added
+    # the API docs need to include the new routes
+    self.app.openapi_schema = None
+
+  async def load(self) -> ModuleType:
+    async with self.lock:
+      if self.module is None:
+        module = await run_in_threadpool(self._import)
+        self._install(module)
+        if hasattr(module, 'startup'):
+          # in a fresh context, so background tasks it starts don't belong to this request
+          await asyncio.create_task(module.startup(), context=contextvars.Context())
+    return self.module
+
+  def load_now(self) -> ModuleType:
+    '''Load from synchronous code. Runs startup() in the background.'''
+    if self.module is None:
+      self._install(self._import())
+      if hasattr(self.module, 'startup'):
+        asyncio.get_running_loop().create_task(self.module.startup(), context=contextvars.Context())
+    return self.module
+
+  async def handle(self, scope:Scope, receive:Receive, send:Send):
+    try:
+      await self.load()
+    except ImportError as e:
+      # e.g. an optional backend that isn't installed
+      logger.warning(f'Failed to load {self.module_name}: {e}')
+      if scope['type'] == 'websocket':
+        await WebSocketClose()(scope, receive, send)
+      else:
+        await JSONResponse({'detail': f'{self.module_name} is unavailable: {e}'},
+                           status_code=503)(scope, receive, send)
+      return
+    # our routes are in place now, so route the request again
+    await self.app.router(scope, receive, send)
+
+
+class LazyRouters:
+  '''The lazily loaded endpoint modules of an app.'''
+
+  def __init__(self, app:FastAPI):
+    self.app = app
+    self.routes: Dict[str, LazyRoute] = {}
+
+  def include(self, module:str, prefixes:List[str]):
+    '''Register module's router, to be imported on the first request under prefixes.'''
+    route = LazyRoute(self.app, module, prefixes)
+    self.routes[module] = route
+    self.app.router.routes.append(route)
+
+  def warm_up(self, module:str) -> asyncio.Task:
+    '''Load a module in the background, without waiting for a request.'''
+    route = self.routes[module]
+    async def load():
+      try:
+        await route.load()
+      except Exception as e:
+        logger.warning(f'Failed to load {route.module_name}: {e}')
+    return asyncio.create_task(load())
+
+  def load_all(self):
+    # for the API docs, which want to see every route
+    for route in self.routes.values():
+      try:
+        route.load_now()
+      except ImportError as e:
+        logger.warning(f'Leaving {route.module_name} out of the API docs: {e}')
+
+  async def shutdown(self):
+    for route in self.routes.values():
+      if route.module is not None and hasattr(route.module, 'shutdown'):
+        await route.module.shutdown()
+
+  def openapi(self) -> dict:
+    '''FastAPI.openapi, with every lazy module loaded first.'''
+    self.load_all()
+    return FastAPI.openapi(self.app)
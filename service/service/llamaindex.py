@@ -0,0 +1,407 @@
+from functools import lru_cache
+from logging import getLogger
+from typing import Dict, List, Optional
+
+from llama_index import PromptTemplate, ServiceContext, StorageContext, VectorStoreIndex
+from llama_index.bridge.pydantic import Field
+from llama_index.callbacks import CallbackManager, LlamaDebugHandler
+from llama_index.embeddings import OpenAIEmbedding
+from llama_index.indices.vector_store.retrievers import VectorIndexRetriever
+from llama_index.llms import Ollama, OpenAI
+from llama_index.llms.base import BaseLLM
+from llama_index.postprocessor.types import BaseNodePostprocessor
+from llama_index.query_pipeline import CustomQueryComponent, QueryPipeline
+from llama_index.response_synthesizers import TreeSummarize
+from llama_index.schema import MetadataMode, NodeRelationship, NodeWithScore, QueryBundle, TextNode
+from llama_index.vector_stores.chroma import ChromaVectorStore
+from llama_index.vector_stores.types import MetadataInfo, VectorStoreInfo
+
+from service.dependencies import TANA_TEXT
+from service.endpoints.chroma import get_collection, get_tana_nodes_by_id
+from service.endpoints.topics import tana_node_ids_from_text
+from service.fanout import RateLimiter, ordered_map
+from service.requestcontext import get_openai_api_key
+from service.streaming import StreamEvent
+from service.txntimer import StageTimings
+
+logger = getLogger()
+
+# The llama_index based research stack behind /llamaindex/ask and
+# /llamaindex/research, over the Tana nodes preloaded into ChromaDB.
+#
+# llama_index takes seconds to import, so nothing imports this module
+# directly: endpoints/research.py loads it in the background instead.
+
+# the model name 'openai' means OpenAI's GPT-4, anything else is an Ollama model
+OPENAI_MODEL = 'gpt-4-1106-preview'
+
+
+def get_llm(model:str, api_key:Optional[str]=None) -> BaseLLM:
+  if model == 'openai':
+    return OpenAI(model=OPENAI_MODEL, api_key=api_key or get_openai_api_key())
+  return Ollama(model=model, request_timeout=120.0)
+
+
+@lru_cache()
+def _get_index(model:str, observe:bool, api_key:str):
+  llm = get_llm(model, api_key)
+  # the vectors in Chroma come from OpenAI (see chroma_upsert), whatever the LLM
+  embed_model = OpenAIEmbedding(api_key=api_key)
+  handlers = [LlamaDebugHandler(print_trace_on_end=True)] if observe else []
+  service_context = ServiceContext.from_defaults(llm=llm, embed_model=embed_model,
+                                                 callback_manager=CallbackManager(handlers))
+  vector_store = ChromaVectorStore(chroma_collection=get_collection())
+  storage_context = StorageContext.from_defaults(vector_store=vector_store)
+  index = VectorStoreIndex.from_vector_store(vector_store, service_context=service_context)
+  logger.info(f'Built llamaindex over ChromaDB for model {model}')
+  return (index, service_context, storage_context, llm)
+
+
+def get_index(model:str='openai', observe:bool=False):
+  '''The (index, service_context, storage_context, llm) for a model.
+  Built once per model (and OpenAI key), then reused.'''
+  return _get_index(model, observe, get_openai_api_key())
+
+
+decompose_tmpl = PromptTemplate(
+    "You are an expert researcher.\n"
+    "TASK\n"
+    "Break the QUERY down into at most {max_questions} simpler research questions that together answer it.\n"
+    "Some rules to follow:\n"
+    "1. Each question must make sense on its own, without the QUERY.\n"
+    "2. The CONTEXT holds the Tana Notebook Nodes the QUERY refers to, if any. Use it to make the questions specific.\n"
+    "3. Output one question per line, and nothing else. No numbering.\n"
+    "\n"
+    "QUERY: {query}\n"
+    "-----\n"
+    "CONTEXT:\n"
+    "{context}\n"
+    "END_CONTEXT\n"
+    "-----\n"
+  )
+
+class DecomposeQueryWithNodeContext(CustomQueryComponent):
+  '''Break a query into research questions, taking into account
+  the Tana nodes the query references ([[name^id]]).'''
+  llm: BaseLLM = Field(..., description='LLM used to write the questions')
+  max_questions: int = Field(default=5, description='Most questions to return')
+
+  @property
+  def _input_keys(self) -> set:
+    return {'query'}
+
+  @property
+  def _output_keys(self) -> set:
+    return {'questions'}
+
+  def _run_component(self, **kwargs) -> Dict[str, List[str]]:
+    query = kwargs['query']
+    context = '\n'.join(get_tana_nodes_by_id(tana_node_ids_from_text(query)))
+    prompt = decompose_tmpl.format(query=query, context=context, max_questions=self.max_questions)
+    response = self.llm.complete(prompt)
+    questions = [line.strip().lstrip('-*0123456789.) ').strip() for line in response.text.split('\n')]
+    questions = [question for question in questions if question][:self.max_questions]
+    logger.info(f'Research questions: {questions}')
+    # no luck? just research the query itself
+    return {'questions': questions or [query]}
+
+
+class WidenNodeWindowPostProcessor(BaseNodePostprocessor):
+  '''Widen retrieved nodes with their neighbours: up to num_nodes previous
+  and/or next nodes (mode is previous, next or both) where the docstore knows
+  them, and the topic node that a piece of Tana text belongs to.'''
+  storage_context: StorageContext
+  num_nodes: int = Field(default=1)
+  mode: str = Field(default='both')
+
+  class Config:
+    arbitrary_types_allowed = True
+
+  @classmethod
+  def class_name(cls) -> str:
+    return 'WidenNodeWindowPostProcessor'
+
+  def _postprocess_nodes(self, nodes:List[NodeWithScore], query_bundle:Optional[QueryBundle]=None) -> List[NodeWithScore]:
+    docstore = self.storage_context.docstore
+    relationships = []
+    if self.mode in ('previous', 'both'):
+      relationships.append(NodeRelationship.PREVIOUS)
+    if self.mode in ('next', 'both'):
+      relationships.append(NodeRelationship.NEXT)
+
+    widened = {node.node.node_id: node for node in nodes}
+    topics = {}
+    for node in nodes:
+      for relationship in relationships:
+        current = node.node
+        for _ in range(self.num_nodes):
+          related = current.relationships.get(relationship)
+          if related is None or not docstore.document_exists(related.node_id):
+            break
+          current = docstore.get_node(related.node_id)
+          if current.node_id not in widened:
+            widened[current.node_id] = NodeWithScore(node=current, score=node.score)
+
+      topic_id = node.node.metadata.get('topic_id')
+      if topic_id and topic_id not in widened:
+        topics[topic_id] = max(topics.get(topic_id, 0.0), node.score or 0.0)
+
+    if topics:
+      # topic nodes live in Chroma next to their text
+      found = self.storage_context.vector_store.client.get(ids=list(topics))
+      for node_id, text, metadata in zip(found['ids'], found['documents'], found['metadatas']):
+        topic = TextNode(id_=node_id, text=text or '', metadata=metadata or {})
+        widened[node_id] = NodeWithScore(node=topic, score=topics[node_id])
+
+    return list(widened.values())
+
+
+# enrich our retriever with knowledge of our metadata
+def get_auto_retriever(index:VectorStoreIndex):
+  vector_store_info = VectorStoreInfo(
+    content_info="My Tana Notebook. Comprises many Tana nodes with text and metadata fields.",
+    metadata_info=[
+        MetadataInfo(
+            name="category",
+            type="str",
+            description=(
+                "One of TANA_NODE or TANA_TEXT\n"
+                "TANA_NODE means that this is a top-level topic in my Tana notebook\n"
+                "TANA_TEXT means this is detailed information as part of a topic, identfied by topic_id metadata.\n"
+                "Do NOT use category to query the index. Only use category to enrich your understanding of the result.\n"
+                "DO NOT reference category in your responses.\n"
+            ),
+        ),
+        MetadataInfo(
+            name="topic_id",
+            type="str",
+            description=(
+                "Identifies the Tana Notebook Node that this text is part of. Should be used as a reference to the notebook entry.\n"
+                "Only use topic_id to query the index when you want a single specific node by reference.\n"
+                "You can use topic_id when referencing a Tana Notebook Node in your responses.\n"
+            ),
+        ),
+        MetadataInfo(
+            name="tana_id",
+            type="str",
+            description=(
+                "The Tana Notebook Node for this piece of text. Should be used a reference to the notebook entry.\n"
+                "Only use topic_id to query the index when you want a single specific node by reference.\n"
+                "You can use tana_id when referencing a Tana Notebook Node in your responses.\n"
+            ),
+        ),
+        MetadataInfo(
+            name="supertag",
+            type="str",
+            description=(
+                "One or more optional GENERAL semantic ontology tags for this Tana Notebook Node.\n"
+                "Delimited by spaces (NOT a LIST. Do not use IN operator to test membership)\n"
+                "Example: \n"
+                "{ supertag:  #task #topic #person #meeting }\n"
+                "Do NOT use supertags to query the index. Only use supertags to enrich your understanding of the result.\n"
+            ),
+        ),
+      ],
+  )
+
+  # THIS doesn't work at all well with GPT 3
+  # and only works sometimes with GPT4. Problem is that it becomes fixated on the 
+  # use of metadata to filter results, overly constraining relevance.
+  # retriever = VectorIndexAutoRetriever(
+  #     index, 
+  #     vector_store_info=vector_store_info, 
+  #     similarity_top_k=10
+  # )
+
+  retriever = VectorIndexRetriever(index=index, similarity_top_k=10)
+  return retriever
+
+
+summary_tmpl = PromptTemplate(
+    "You are an expert Q&A system that is trusted around the world.\n"
+    "TASK\n"
+    "Summarize the following CONTEXT in order to best answer the QUERY.\n"
+    "Answer the QUERY using the provided CONTEXT information, and not prior knowledge.\n"
+    "Some rules to follow:\n"
+    "1. Avoid statements like 'Based on the context, ...' or 'The context information ...' or anything along those lines.\n"
+    "2. The CONTEXT contais references to many Tana Notebook Nodes. Nodes have both metadata and text content\n"
+    "3. Whenever your summary needs to reference Tana Notebook Nodes from the CONTEXT, use proper Tana node reference format as follows:\n"
+    "  the characters '[[' + '^' + tana_id metadata and then the characters ']]'.\n"
+    "  E.g. to reference the Tana context node titled 'Recipe for making icecream' with tana_id: xghysd76 use this format:\n"
+    "    [[^xghysd76]]\n"
+    "5. Try to avoid making many redundant references to the same Tana node in your summary. Use footnote style if you really need to do this.\n"
+    "\n"
+    "QUERY: {query_str}\n"
+    "-----\n"
+    "CONTEXT:\n"
+    "{context_str}\n"
+    "END_CONTEXT\n"
+    "-----\n"
+  )
+
+research_tmpl = PromptTemplate(
+    "You are an expert Q&A system that is trusted around the world.\n"
+    "Always answer the question using the provided context information, and not prior knowledge.\n"
+    "Some rules to follow:\n"
+    "1. Avoid statements like 'Based on the context, ...' or 'The context information ...' or anything along those lines.\n"
+    "2. You will be given CONTEXT information in the form of one or more related QUESTIONS and the ANSWERS to those questions.\n"
+    "3. For each ANSWER, there may be many Tana Notebook Nodes. Nodes have both metadata and text content\n"
+    "4. Whenever your response needs to reference Tana Notebook Nodes from the context, use proper Tana node reference format as follows:\n"
+    "  the characters '[[' + '^' + tana_id metadata and then the characters ']]'.\n"
+    "  E.g. to reference the Tana context node titled 'Recipe for making icecream' with tana_id: xghysd76 use this format:\n"
+    "    [[^xghysd76]]\n"
+    "5. Try to avoid making many redundant references to the same Tana node in your response. Use footnote style if you really need to do this.\n"
+    "\n"
+    "QUERY: {query}\n"
+    "-----\n"
+    "CONTEXT:\n"
+    "{context}\n"
+    "END_CONTEXT\n"
+    "-----\n"
+  )
+
+
+def research_question(question:str, index, service_context, storage_context, limiter:RateLimiter,
+                      timings:StageTimings):
+  logger.info(f'Question: {question}')
+  # questions are researched side by side, and these keep state as they
+  # run, so each question gets its own
+  retriever = get_auto_retriever(index)
+  # and preprocess the result nodes to make use of next/previous
+  prevnext = WidenNodeWindowPostProcessor(storage_context=storage_context, num_nodes=5, mode="both")
+  summarizer = TreeSummarize(summary_template=summary_tmpl, service_context=service_context)
+
+  # use our metadata aware auto-retriever to fetch from Chroma
+  limiter.wait()
+  with timings.stage('retrieve'):
+    q1 = QueryPipeline(chain=[retriever, prevnext])
+    nodes = q1.run(input=question)
+  # nodes = retriever.retrieve(question)
+  # logger.info(f'Nodes:\n{nodes}')
+
+  # clean up the redudant metadata (TANA_TEXT node metadata is less useful here)
+  new_nodes = []
+  if nodes:
+    for node in nodes:
+      new_node = node
+      if node.metadata['category'] == TANA_TEXT:
+        # copy the outer NodeWithScore and the inner TextNode objects
+        new_text_node = TextNode(**node.node.dict())
+        # wipe out the metadata
+        new_text_node.metadata = {}
+        new_node = NodeWithScore(node=new_text_node, score=node.score)
+
+      new_nodes.append(new_node)
+
+  research = '\n'.join([node.get_content(metadata_mode=MetadataMode.LLM) for node in new_nodes])
+  logger.info(f'Nodes:\n{research}')
+
+  # tailor the summarizer prompt
+  limiter.wait()
+  with timings.stage('summarize'):
+    sum_result = summarizer.as_query_component().run_component(nodes=new_nodes, query_str=question)
+  summary = sum_result['output'].response
+  logger.info(f'Summary:\n{summary}')
+
+  return {'question': question,
+          'answers': nodes,
+          'summary': summary}
+
+
+def research_questions(query:str, index, service_context, storage_context, llm, timings:StageTimings,
+                       fan_out:int, rate_limit:float):
+  '''Break the query into research questions and answer each of them from the index.
+  Questions are researched fan_out at a time. Yields a result dict per question, in order.'''
+  # first, build up a set of research questions
+  with timings.stage('decompose'):
+    decompose_transform = DecomposeQueryWithNodeContext(llm=llm)
+    p1 = QueryPipeline(chain=[decompose_transform])
+    questions = p1.run(query=query)
+
+  limiter = RateLimiter(rate_limit)
+  def research_one(question:str):
+    return research_question(question, index, service_context, storage_context, limiter, timings)
+
+  # for each question, do a fetch against Chroma to find potentially relevant nodes
+  # and summarize them. Each is a few round trips, so run them side by side
+  with timings.stage('research'):
+    yield from ordered_map(research_one, [question for question in questions if question != ''], fan_out)
+
+
+def research_context(results) -> str:
+  # now build up the context from the result nodes
+  context = []
+  for result in results:
+    question = result['question']
+    answer = result['answers']
+    summary = result['summary']
+    context.append(f'QUESTION: {question}\n')
+
+    #context.append('RESEARCH:\n')
+    # TODO: instead of dumping all nodes into the primary context
+    # we should prepare an answer to each question and then use that
+    # node:TextNode
+    # for node in answer:
+    #   context.append(node.get_content(metadata_mode=MetadataMode.LLM)+'\n')
+    
+    context.append('ANSWER:\n')
+    context.append(summary+'\n')
+
+    context.append('\n')
+  return '\n'.join(context)
+
+
+def research(query:str, model:str, timings:StageTimings, fan_out:int, rate_limit:float) -> str:
+  '''Research a question, returning the answer.'''
+  # LlamaDebugHandler isn't thread safe, so only observe one question at a time
+  (index, service_context, storage_context, llm) = get_index(model, observe=fan_out == 1)
+  logger.info(f'Researching LLamaindex with {query}')
+  results = list(research_questions(query, index, service_context, storage_context, llm, timings,
+                                    fan_out, rate_limit))
+
+  # now combine all that research 
+  with timings.stage('answer'):
+    p2 = QueryPipeline(chain=[research_tmpl, llm])
+    response = p2.run(query=query, context=research_context(results))
+  return response.message.content
+
+
+def stream_research(query:str, model:str, timings:StageTimings, fan_out:int, rate_limit:float):
+  '''Research a question, yielding progress events then the answer as it's generated.'''
+  # LlamaDebugHandler isn't thread safe, so only observe one question at a time
+  (index, service_context, storage_context, llm) = get_index(model, observe=fan_out == 1)
+  logger.info(f'Researching LLamaindex with {query}')
+
+  # the research steps can take a while, so let SSE clients
+  # follow along before the answer itself starts to arrive
+  results = []
+  for result in research_questions(query, index, service_context, storage_context, llm, timings, fan_out, rate_limit):
+    results.append(result)
+    yield StreamEvent('question', result['question'])
+    yield StreamEvent('summary', result['summary'])
+
+  # now combine all that research, streaming the answer as it's generated
+  messages = research_tmpl.format_messages(query=query, context=research_context(results))
+  with timings.stage('answer'):
+    for response in llm.stream_chat(messages):
+      yield response.delta
+  # too late for a header by now
+  yield StreamEvent('timing', timings.server_timing())
+
+
+def ask(query:str, model:str, stream:bool=False):
+  '''Ask a question of the index. Returns the answer, or a generator of it with stream.'''
+  (index, service_context, storage_context, llm) = get_index(model=model)
+  query_engine = index.as_query_engine(similarity_top_k=20, streaming=stream)
+
+  logger.info(f'Querying LLamaindex with {query}')
+  response = query_engine.query(query)
+  if stream:
+    return response.response_gen
+  return str(response)
+
+
+def warm_up(model:str='openai'):
+  '''Build the index ahead of the first request.'''
+  get_index(model)
+  get_index(model, observe=True)
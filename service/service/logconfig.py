@@ -11,6 +11,8 @@ from functools import lru_cache
 from pathlib import Path
 from pydantic import BaseModel
 from service.settings import settings
+from service.loghub import log_hub
+from service.workers import worker_count
 from typing import Optional
 
 import logging
@@ -70,12 +72,13 @@ def get_logger_config():
       **rich_props
     )
 
-    # TODO: turns this into a log stream, rather than a file
-    # so we can pass raw logs to websocket monitor in logmonitor.py
+    # the log file is for people. The log monitor gets structured records from log_hub
     # TODO: Can Rich format log lines without a Console width or do we
     # need to glue all of this together somehow and pass width back to this 
     # layer?
-    rich_log_file = open(LOGGER_FILE, "wt")
+    # with several worker processes they all append to the one log, which
+    # myuvicorn.ServiceWorker empties before starting them
+    rich_log_file = open(LOGGER_FILE, "at" if worker_count() > 1 else "wt")
     rich_file_handler = RichHandler(
       console=Console(file=rich_log_file, force_terminal=True, soft_wrap=True, width=100),
       **rich_props
@@ -90,7 +93,8 @@ def get_logger_config():
       handlers=[
         rich_handler,
         # output_file_handler,
-        rich_file_handler
+        rich_file_handler,
+        log_hub,
       ],
       format=LOGGER_FORMAT, # changed from None
       date_format=DATE_FORMAT,
@@ -110,7 +114,7 @@ def get_logger_config():
     stdout_handler.setFormatter(handler_format)
 
     logger_config = LoggerConfig(
-      handlers=[output_file_handler, stdout_handler],
+      handlers=[output_file_handler, stdout_handler, log_hub],
       format="%(levelname)s: %(asctime)s %(threadName)s \t%(message)s",
       date_format="%d-%b-%y %H:%M:%S",
       logger_file=LOGGER_FILE,
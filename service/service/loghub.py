@@ -0,0 +1,176 @@
+import asyncio
+import logging
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from typing import Deque, Iterator, List, Optional, Set
+
+from pydantic import BaseModel
+
+# In-process log broadcast.
+#
+# LogHub is a logging handler that keeps the most recent records in a ring
+# buffer and pushes each new record to any number of subscribers (the /ws/log
+# websockets). Records can come from any thread, so they are handed to each
+# subscriber's event loop. Every subscriber has a bounded queue: a client that
+# can't keep up loses its oldest undelivered records (and is told how many),
+# rather than holding up logging or growing without limit.
+
+LOG_BUFFER_SIZE = 5000
+SUBSCRIBER_QUEUE_SIZE = 1000
+
+TXID_PATTERN = re.compile(r'\btxid=(\S+)')
+
+# ANSI colours for the rendered text, as the Rich log file had
+LEVEL_COLORS = {
+  'DEBUG': '\x1b[2m',
+  'INFO': '\x1b[34m',
+  'WARNING': '\x1b[33m',
+  'ERROR': '\x1b[31m',
+  'CRITICAL': '\x1b[1;31m',
+}
+RESET = '\x1b[0m'
+
+class LogEntry(BaseModel):
+  seq: int
+  created: float
+  level: str
+  levelno: int
+  logger: str
+  thread: str
+  message: str
+  txid: Optional[str] = None
+  exception: Optional[str] = None
+
+  def render(self, date_format:str='%H:%M:%S') -> str:
+    '''One line (plus any traceback) with the level in colour, for a terminal.'''
+    stamp = time.strftime(date_format, time.localtime(self.created))
+    color = LEVEL_COLORS.get(self.level, '')
+    text = f'{stamp} {color}{self.level:8s}{RESET} {self.message}'
+    if self.exception:
+      text += '\n' + self.exception
+    return text + '\n'
+
+
+def parse_level(level:str) -> int:
+  '''Level name or number to a level number. ValueError if it isn't one.'''
+  if level.isdigit():
+    return int(level)
+  levelno = logging.getLevelName(level.upper())
+  if not isinstance(levelno, int):
+    raise ValueError(f'Unknown log level {level}')
+  return levelno
+
+
+def matches(entry:LogEntry, levelno:int=logging.NOTSET, txid:Optional[str]=None) -> bool:
+  return entry.levelno >= levelno and (txid is None or entry.txid == txid)
+
+
+class LogSubscription:
+  '''The records for one subscriber, read from its own event loop.'''
+
+  def __init__(self, loop:asyncio.AbstractEventLoop, levelno:int=logging.NOTSET,
+               txid:Optional[str]=None, maxsize:int=SUBSCRIBER_QUEUE_SIZE):
+    self.loop = loop
+    self.levelno = levelno
+    self.txid = txid
+    self.queue: Deque[LogEntry] = deque()
+    self.maxsize = maxsize
+    # records dropped since the last get(), because the queue was full
+    self.dropped = 0
+    self.ready = asyncio.Event()
+
+  def wants(self, entry:LogEntry) -> bool:
+    return matches(entry, self.levelno, self.txid)
+
+  def put(self, entry:LogEntry):
+    # only ever called on self.loop
+    if len(self.queue) >= self.maxsize:
+      self.queue.popleft()
+      self.dropped += 1
+    self.queue.append(entry)
+    self.ready.set()
+
+  async def get(self) -> List[LogEntry]:
+    '''Wait for records, then return all of them.'''
+    await self.ready.wait()
+    self.ready.clear()
+    entries = list(self.queue)
+    self.queue.clear()
+    return entries
+
+  def take_dropped(self) -> int:
+    dropped, self.dropped = self.dropped, 0
+    return dropped
+
+
+class LogHub(logging.Handler):
+  def __init__(self, capacity:int=LOG_BUFFER_SIZE):
+    super().__init__()
+    self.buffer: Deque[LogEntry] = deque(maxlen=capacity)
+    self.subscribers: Set[LogSubscription] = set()
+    self.seq = 0
+    self.buffer_lock = threading.Lock()
+
+  def to_entry(self, record:logging.LogRecord) -> LogEntry:
+    message = record.getMessage()
+    txid = getattr(record, 'txid', None)
+    if txid is None:
+      match = TXID_PATTERN.search(message)
+      txid = match.group(1) if match else None
+    exception = None
+    if record.exc_info:
+      exception = logging.Formatter().formatException(record.exc_info)
+    self.seq += 1
+    return LogEntry(seq=self.seq, created=record.created, level=record.levelname, levelno=record.levelno,
+                    logger=record.name, thread=record.threadName or '', message=message,
+                    txid=str(txid) if txid is not None else None, exception=exception)
+
+  def emit(self, record:logging.LogRecord):
+    try:
+      with self.buffer_lock:
+        entry = self.to_entry(record)
+        self.buffer.append(entry)
+        subscribers = list(self.subscribers)
+      for subscriber in subscribers:
+        if subscriber.wants(entry):
+          try:
+            subscriber.loop.call_soon_threadsafe(subscriber.put, entry)
+          except RuntimeError:
+            # its loop has gone away
+            with self.buffer_lock:
+              self.subscribers.discard(subscriber)
+    except Exception:
+      self.handleError(record)
+
+  def recent(self, count:int, levelno:int=logging.NOTSET, txid:Optional[str]=None) -> List[LogEntry]:
+    '''The last count records that pass the level and txid filters.'''
+    if count <= 0:
+      return []
+    with self.buffer_lock:
+      entries = [entry for entry in self.buffer if matches(entry, levelno, txid)]
+    return entries[-count:]
+
+  @contextmanager
+  def subscribe(self, replay:int=0, levelno:int=logging.NOTSET, txid:Optional[str]=None,
+                maxsize:int=SUBSCRIBER_QUEUE_SIZE) -> Iterator[LogSubscription]:
+    '''Subscribe to new records from within a running event loop, starting
+    with up to replay of the most recent ones.'''
+    subscription = LogSubscription(asyncio.get_running_loop(), levelno, txid, maxsize)
+    with self.buffer_lock:
+      # under the lock, so nothing is missed or seen twice between the replay and the first new record
+      if replay > 0:
+        for entry in [entry for entry in self.buffer if subscription.wants(entry)][-replay:]:
+          subscription.put(entry)
+      self.subscribers.add(subscription)
+    try:
+      yield subscription
+    finally:
+      with self.buffer_lock:
+        self.subscribers.discard(subscription)
+
+
+# the one hub for the whole service, installed by logconfig
+log_hub = LogHub()
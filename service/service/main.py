@@ -29,10 +29,13 @@ from starlette.background import BackgroundTask
 import httpx
 
 from service.settings import settings
-from service.endpoints import (calendar, chroma, class_diagram, configure, exec_code, graph_view, home, 
-                 inlinerefs, jsonify, logmonitor, api_docs, preload, cleanups, proxy, topics, weaviate, webhooks)
+from service.endpoints import (calendar, class_diagram, configure, exec_code, graph_view, home, 
+                 inlinerefs, jsonify, logmonitor, metrics, api_docs, cleanups, proxy, research, topics)
+from service.lazyrouter import LazyRouters
+from service.requestcontext import RequestContextMiddleware
 from service.logconfig import setup_rich_logger
-from snowflake import SnowflakeGenerator
+from service.processpool import process_pool
+from service.outbound import outbound
 from service.endpoints.api_docs import get_api_metadata
 
 log_filename = None
@@ -45,10 +48,15 @@ async def lifespan(app: FastAPI):
   logger.info("Try opening http://localhost:8000/")
   logger.info(f"Log file is {log_filename}")
   # ...do other expensive startup things here
-  # ...
+  # the shared client for calls out to other services
+  outbound.open()
+  # load webhooks in the background, to pick up any jobs left over from last time
+  lazy_routers.warm_up('service.endpoints.webhooks')
   yield # yield 
   # ... do any shutdown cleanup stuff before finishing
-  # ...
+  await lazy_routers.shutdown()
+  await outbound.close()
+  process_pool.shutdown()
 
 
 def get_app() -> FastAPI:
@@ -62,6 +70,10 @@ def get_app() -> FastAPI:
 
 app = get_app()
 
+# endpoint modules with heavy imports are only loaded when first used
+lazy_routers = LazyRouters(app)
+app.openapi = lazy_routers.openapi
+
 logger = getLogger()
 
 origins = [
@@ -82,6 +94,8 @@ app.add_middleware(
 # import our various service endpoints
 # Comment out any service you don't want here
 # and remove the import from above (line 4)
+# Endpoints with heavy imports go in lazy_routers instead, with the
+# path prefixes they serve
 
 plat = platform.system()
 if plat == 'Darwin':
@@ -89,7 +103,7 @@ if plat == 'Darwin':
 
 app.include_router(inlinerefs.router)
 app.include_router(exec_code.router)
-app.include_router(webhooks.router)
+lazy_routers.include('service.endpoints.webhooks', ['/template', '/schema', '/webhook', '/webhooks'])
 app.include_router(jsonify.router)
 app.include_router(graph_view.router)
 app.include_router(class_diagram.router)
@@ -100,14 +114,16 @@ app.include_router(proxy.router)
 app.include_router(api_docs.router)
 app.include_router(home.router)
 
-app.include_router(chroma.router)
+lazy_routers.include('service.endpoints.chroma', ['/chroma'])
 # TODO: preload is not yet ready for RAGIndex features
-app.include_router(preload.router)
-# app.include_router(research.router)
+lazy_routers.include('service.endpoints.preload', ['/chroma/preload'])
+# research loads llama_index on first use, see endpoints/research.py
+app.include_router(research.router)
 
 app.include_router(logmonitor.router)
+app.include_router(metrics.router)
 
-app.include_router(weaviate.router)
+lazy_routers.include('service.endpoints.weaviate', ['/weaviate'])
 # TODO: upgrade pinecone code
 # app.include_router(pinecone.router)
 
@@ -124,42 +140,9 @@ async def get_body(request: Request) -> bytes:
   await set_body(request, body)
   return body
 
-@app.middleware("http")
-async def add_get_authorization_headers(request: Request, call_next):
-  # find headers in request
-  x_tana_api_token = request.headers.get('x-tana-api-token')
-  x_openai_api_key = request.headers.get('x-openai-api-key')
-  # TODO: make settings per-request context, not gobal
-  # use passed in header tokens if present, otherwise look for env vars
-  settings.openai_api_key = settings.openai_api_key if not x_openai_api_key else x_openai_api_key
-  settings.tana_api_token = settings.tana_api_token if not x_tana_api_token else x_tana_api_token
-  response = await call_next(request)
-  return response
-
-snowflakes = SnowflakeGenerator(42)
-
-@app.middleware("http")
-async def log_entry_exit(request: Request, call_next):
-  x_request_id = request.headers.get('x-request-id')
-  idem = next(snowflakes) if not x_request_id else x_request_id
-  if not x_request_id:
-    id_header = (b'x-request-id', bytes(str(idem), 'utf-8'))
-    request.headers.__dict__["_list"].append(id_header)
-     
-  logger.info(f"txid={idem} start request path={request.url.path}")
-  start_time = time.time()
-
-  # await set_body(request, await request.body())
-  # body = await get_body(request)
-  # logger.info(f"txid={idem} body={body}")
-  response:Response = await call_next(request)
-
-  process_time = (time.time() - start_time) * 1000
-  formatted_process_time = '{0:.2f}'.format(process_time)
-  logger.info(f"txid={idem} completed_in={formatted_process_time}ms status_code={response.status_code}")
-  if not x_request_id:
-     response.headers['x-request-id'] = str(idem)
-  return response
+# request id, per-request credentials (x-openai-api-key and x-tana-api-token
+# headers) and timing, see requestcontext.py
+app.add_middleware(RequestContextMiddleware)
 
 
 # fiddle with the CWD to satsify double-clickable .app
@@ -0,0 +1,355 @@
+import asyncio
+import time
+from collections import OrderedDict
+from logging import getLogger
+from typing import Callable, Dict, List, Optional, Tuple
+
+import httpx
+from pydantic import BaseModel
+
+from service.settings import settings
+
+logger = getLogger()
+
+# h2 is optional. Without it, calls out are HTTP/1.1 whatever the settings say
+try:
+  import h2 # type: ignore
+except ImportError:
+  h2 = None
+
+# Outbound HTTP for the whole service.
+#
+# One shared httpx client, opened in the app's lifespan (see main.py), for
+# the calls we make to other services: the proxy, the home page content from
+# tana.pub and the Tana Input API (so webhooks too). Connections are kept
+# alive and reused across requests, and HTTP/2 can be turned on if h2 is
+# installed. Limits and timeouts come from settings (outbound_*).
+#
+# On top of httpx's limits for the whole pool, calls to any one host are
+# limited to settings.outbound_max_connections_per_host at a time, so one slow
+# service can't take every connection.
+#
+# GET responses that say they may be kept (Cache-Control max-age or
+# s-maxage, and not private, no-store or no-cache) are cached in memory for
+# that long, up to settings.outbound_cache_bytes. It's a shared cache, since
+# the service is, so responses to calls with credentials are only kept if
+# they're marked public. Anything with Vary: * or Set-Cookie isn't kept.
+# The proxy passes on whatever headers its caller sent, so a call with
+# cookies, or any header not in SAFE_REQUEST_HEADERS, isn't cached at all.
+#
+# Pool statistics are at /metrics/outbound, and in /metrics.
+
+HostKey = Tuple[str, str, Optional[int]]
+
+# at most this fraction of the cache for any one response
+MAX_ENTRY_FRACTION = 8
+
+# request headers that don't make a response particular to the caller.
+# Authorization is checked separately, see _Cache._lifetime
+SAFE_REQUEST_HEADERS = {'host', 'accept', 'accept-encoding', 'accept-language', 'accept-charset',
+                        'cache-control', 'pragma', 'connection', 'keep-alive', 'user-agent',
+                        'content-type', 'content-length', 'authorization'}
+
+# as Prometheus gauges (or counters, ending _total)
+STATS_HELP = {
+  'requests_total': 'Calls made to other services',
+  'cache_hits_total': 'Calls answered from the outbound cache',
+  'cache_misses_total': 'Cacheable calls not answered from the outbound cache',
+  'cache_stores_total': 'Responses put in the outbound cache',
+  'cache_entries': 'Responses in the outbound cache',
+  'cache_bytes': 'Bytes of responses in the outbound cache',
+  'connections': 'Connections open to other services',
+  'idle_connections': 'Connections open to other services and not in use',
+}
+
+
+class HostStats(BaseModel):
+  host: str
+  active: int
+  waiting: int
+
+
+class OutboundStats(BaseModel):
+  http2: bool
+  requests_total: int
+  cache_hits_total: int
+  cache_misses_total: int
+  cache_stores_total: int
+  cache_entries: int
+  cache_bytes: int
+  connections: int
+  idle_connections: int
+  # hosts with calls in progress
+  hosts: List[HostStats]
+
+
+def cache_control(value:Optional[str]) -> Dict[str, Optional[str]]:
+  directives = {}
+  for directive in (value or '').split(','):
+    name, _, argument = directive.strip().partition('=')
+    if name:
+      directives[name.lower()] = argument.strip('"') or None
+  return directives
+
+
+def _seconds(value:Optional[str]) -> Optional[int]:
+  try:
+    return int(value)
+  except (TypeError, ValueError):
+    return None
+
+
+class _ReleasingStream(httpx.AsyncByteStream):
+  '''A response body that calls release once it is closed.'''
+
+  def __init__(self, stream:httpx.AsyncByteStream, release:Callable[[], None]):
+    self.stream = stream
+    self.release = release
+
+  async def __aiter__(self):
+    async for chunk in self.stream:
+      yield chunk
+
+  async def aclose(self):
+    try:
+      await self.stream.aclose()
+    finally:
+      self.release()
+
+
+class _Host:
+  def __init__(self, limit:int):
+    self.slots = asyncio.Semaphore(limit)
+    self.active = 0
+    self.waiting = 0
+
+
+class _HostLimits(httpx.AsyncBaseTransport):
+  '''Limits the calls in progress to each host. A call is in progress
+  until its response is closed.'''
+
+  def __init__(self, transport:httpx.AsyncBaseTransport, per_host:int):
+    self.transport = transport
+    self.per_host = per_host
+    # only hosts with calls in progress
+    self.hosts: Dict[HostKey, _Host] = {}
+
+  async def handle_async_request(self, request:httpx.Request) -> httpx.Response:
+    key = (request.url.scheme, request.url.host, request.url.port)
+    host = self.hosts.get(key)
+    if host is None:
+      host = self.hosts[key] = _Host(self.per_host)
+
+    host.waiting += 1
+    try:
+      async with asyncio.timeout(request.extensions.get('timeout', {}).get('pool')):
+        await host.slots.acquire()
+    except BaseException as e:
+      host.waiting -= 1
+      self._forget(key, host)
+      if isinstance(e, TimeoutError):
+        raise httpx.PoolTimeout(f'Too many calls in progress to {request.url.host}', request=request) from None
+      raise
+    host.waiting -= 1
+    host.active += 1
+
+    released = False
+    def release():
+      nonlocal released
+      if released:
+        return
+      released = True
+      host.active -= 1
+      host.slots.release()
+      self._forget(key, host)
+
+    try:
+      response = await self.transport.handle_async_request(request)
+    except BaseException:
+      release()
+      raise
+    return httpx.Response(status_code=response.status_code, headers=response.headers,
+                          stream=_ReleasingStream(response.stream, release), extensions=response.extensions)
+
+  def _forget(self, key:HostKey, host:_Host):
+    if host.waiting == 0 and host.active == 0 and self.hosts.get(key) is host:
+      del self.hosts[key]
+
+  async def aclose(self):
+    await self.transport.aclose()
+
+
+class _Entry:
+  def __init__(self, response:httpx.Response, content:bytes, vary:Dict[str, Optional[str]], lifetime:float):
+    self.status_code = response.status_code
+    self.headers = [(name, value) for name, value in response.headers.multi_items() if name.lower() != 'age']
+    self.content = content
+    self.vary = vary
+    self.age = _seconds(response.headers.get('age')) or 0
+    self.stored = time.monotonic()
+    self.expires = self.stored + lifetime
+
+  def matches(self, request:httpx.Request) -> bool:
+    return all(request.headers.get(name) == value for name, value in self.vary.items())
+
+  def response(self) -> httpx.Response:
+    age = self.age + int(time.monotonic() - self.stored)
+    return httpx.Response(status_code=self.status_code, headers=self.headers + [('age', str(age))],
+                          content=self.content)
+
+
+class _Cache(httpx.AsyncBaseTransport):
+  '''A small in memory cache of GET responses, honoring Cache-Control.'''
+
+  def __init__(self, transport:httpx.AsyncBaseTransport, max_bytes:int):
+    self.transport = transport
+    self.max_bytes = max_bytes
+    self.entries: OrderedDict[str, _Entry] = OrderedDict()
+    self.bytes = 0
+    self.requests = 0
+    self.hits = 0
+    self.misses = 0
+    self.stores = 0
+
+  async def handle_async_request(self, request:httpx.Request) -> httpx.Response:
+    self.requests += 1
+    if request.method != 'GET' or self.max_bytes <= 0 or not SAFE_REQUEST_HEADERS.issuperset(request.headers.keys()):
+      return await self.transport.handle_async_request(request)
+
+    asked = cache_control(request.headers.get('cache-control'))
+    url = str(request.url)
+    if 'no-cache' not in asked and 'no-store' not in asked:
+      entry = self.entries.get(url)
+      if entry is not None and entry.expires <= time.monotonic():
+        del self.entries[url]
+        self.bytes -= len(entry.content)
+      elif entry is not None and entry.matches(request):
+        self.entries.move_to_end(url)
+        self.hits += 1
+        return entry.response()
+    self.misses += 1
+
+    response = await self.transport.handle_async_request(request)
+    lifetime = None if 'no-store' in asked else self._lifetime(request, response)
+    if lifetime is None:
+      return response
+
+    try:
+      content = await response.aread()
+    finally:
+      await response.aclose()
+    vary = {name.strip().lower(): request.headers.get(name.strip())
+            for name in response.headers.get('vary', '').split(',') if name.strip()}
+    self._store(url, _Entry(response, content, vary, lifetime))
+    return httpx.Response(status_code=response.status_code, headers=response.headers, content=content,
+                          extensions=response.extensions)
+
+  def _lifetime(self, request:httpx.Request, response:httpx.Response) -> Optional[float]:
+    '''How long the response may be kept for, None if it mayn't be.'''
+    if response.status_code != 200 or 'set-cookie' in response.headers:
+      return None
+    directives = cache_control(response.headers.get('cache-control'))
+    if {'no-store', 'no-cache', 'private'} & directives.keys():
+      return None
+    if 'authorization' in request.headers and not {'public', 's-maxage'} & directives.keys():
+      return None
+    if response.headers.get('vary', '').strip() == '*':
+      return None
+    # only ones we know are small enough, without reading them
+    length = _seconds(response.headers.get('content-length'))
+    if length is None or length > self.max_bytes // MAX_ENTRY_FRACTION:
+      return None
+    max_age = _seconds(directives.get('s-maxage', directives.get('max-age')))
+    if max_age is None:
+      return None
+    lifetime = max_age - (_seconds(response.headers.get('age')) or 0)
+    return lifetime if lifetime > 0 else None
+
+  def _store(self, url:str, entry:_Entry):
+    old = self.entries.pop(url, None)
+    if old is not None:
+      self.bytes -= len(old.content)
+    self.entries[url] = entry
+    self.bytes += len(entry.content)
+    self.stores += 1
+    while self.bytes > self.max_bytes:
+      _, evicted = self.entries.popitem(last=False)
+      self.bytes -= len(evicted.content)
+
+  async def aclose(self):
+    await self.transport.aclose()
+
+
+class Outbound:
+  '''The shared client for calls out, with its pool, limits and cache.'''
+
+  def __init__(self, transport:Optional[httpx.AsyncBaseTransport]=None):
+    # the transport to make calls with, httpx's own unless given one
+    self.transport = transport
+    self._client: Optional[httpx.AsyncClient] = None
+    self.http2 = False
+    self.pool: Optional[httpx.AsyncBaseTransport] = None
+    self.host_limits: Optional[_HostLimits] = None
+    self.cache: Optional[_Cache] = None
+
+  @property
+  def client(self) -> httpx.AsyncClient:
+    '''The shared client, opened if need be.'''
+    if self._client is None or self._client.is_closed:
+      self.open()
+    return self._client
+
+  def open(self):
+    self.http2 = settings.outbound_http2 and h2 is not None
+    if settings.outbound_http2 and h2 is None:
+      logger.warning('HTTP/2 needs the h2 package (poetry install -E http2), using HTTP/1.1 for calls out')
+    limits = httpx.Limits(max_connections=settings.outbound_max_connections,
+                          max_keepalive_connections=settings.outbound_max_keepalive,
+                          keepalive_expiry=settings.outbound_keepalive_expiry)
+    self.pool = self.transport or httpx.AsyncHTTPTransport(http2=self.http2, limits=limits)
+    self.host_limits = _HostLimits(self.pool, settings.outbound_max_connections_per_host)
+    self.cache = _Cache(self.host_limits, settings.outbound_cache_bytes)
+    self._client = httpx.AsyncClient(transport=self.cache,
+                                     timeout=httpx.Timeout(settings.outbound_timeout,
+                                                           connect=settings.outbound_connect_timeout))
+
+  async def close(self):
+    if self._client is not None:
+      await self._client.aclose()
+      self._client = None
+
+  def stats(self) -> OutboundStats:
+    connections = []
+    # httpx doesn't expose its pool, so look at httpcore's if it's there
+    pool = getattr(self.pool, '_pool', None)
+    if pool is not None:
+      connections = pool.connections
+    cache = self.cache
+    hosts = self.host_limits.hosts if self.host_limits is not None else {}
+    return OutboundStats(
+      http2=self.http2,
+      requests_total=cache.requests if cache else 0,
+      cache_hits_total=cache.hits if cache else 0,
+      cache_misses_total=cache.misses if cache else 0,
+      cache_stores_total=cache.stores if cache else 0,
+      cache_entries=len(cache.entries) if cache else 0,
+      cache_bytes=cache.bytes if cache else 0,
+      connections=len(connections),
+      idle_connections=sum(1 for connection in connections if connection.is_idle()),
+      hosts=[HostStats(host=f'{scheme}://{host}' + (f':{port}' if port else ''), active=h.active, waiting=h.waiting)
+             for (scheme, host, port), h in list(hosts.items())])
+
+  def prometheus(self) -> str:
+    '''The stats in Prometheus text exposition format.'''
+    stats = self.stats()
+    lines = []
+    for field, help in STATS_HELP.items():
+      name = f'tana_helper_outbound_{field}'
+      lines.append(f'# HELP {name} {help}')
+      lines.append(f'# TYPE {name} {"counter" if field.endswith("_total") else "gauge"}')
+      lines.append(f'{name} {getattr(stats, field)}')
+    return '\n'.join(lines) + '\n'
+
+
+# the outbound client for the whole service
+outbound = Outbound()
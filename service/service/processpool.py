@@ -0,0 +1,182 @@
+import asyncio
+import hashlib
+import itertools
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from logging import getLogger
+from multiprocessing import get_context
+from typing import Any, Callable, Optional
+
+from fastapi import HTTPException, status
+from fastapi.concurrency import run_in_threadpool
+
+from service.instrumentation import PROCESS_POOL, span
+from service.workers import process_count
+
+logger = getLogger()
+
+# CPU heavy requests in separate processes.
+#
+# Parsing a big Tana dump, building its graph or converting a large paste is
+# pure Python, so it holds the GIL. Run on the event loop (or in the
+# threadpool) it stalls every other request, including the tray app's health
+# checks. Those endpoints hand the work to the ProcessPool here instead.
+#
+# The pool is made of shards, each a single worker process:
+#
+#   - work with the same key (the hash of a Tana dump) always goes to the
+#     same shard, so the dump cache in that process (graph_pipeline.py) is
+#     still hit when a dump is POSTed again. Work without a key goes to the
+#     least busy shard
+#   - each shard runs one task at a time, and holds at most QUEUE_LIMIT
+#     tasks, running or waiting. Beyond that requests are turned away with a
+#     503 and Retry-After, rather than piling up
+#   - a task that runs for longer than TASK_TIMEOUT seconds is abandoned with
+#     a 504 and its process is killed and replaced. Time spent waiting for
+#     the shard doesn't count
+#
+# Functions run in the pool must be module level functions, and their
+# arguments and results picklable. HTTPExceptions they raise are passed back
+# to the caller.
+
+TASK_TIMEOUT = 120.0
+QUEUE_LIMIT = 16
+
+# how often pool processes check that the service is still there
+PARENT_CHECK_INTERVAL = 2.0
+
+# there's no SIGKILL on Windows, where os.kill terminates the process for any signal
+KILL_SIGNAL = getattr(signal, 'SIGKILL', signal.SIGTERM)
+
+
+def _watch_parent(parent:int):
+  # the pool processes are left behind if the service is killed outright
+  while True:
+    time.sleep(PARENT_CHECK_INTERVAL)
+    if os.getppid() != parent:
+      os._exit(0)
+
+def _start_process(parent:int, pid):
+  # tell the shard which process to kill if a task gets stuck
+  pid.value = os.getpid()
+  threading.Thread(target=_watch_parent, args=(parent,), daemon=True).start()
+
+def _call(fn:Callable, args:tuple) -> tuple:
+  # HTTPException can't be unpickled, so send back what's needed to raise it again
+  try:
+    return True, fn(*args)
+  except HTTPException as e:
+    return False, (e.status_code, e.detail, e.headers)
+
+
+def shard_key(data:bytes) -> str:
+  '''Key that sends work on the same data to the same shard.'''
+  return hashlib.sha1(data).hexdigest()
+
+
+class _Shard:
+  def __init__(self):
+    self.executor: Optional[ProcessPoolExecutor] = None
+    # of the executor's process, set by the process once it has started
+    self.pid = None
+    # tasks running or waiting
+    self.tasks = 0
+    self.lock: Optional[asyncio.Lock] = None
+    self.loop = None
+
+  def turn(self) -> asyncio.Lock:
+    # one task at a time. A lock belongs to the event loop it's used from
+    loop = asyncio.get_running_loop()
+    if self.loop is not loop:
+      self.lock, self.loop = asyncio.Lock(), loop
+    return self.lock
+
+  def process(self) -> ProcessPoolExecutor:
+    if self.executor is None:
+      # spawn, as the tray app does: forking a process with running threads isn't safe
+      context = get_context('spawn')
+      self.pid = context.RawValue('i', 0)
+      self.executor = ProcessPoolExecutor(max_workers=1, mp_context=context,
+                                          initializer=_start_process, initargs=(os.getpid(), self.pid))
+    return self.executor
+
+  def kill(self):
+    '''Kill the process, stuck on a task, and start a new one for the next.'''
+    pid = self.pid.value if self.pid is not None else 0
+    self.discard()
+    if pid:
+      try:
+        os.kill(pid, KILL_SIGNAL)
+      except OSError:
+        # already gone
+        pass
+
+  def discard(self):
+    executor, self.executor, self.pid = self.executor, None, None
+    if executor is not None:
+      executor.shutdown(wait=False, cancel_futures=True)
+
+
+class ProcessPool:
+  '''Runs CPU heavy functions in a pool of single process shards.
+  With no processes, they run in the threadpool instead.'''
+
+  def __init__(self, processes:int, queue_limit:int=QUEUE_LIMIT, timeout:float=TASK_TIMEOUT):
+    self.shards = [_Shard() for _ in range(processes)]
+    self.queue_limit = queue_limit
+    self.timeout = timeout
+    self.turns = itertools.count()
+
+  def _shard(self, key:Optional[str]) -> _Shard:
+    if key is not None:
+      return self.shards[int(key[:8], 16) % len(self.shards)]
+    # least busy, taking turns between equally busy shards
+    start = next(self.turns)
+    order = self.shards[start % len(self.shards):] + self.shards[:start % len(self.shards)]
+    return min(order, key=lambda shard: shard.tasks)
+
+  async def run(self, fn:Callable[..., Any], *args, key:Optional[str]=None) -> Any:
+    '''fn(*args) in a pool process. key picks the shard, see shard_key.'''
+    if not self.shards:
+      return await run_in_threadpool(fn, *args)
+
+    shard = self._shard(key)
+    if shard.tasks >= self.queue_limit:
+      raise HTTPException(status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                          detail='Too busy right now, try again shortly', headers={'Retry-After': '1'})
+    shard.tasks += 1
+    try:
+      async with shard.turn():
+        with span(PROCESS_POOL, function=fn.__name__):
+          future = asyncio.wrap_future(shard.process().submit(_call, fn, args))
+          try:
+            ok, result = await asyncio.wait_for(future, self.timeout)
+          except asyncio.TimeoutError:
+            logger.warning(f'{fn.__name__} took longer than {self.timeout}s, restarting its process')
+            shard.kill()
+            raise HTTPException(status_code=status.HTTP_504_GATEWAY_TIMEOUT,
+                                detail=f'Gave up after {self.timeout:.0f}s')
+          except BrokenProcessPool:
+            # killed by something other than us
+            logger.error(f'Process running {fn.__name__} died, restarting it')
+            shard.discard()
+            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                                detail='Worker process died')
+    finally:
+      shard.tasks -= 1
+
+    if not ok:
+      status_code, detail, headers = result
+      raise HTTPException(status_code=status_code, detail=detail, headers=headers)
+    return result
+
+  def shutdown(self):
+    for shard in self.shards:
+      shard.discard()
+
+
+process_pool = ProcessPool(process_count())
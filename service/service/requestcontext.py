@@ -0,0 +1,113 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging import getLogger
+from typing import Iterator, List, Optional, Tuple
+
+from snowflake import SnowflakeGenerator
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from service.instrumentation import route_path, span
+from service.settings import settings
+from service.workers import snowflake_instance
+
+logger = getLogger()
+
+# Per-request context.
+#
+# RequestContextMiddleware is a plain ASGI middleware (no BaseHTTPMiddleware,
+# so no extra task per request and streamed responses pass straight through).
+# For each HTTP request it:
+#   - takes the request id from x-request-id, or makes one up and adds it to
+#     the request and response headers
+#   - puts the request id and any x-openai-api-key / x-tana-api-token header
+#     values into context variables, visible to everything handling the request
+#     (including code run in the threadpool)
+#   - times the request as a span (see instrumentation.py) and adds a
+#     Server-Timing header with the time spent in each stage
+
+REQUEST_ID_HEADER = b'x-request-id'
+OPENAI_API_KEY_HEADER = b'x-openai-api-key'
+TANA_API_TOKEN_HEADER = b'x-tana-api-token'
+
+request_id: ContextVar[Optional[str]] = ContextVar('request_id', default=None)
+openai_api_key: ContextVar[Optional[str]] = ContextVar('openai_api_key', default=None)
+tana_api_token: ContextVar[Optional[str]] = ContextVar('tana_api_token', default=None)
+
+# txids, unique across the worker processes
+snowflakes = SnowflakeGenerator(snowflake_instance())
+
+
+def get_openai_api_key() -> str:
+  '''The OpenAI key for the current request: its x-openai-api-key header, else the configured key.'''
+  return openai_api_key.get() or settings.openai_api_key
+
+def get_tana_api_token() -> str:
+  '''The Tana API token for the current request: its x-tana-api-token header, else the configured token.'''
+  return tana_api_token.get() or settings.tana_api_token
+
+
+Credentials = Tuple[Optional[str], Optional[str]]
+
+def current_credentials() -> Credentials:
+  '''The current request's own credentials, to carry over to work done after it.'''
+  return openai_api_key.get(), tana_api_token.get()
+
+@contextmanager
+def use_credentials(credentials:Credentials) -> Iterator[None]:
+  tokens = openai_api_key.set(credentials[0]), tana_api_token.set(credentials[1])
+  try:
+    yield
+  finally:
+    openai_api_key.reset(tokens[0])
+    tana_api_token.reset(tokens[1])
+
+
+class RequestContextMiddleware:
+  def __init__(self, app:ASGIApp):
+    self.app = app
+
+  async def __call__(self, scope:Scope, receive:Receive, send:Send):
+    if scope['type'] != 'http':
+      await self.app(scope, receive, send)
+      return
+
+    txid = openai_key = tana_token = None
+    for name, value in scope['headers']:
+      if name == REQUEST_ID_HEADER:
+        txid = value.decode('latin-1')
+      elif name == OPENAI_API_KEY_HEADER:
+        openai_key = value.decode('latin-1')
+      elif name == TANA_API_TOKEN_HEADER:
+        tana_token = value.decode('latin-1')
+
+    extra_headers: List[Tuple[bytes, bytes]] = []
+    if txid is None:
+      txid = str(next(snowflakes))
+      id_header = (REQUEST_ID_HEADER, txid.encode('latin-1'))
+      # endpoints can read it from the request as before, and the client gets it back
+      scope['headers'] = [*scope['headers'], id_header]
+      extra_headers.append(id_header)
+
+    token = request_id.set(txid)
+    try:
+      with use_credentials((openai_key, tana_token)), span('request', txid=txid, method=scope['method']) as request_span:
+        async def send_with_context(message:Message):
+          if message['type'] == 'http.response.start':
+            request_span.attributes['route'] = route_path(scope)
+            request_span.attributes['status'] = message['status']
+            headers = list(message.get('headers', []))
+            headers += extra_headers
+            server_timing = request_span.server_timing()
+            if server_timing and not any(name == b'server-timing' for name, _ in headers):
+              headers.append((b'server-timing', server_timing.encode('latin-1')))
+            message = {**message, 'headers': headers}
+          await send(message)
+
+        try:
+          await self.app(scope, receive, send_with_context)
+        except Exception:
+          request_span.attributes.setdefault('route', route_path(scope))
+          request_span.attributes.setdefault('status', 500)
+          raise
+    finally:
+      request_id.reset(token)
@@ -36,6 +36,46 @@ class Settings(BaseSettings):
     description="Path to store exported files")] \
       = os.path.join('/', 'tmp','tana_helper', 'export')
 
+  proxy_max_bytes: Annotated[int, Field(title="Proxy Response Size Limit",
+    description="Largest response, in bytes, the proxy will convert to Tana format")] \
+      = 100_000_000
+
+  proxy_timeout: Annotated[float, Field(title="Proxy Timeout",
+    description="Seconds the proxy will wait for a whole response")] \
+      = 60.0
+
+  outbound_max_connections: Annotated[int, Field(title="Outbound Connection Limit",
+    description="Most connections open at once for calls out to other services")] \
+      = 100
+
+  outbound_max_connections_per_host: Annotated[int, Field(title="Outbound Connection Limit per Host",
+    description="Most calls in progress at once to any one host")] \
+      = 10
+
+  outbound_max_keepalive: Annotated[int, Field(title="Outbound Keep-Alive Connections",
+    description="Most idle connections kept open for reuse")] \
+      = 20
+
+  outbound_keepalive_expiry: Annotated[float, Field(title="Outbound Keep-Alive Expiry",
+    description="Seconds an idle connection is kept open for reuse")] \
+      = 30.0
+
+  outbound_http2: Annotated[bool, Field(title="Outbound HTTP/2",
+    description="Use HTTP/2 for calls out where the other end supports it (needs the h2 package)")] \
+      = False
+
+  outbound_connect_timeout: Annotated[float, Field(title="Outbound Connect Timeout",
+    description="Seconds to wait to connect to another service")] \
+      = 10.0
+
+  outbound_timeout: Annotated[float, Field(title="Outbound Timeout",
+    description="Seconds to wait for each read from, or write to, another service")] \
+      = 60.0
+
+  outbound_cache_bytes: Annotated[int, Field(title="Outbound Cache Size",
+    description="Bytes of cacheable GET responses to keep in memory. 0 turns caching off")] \
+      = 16_000_000
+
   tana_environment: Annotated[str, Field(title="Tana Pinecone Environment",
     description="Pinecone environment for Tana vector storage")] \
       = "us-west4-gcp-free"
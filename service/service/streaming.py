@@ -0,0 +1,88 @@
+from logging import getLogger
+from typing import AsyncIterator, Iterator, Optional, Union
+import os
+
+from starlette.concurrency import iterate_in_threadpool, run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import StreamingResponse
+
+logger = getLogger()
+
+# Streaming responses for LLM backed endpoints.
+#
+# Rather than waiting for the whole completion, endpoints hand us the text
+# as it arrives and we forward it straight on. Callers that send
+# Accept: text/event-stream get Server-Sent Events (text as 'data', progress
+# and results as named events), everyone else gets the bare text, chunked.
+
+# Conversions (see service/json2tana.py) stream their output too, from
+# files, in chunks of this many bytes.
+CHUNK_SIZE = 64 * 1024
+
+class StreamEvent:
+  '''A named event in a stream. Only sent to SSE clients.'''
+  def __init__(self, event:str, data:str=''):
+    self.event = event
+    self.data = data
+
+Chunk = Union[str, StreamEvent]
+
+
+def sse_message(data:str, event:Optional[str]=None) -> str:
+  lines = [f'event: {event}'] if event else []
+  # multi-line data goes out as one data field per line
+  lines.extend(f'data: {line}' for line in data.split('\n'))
+  return '\n'.join(lines) + '\n\n'
+
+
+def wants_sse(request:Request) -> bool:
+  return 'text/event-stream' in request.headers.get('accept', '')
+
+
+async def _chunks(source:Union[Iterator[Chunk], AsyncIterator[Chunk]]) -> AsyncIterator[Chunk]:
+  if hasattr(source, '__aiter__'):
+    async for chunk in source:
+      yield chunk
+  else:
+    # blocking iterators (OpenAI, llama_index) are pulled in the threadpool
+    async for chunk in iterate_in_threadpool(source):
+      yield chunk
+
+
+def stream_response(request:Request, source:Union[Iterator[Chunk], AsyncIterator[Chunk]]) -> StreamingResponse:
+  '''Stream text (and events) from source to the caller as they are produced.'''
+  sse = wants_sse(request)
+
+  async def body():
+    try:
+      async for chunk in _chunks(source):
+        if isinstance(chunk, StreamEvent):
+          if sse:
+            yield sse_message(chunk.data, chunk.event)
+        elif chunk:
+          yield sse_message(chunk) if sse else chunk
+    except Exception as e:
+      # too late for an error status, the response has started
+      logger.exception(f'Stream for {request.url.path} failed: {e}')
+      if sse:
+        yield sse_message(str(e), 'error')
+
+  media_type = 'text/event-stream' if sse else 'text/plain; charset=utf-8'
+  # ask proxies not to buffer us
+  headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+  return StreamingResponse(body(), media_type=media_type, headers=headers)
+
+
+async def file_chunks(path:str, remove:bool=False, size:int=CHUNK_SIZE) -> AsyncIterator[bytes]:
+  '''Reads a file in chunks, in the threadpool. If remove, the file is
+  deleted once it has been read (or the reader has given up).'''
+  try:
+    with open(path, 'rb') as f:
+      while True:
+        chunk = await run_in_threadpool(f.read, size)
+        if not chunk:
+          break
+        yield chunk
+  finally:
+    if remove:
+      os.remove(path)
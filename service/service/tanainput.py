@@ -0,0 +1,214 @@
+import asyncio
+import time
+import httpx
+from email.utils import parsedate_to_datetime
+from logging import getLogger
+from typing import Dict, List, Optional, Tuple, Union
+
+from service.dependencies import Node
+from service.outbound import outbound
+from service.requestcontext import get_tana_api_token
+
+logger = getLogger()
+
+# Async client for the Tana Input API (addToNodeV2).
+#
+# Calls go out through the service's shared client (see outbound.py).
+# Nodes added to the same target (with the same token) within a short window
+# are coalesced into a single addToNodeV2 call, since the API is rate limited
+# per token and each call can carry many nodes. Calls are spaced out per
+# token and callers are made to wait once too many nodes are pending.
+# addToNodeV2 isn't idempotent, so a call is only retried (with backoff) when
+# we know the nodes weren't added: a 429 (honoring Retry-After), or failing
+# to connect. A 5xx or a timeout waiting for the response may come after
+# the nodes went in, so those are surfaced rather than risk adding them
+# twice. Unless given a token, calls use the current request's (see
+# requestcontext.py), so requests from different users are batched and rate
+# limited separately.
+
+TANA_INPUT_API = "https://europe-west1-tagr-prod.cloudfunctions.net/addToNodeV2"
+
+class TanaInputAPIError(Exception):
+  def __init__(self, status_code:int, detail:str):
+    super().__init__(f'Tana Input API error {status_code}: {detail}')
+    self.status_code = status_code
+    self.detail = detail
+
+
+class _Batch:
+  def __init__(self):
+    self.nodes: List[dict] = []
+    self.waiters: List[asyncio.Future] = []
+    # the [start, end) of each waiter's nodes in nodes
+    self.spans: List[Tuple[int, int]] = []
+    self.flusher: Optional[asyncio.TimerHandle] = None
+
+
+def _retry_after(response:httpx.Response) -> Optional[float]:
+  value = response.headers.get('retry-after')
+  if not value:
+    return None
+  try:
+    return max(float(value), 0.0)
+  except ValueError:
+    pass
+  try:
+    return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+  except (TypeError, ValueError):
+    return None
+
+
+class AsyncTanaInputAPIClient:
+  def __init__(self,
+               url:str = TANA_INPUT_API,
+               window:float = 0.25,
+               max_batch:int = 100,
+               min_interval:float = 1.0,
+               max_retries:int = 4,
+               backoff:float = 1.0,
+               max_pending:int = 1000,
+               timeout:float = 30.0):
+    self.url = url
+    # how long to wait for more nodes before sending a batch
+    self.window = window
+    # the API limits how many nodes one call may carry
+    self.max_batch = max_batch
+    # the API is rate limited per token
+    self.min_interval = min_interval
+    self.max_retries = max_retries
+    self.backoff = backoff
+    self.max_pending = max_pending
+    self.timeout = timeout
+    # the shared outbound client, unless given one
+    self.client: Optional[httpx.AsyncClient] = None
+    self.batches: Dict[Tuple[str, Optional[str]], _Batch] = {}
+    self.pending = 0
+    self.space: Optional[asyncio.Condition] = None
+    self.token_locks: Dict[str, asyncio.Lock] = {}
+    self.last_call: Dict[str, float] = {}
+    # keep references to in flight sends, so they aren't garbage collected
+    self.tasks = set()
+
+  def _client(self) -> httpx.AsyncClient:
+    return self.client if self.client is not None else outbound.client
+
+  async def add_nodes(self, nodes:List[Union[Node, dict]], target_node_id:Optional[str]=None,
+                      auth_token:Optional[str]=None) -> httpx.Response:
+    '''Add nodes under target_node_id (the Inbox if None), using auth_token or else the
+    current request's token. Returns the response of the (possibly shared) addToNodeV2 call.'''
+    if auth_token is None:
+      auth_token = get_tana_api_token()
+    payload = [node.model_dump(exclude_unset=True) if isinstance(node, Node) else node for node in nodes]
+    if not payload:
+      raise ValueError('No nodes to add')
+
+    # backpressure: wait for room if too many nodes are already pending
+    if self.space is None:
+      self.space = asyncio.Condition()
+    async with self.space:
+      await self.space.wait_for(lambda: self.pending < self.max_pending)
+      self.pending += len(payload)
+
+    key = (auth_token, target_node_id)
+    batch = self.batches.get(key)
+    if batch is None:
+      batch = self.batches[key] = _Batch()
+    batch.spans.append((len(batch.nodes), len(batch.nodes) + len(payload)))
+    batch.nodes.extend(payload)
+    waiter = asyncio.get_running_loop().create_future()
+    batch.waiters.append(waiter)
+
+    if len(batch.nodes) >= self.max_batch:
+      self._flush(key)
+    elif batch.flusher is None:
+      batch.flusher = asyncio.get_running_loop().call_later(self.window, self._flush, key)
+
+    return await waiter
+
+  async def add_to_inbox(self, request_data, auth_token:Optional[str]=None) -> httpx.Response:
+    '''Add an AddToNodeRequest's nodes, batched with other calls'''
+    return await self.add_nodes(request_data.nodes, request_data.targetNodeId, auth_token)
+
+  def _flush(self, key):
+    batch = self.batches.pop(key, None)
+    if batch is None:
+      return
+    if batch.flusher is not None:
+      batch.flusher.cancel()
+    task = asyncio.create_task(self._send(key, batch))
+    self.tasks.add(task)
+    task.add_done_callback(self.tasks.discard)
+
+  async def _send(self, key, batch:_Batch):
+    auth_token, target_node_id = key
+    headers = {'Content-Type': 'application/json'}
+    if auth_token:
+      headers['Authorization'] = f'Bearer {auth_token}'
+
+    try:
+      # a batch bigger than max_batch goes out in several calls. Each caller
+      # gets the result of the call(s) carrying its own nodes
+      results = []
+      for start in range(0, len(batch.nodes), self.max_batch):
+        end = min(start + self.max_batch, len(batch.nodes))
+        body = {'nodes': batch.nodes[start:end]}
+        if target_node_id:
+          body['targetNodeId'] = target_node_id
+        try:
+          response = await self._post(auth_token, body, headers)
+          result = TanaInputAPIError(response.status_code, response.text) if response.is_error else response
+        except Exception as e:
+          result = e
+        results.append((start, end, result))
+      logger.debug(f'Tana Input API sent {len(batch.nodes)} nodes in {len(results)} calls for {len(batch.waiters)} callers')
+
+      for waiter, (first, last) in zip(batch.waiters, batch.spans):
+        if waiter.done():
+          continue
+        mine = [result for start, end, result in results if start < last and first < end]
+        error = next((result for result in mine if isinstance(result, Exception)), None)
+        if error is not None:
+          waiter.set_exception(error)
+        else:
+          waiter.set_result(mine[-1])
+    finally:
+      async with self.space:
+        self.pending -= len(batch.nodes)
+        self.space.notify_all()
+
+  async def _post(self, auth_token:str, body:dict, headers:dict) -> httpx.Response:
+    lock = self.token_locks.setdefault(auth_token, asyncio.Lock())
+    attempt = 0
+    while True:
+      # one call at a time per token, spaced out by min_interval
+      async with lock:
+        wait = self.last_call.get(auth_token, 0.0) + self.min_interval - time.monotonic()
+        if wait > 0:
+          await asyncio.sleep(wait)
+        try:
+          response = await self._client().post(self.url, json=body, headers=headers, timeout=self.timeout)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+          # never reached the API, so safe to try again
+          response = None
+          if attempt >= self.max_retries:
+            raise
+          logger.warning(f'Tana Input API call failed ({e}), retrying')
+        finally:
+          self.last_call[auth_token] = time.monotonic()
+
+      if response is not None:
+        if response.status_code != 429 or attempt >= self.max_retries:
+          return response
+        delay = _retry_after(response)
+        logger.warning('Tana Input API rate limited, retrying')
+      else:
+        delay = None
+
+      if delay is None:
+        delay = self.backoff * (2 ** attempt)
+      attempt += 1
+      await asyncio.sleep(delay)
+
+
+# shared client for the whole service
+tana_input = AsyncTanaInputAPIClient()
@@ -40,8 +40,17 @@ class NodeIndex(BaseModel):
   trash: dict[str, NodeDump] = {}
   tags: dict[str, str] = {}
   tag_colors: dict[str, str] = {}
+  # field definitions by id -> name, and the fields of each tag (by tag id)
+  field_defs: dict[str, str] = {}
+  tag_fields: dict[str, List[str]] = {}
   master_pairs: List[tuple[str, str, str]] = []
   config: Visualizer = Visualizer()
+  # what we work out about each node, by node id. Kept here rather than on
+  # the NodeDumps, since the dump may be shared (see graph_pipeline.py)
+  node_tags: dict[str, List[str]] = {}
+  node_colors: dict[str, str] = {}
+  node_fields: dict[str, List[dict]] = {}
+  node_content: dict[str, List[str]] = {}
 
   # populate an index of all the nodes in the tana dump, including trash
   def build_index(self):
@@ -75,6 +84,21 @@ class NodeIndex(BaseModel):
   
   def node(self, node_id:str):
     return self.index[node_id]
+
+  # tags of a node (supertags, for a tag)
+  def tags_of(self, node_id:str) -> List[str]:
+    return self.node_tags.get(node_id, [])
+
+  def color_of(self, node_id:str) -> str|None:
+    return self.node_colors.get(node_id)
+
+  # fields of a node, as {"field": field_id, "values": value_ids}
+  def fields_of(self, node_id:str) -> List[dict]:
+    return self.node_fields.get(node_id, [])
+
+  # child content of a node
+  def content_of(self, node_id:str) -> List[str]:
+    return self.node_content.get(node_id, [])
   
   def build_indices(self):
     self.build_index()
@@ -82,6 +106,9 @@ class NodeIndex(BaseModel):
 
   # look for tags and build a tag index
   def build_tag_index(self):
+    # (tag_id, field_id) for tuples hanging off tag definitions. We only know
+    # which of these are fields once we have seen all the field definitions
+    tag_tuples = []
     for node in self.tana_dump.docs:
 
       # skip trashed nodes
@@ -111,7 +138,7 @@ class NodeIndex(BaseModel):
                             continue
                           if self.valid(child_id):
                             supertag = self.index[child_id]
-                            tag_node.tags.append(supertag.id)
+                            self.node_tags.setdefault(tag_id, []).append(supertag.id)
                             # print (f'TAG {tag_name} -> {supertag.props.name}')
                             if self.config.include_tag_tag_links:
                               self.master_pairs.append((tag_id, child_id, IS_TAG_TAG_LINK))
@@ -126,9 +153,12 @@ class NodeIndex(BaseModel):
                   # print(f'Found tag_id {tag_id}, name {trashed_node.props.name} in the TRASH')
 
           elif FIELD in node.children:
-            # found field tuple
-            # TODO handle fields similiarly to tags
-            continue
+            # found field tuple, which makes the owner of its meta node a field definition
+            if node.props.ownerId and self.valid(node.props.ownerId):
+              meta_node:NodeDump = self.index[node.props.ownerId]
+              field_id = meta_node.props.ownerId
+              if field_id and self.valid(field_id):
+                self.field_defs[field_id] = self.index[field_id].props.name
           
         # doi we have a tag color specifier?
         elif COLOR_SPEC in node.children:
@@ -147,7 +177,36 @@ class NodeIndex(BaseModel):
               tag_id = meta_node.props.ownerId
               if color and tag_id and self.valid(tag_id):
                 self.tag_colors[tag_id] = color
-                self.index[tag_id].color = color
+                self.node_colors[tag_id] = color
+
+        # tuples owned by a tag definition are the tag's fields (and their defaults)
+        elif node.props.docType == 'tuple' and node.props.ownerId and self.valid(node.props.ownerId):
+          if self.index[node.props.ownerId].props.docType == 'tagDef':
+            tag_tuples.append((node.props.ownerId, node.children[0]))
+
+    # now we know all the field definitions, keep the tuples that are fields
+    for tag_id, field_id in tag_tuples:
+      if field_id in self.field_defs:
+        self.tag_fields.setdefault(tag_id, []).append(field_id)
+
+  # fields of a tag including those inherited from its supertags, as
+  # (field_id, tag_id) where tag_id is the tag that defines the field
+  def all_tag_fields(self, tag_id:str) -> List[tuple[str, str]]:
+    result = []
+    seen_fields = set()
+    seen_tags = set()
+    pending = [tag_id]
+    while pending:
+      current = pending.pop(0)
+      if current in seen_tags or not self.valid(current):
+        continue
+      seen_tags.add(current)
+      for field_id in self.tag_fields.get(current, []):
+        if field_id not in seen_fields:
+          seen_fields.add(field_id)
+          result.append((field_id, current))
+      pending.extend(self.tags_of(current))
+    return result
 
   def build_master_pairs(self):
     # Find all the pairs we care about to build our graph viz
@@ -175,7 +234,6 @@ class NodeIndex(BaseModel):
               if not self.trashed(data_node_id):
                 logger.warning(f'Found tag tuple {node.id} with missing data node {data_node_id}')
             elif data_node_id and self.valid(data_node_id):
-              data_node:NodeDump = self.node(data_node_id)
               # now create a link from the tag node to the data node
               # for every child that isn't SYS_A13
               for tag_id in tag_ids:
@@ -186,10 +244,10 @@ class NodeIndex(BaseModel):
                   if self.config.include_node_tag_links:
                     self.master_pairs.append((data_node_id, tag_id, IS_TAG_LINK))
                     # collect the tags...
-                    data_node.tags.append(tag_id)
+                    self.node_tags.setdefault(data_node_id, []).append(tag_id)
                   # also apply the color of the tag...
                   if tag_id in self.tag_colors:
-                    data_node.color = self.tag_colors[tag_id]
+                    self.node_colors[data_node_id] = self.tag_colors[tag_id]
                   else:
                     # tag from another workspace...must be?
                     pass
@@ -226,62 +284,81 @@ class NodeIndex(BaseModel):
       # what to do with children of regular nodes? Too much graph structure, not enough meaning
       # BUT, we probably want nodes that are tagged and are subnodes of other tagged nodes
       # to be included as a link from the child tagged node to the parent tagged node
-      if self.config.include_content_nodes and node.children and 'Root node for file:' not in name and 'SYS' not in node.id:
-        for child_id in node.children:
-          if self.valid(child_id) and SUPERTAG not in child_id and FIELD not in child_id and 'SYS' not in child_id:
-            child_node = self.node(child_id)
-
-            if child_node.props.docType == 'tuple':
-              # tuples are fields
-              if child_node.children:
-                if len(child_node.children) < 2:
-                  continue
-                # field definition itself is the first child
-                field_id = child_node.children[0]
-                # values are all the rest...
-                value_ids = child_node.children[1:]
-                if self.valid(field_id):
-                  node.fields.append({"field": field_id, "values": value_ids})
-                  # TODO field linkages have extra ID (value_id)
-                  linkage = (node.id, field_id, IS_FIELD_CONTENT_LINK)
-                  self.master_pairs.append(linkage)
-            elif child_node.props.docType == 'search':
-              # we don't want to expand search nodes...
-              # TODO: revisit this decision
-              continue
-            elif child_node.props.docType == 'viewDef':
-              # we don't want to expand viewDef nodes...
-              # TODO: revisit this decision
-              continue
-            elif child_node.props.docType == 'associatedData':
-              # we don't want to expand associated data nodes...
-              # TODO: revisit this decision
-              continue
+      if self.config.include_content_nodes:
+        self.add_content_pairs(node)
+    
+    return self.master_pairs
+
+  # links from a node to its child content and fields
+  def add_content_pairs(self, node:NodeDump):
+    if node.children and 'Root node for file:' not in node.props.name and 'SYS' not in node.id:
+      for child_id in node.children:
+        if self.valid(child_id) and SUPERTAG not in child_id and FIELD not in child_id and 'SYS' not in child_id:
+          child_node = self.node(child_id)
+
+          if child_node.props.docType == 'tuple':
+            # tuples are fields
+            if child_node.children:
+              if len(child_node.children) < 2:
+                continue
+              # field definition itself is the first child
+              field_id = child_node.children[0]
+              # values are all the rest...
+              value_ids = child_node.children[1:]
+              if self.valid(field_id):
+                self.node_fields.setdefault(node.id, []).append({"field": field_id, "values": value_ids})
+                # TODO field linkages have extra ID (value_id)
+                linkage = (node.id, field_id, IS_FIELD_CONTENT_LINK)
+                self.master_pairs.append(linkage)
+          elif child_node.props.docType == 'search':
+            # we don't want to expand search nodes...
+            # TODO: revisit this decision
+            continue
+          elif child_node.props.docType == 'viewDef':
+            # we don't want to expand viewDef nodes...
+            # TODO: revisit this decision
+            continue
+          elif child_node.props.docType == 'associatedData':
+            # we don't want to expand associated data nodes...
+            # TODO: revisit this decision
+            continue
+          else:
+            if child_node.props.ownerId != node.id:
+              # this is a child reference, not an owned child
+              linkage = (node.id, child_id, IS_CHILD_REF_LINK)
             else:
-              if child_node.props.ownerId != node.id:
-                # this is a child reference, not an owned child
-                linkage = (node.id, child_id, IS_CHILD_REF_LINK)
-              else:
-                linkage = (node.id, child_id, IS_CHILD_CONTENT_LINK)
+              linkage = (node.id, child_id, IS_CHILD_CONTENT_LINK)
 
-              self.master_pairs.append(linkage)
-              node.content.append(child_id)
-    
+            self.master_pairs.append(linkage)
+            self.node_content.setdefault(node.id, []).append(child_id)
+
+  # content links on their own, for an index built without include_content_nodes.
+  # Only call this once per index, since it adds to the pairs and content
+  def build_content_pairs(self):
+    node: NodeDump
+    for node in self.tana_dump.docs:
+      if self.trashed(node.id):
+        continue
+      self.add_content_pairs(node)
+    # there are more links to look up now
+    self.link_index = None
     return self.master_pairs
   
   link_index: dict[str, dict]|None = None
 
   def get_linkage_reason(self, source_id:str, target_id:str) -> str:
+    # built once we have all the pairs, so build the pairs first
     if self.link_index is None:
-      self.link_index = {}
+      link_index = {}
       for link in self.master_pairs:
-        if link[0] not in self.link_index:
+        if link[0] not in link_index:
           index = {}
-          self.link_index[link[0]] = index
+          link_index[link[0]] = index
         else:
-          index = self.link_index[link[0]]
+          index = link_index[link[0]]
 
         index[link[1]] = link[2]
+      self.link_index = link_index
     
     return self.link_index[source_id][target_id]
 
@@ -1,5 +1,8 @@
+from contextlib import contextmanager
 from time import perf_counter
+from threading import Lock
 from logging import getLogger
+from service.instrumentation import span
 
 logger = getLogger()
 
@@ -9,11 +12,39 @@ class txntimer:
     self.txnid = request.headers["x-request-id"]
 
   def __enter__(self):
-    self.start = perf_counter()
-    logger.info(f'DO txid={self.txnid}')
+    # timed as a stage of the request, see instrumentation.py
+    self.timer = span('transaction', txid=self.txnid)
+    self.span = self.timer.__enter__()
+    logger.debug(f'DO txid={self.txnid}')
     return self
 
   def __exit__(self, type, value, traceback):
-    duration = perf_counter() - self.start
-    formatted_process_time = '{0:.2f}'.format(duration)
-    logger.info(f'DONE txid={self.txnid} time={formatted_process_time}')
+    self.timer.__exit__(type, value, traceback)
+    logger.debug(f'DONE txid={self.txnid} time={self.span.duration:.2f}')
+
+
+class StageTimings:
+  '''Time spent in each stage of a request, reported as a Server-Timing header.
+  Stages that run several times (or in parallel threads) add up.'''
+
+  def __init__(self) -> None:
+    self.durations = {}
+    self.lock = Lock()
+
+  @contextmanager
+  def stage(self, name:str):
+    # also a span, so stages show up in the latency histograms
+    with span(name):
+      start = perf_counter()
+      try:
+        yield
+      finally:
+        self.add(name, perf_counter() - start)
+
+  def add(self, name:str, seconds:float):
+    with self.lock:
+      self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+  def server_timing(self) -> str:
+    with self.lock:
+      return ', '.join(f'{name};dur={seconds * 1000.0:.1f}' for name, seconds in self.durations.items())
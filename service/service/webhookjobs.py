@@ -0,0 +1,224 @@
+import asyncio
+import os
+import sqlite3
+import time
+import uuid
+from collections import deque
+from logging import getLogger
+from threading import Lock
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from fastapi import HTTPException
+from pydantic import BaseModel
+from service.instrumentation import span
+from service.requestcontext import Credentials, current_credentials, use_credentials
+from service.workers import BOOT_ID
+
+logger = getLogger()
+
+# Background processing for webhooks.
+#
+# A webhook can take 10-40s (prompt render, GPT-4, Tana Input API) which is
+# longer than many callers are willing to wait. In background mode we store
+# the payload as a job, answer 202 with the job id straight away, and let a
+# small pool of workers process jobs in order. Jobs live in a sqlite database
+# so anything still queued (or interrupted mid-flight) is picked up again
+# after a restart.
+#
+# With several worker processes (see service/workers.py) every process runs
+# its own workers over the same database. A job is claimed by atomically
+# moving it from queued to running, so only one process runs it. Each running
+# job records the boot id of the processes that claimed it, so on startup
+# only jobs from an earlier boot are treated as interrupted.
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+# finished jobs are kept around for status queries, for a while
+JOB_RETENTION = 7 * 24 * 60 * 60
+
+# latencies kept per schema for percentiles
+METRICS_WINDOW = 200
+
+class WebhookJob(BaseModel):
+  id: str
+  schema_name: str
+  status: str
+  created: float
+  started: Optional[float] = None
+  finished: Optional[float] = None
+  status_code: Optional[int] = None
+  result: Optional[str] = None
+  error: Optional[str] = None
+
+class SchemaMetrics(BaseModel):
+  submitted: int = 0
+  completed: int = 0
+  failed: int = 0
+  # jobs per minute over the last minute
+  throughput: float = 0.0
+  # time spent queued, and processing, in ms
+  mean_wait_ms: float = 0.0
+  mean_latency_ms: float = 0.0
+  p50_latency_ms: float = 0.0
+  p95_latency_ms: float = 0.0
+
+
+class _SchemaStats:
+  def __init__(self):
+    self.submitted = 0
+    self.completed = 0
+    self.failed = 0
+    self.waits = deque(maxlen=METRICS_WINDOW)
+    self.latencies = deque(maxlen=METRICS_WINDOW)
+    self.finished = deque(maxlen=METRICS_WINDOW)
+
+  def metrics(self) -> SchemaMetrics:
+    now = time.time()
+    latencies = sorted(self.latencies)
+    def percentile(p):
+      return latencies[min(int(p * len(latencies)), len(latencies) - 1)] * 1000.0 if latencies else 0.0
+    return SchemaMetrics(submitted=self.submitted,
+                         completed=self.completed,
+                         failed=self.failed,
+                         throughput=float(sum(1 for t in self.finished if now - t <= 60.0)),
+                         mean_wait_ms=sum(self.waits) / len(self.waits) * 1000.0 if self.waits else 0.0,
+                         mean_latency_ms=sum(latencies) / len(latencies) * 1000.0 if latencies else 0.0,
+                         p50_latency_ms=percentile(0.5),
+                         p95_latency_ms=percentile(0.95))
+
+
+class WebhookJobQueue:
+  '''Persistent job queue with a bounded pool of async workers.
+  process(schema, body) does the actual work and returns the result.'''
+
+  def __init__(self, db_path:str, process:Callable[[str, str], Awaitable[bytes]], workers:int=4):
+    self.db_path = db_path
+    self.process = process
+    self.worker_count = workers
+    self.workers: List[asyncio.Task] = []
+    self.queue: Optional[asyncio.Queue] = None
+    # the credentials each queued job's request came with. Only in memory, so
+    # jobs resumed after a restart use the configured credentials
+    self.credentials: Dict[str, Credentials] = {}
+    self.stats: Dict[str, _SchemaStats] = {}
+    self.db: Optional[sqlite3.Connection] = None
+    self.db_lock = Lock()
+
+  def _execute(self, sql:str, params=()) -> List[tuple]:
+    with self.db_lock:
+      if self.db is None:
+        os.makedirs(os.path.dirname(self.db_path), exist_ok=True)
+        self.db = sqlite3.connect(self.db_path, check_same_thread=False, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('''CREATE TABLE IF NOT EXISTS jobs (
+                            id TEXT PRIMARY KEY, schema_name TEXT, body TEXT, status TEXT,
+                            created REAL, started REAL, finished REAL,
+                            status_code INTEGER, result TEXT, error TEXT)''')
+        self.db.execute('CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)')
+        columns = [row[1] for row in self.db.execute('PRAGMA table_info(jobs)')]
+        if 'boot' not in columns:
+          # databases from before multiple worker processes
+          self.db.execute('ALTER TABLE jobs ADD COLUMN boot TEXT')
+      return self.db.execute(sql, params).fetchall()
+
+  def _stats(self, schema:str) -> _SchemaStats:
+    if schema not in self.stats:
+      self.stats[schema] = _SchemaStats()
+    return self.stats[schema]
+
+  async def start(self):
+    '''Start the workers and pick up any jobs left over from last time.'''
+    if self.queue is not None:
+      return
+    self.queue = asyncio.Queue()
+    # anything that was running when we stopped gets another go. Not jobs other
+    # worker processes started along with this one are running right now
+    self._execute('UPDATE jobs SET status=?, started=NULL WHERE status=? AND (boot IS NULL OR boot!=?)',
+                  (QUEUED, RUNNING, BOOT_ID))
+    self._execute('DELETE FROM jobs WHERE status IN (?, ?) AND finished < ?',
+                  (DONE, FAILED, time.time() - JOB_RETENTION))
+    pending = self._execute('SELECT id FROM jobs WHERE status=? ORDER BY created', (QUEUED,))
+    for (job_id,) in pending:
+      self.queue.put_nowait(job_id)
+    if pending:
+      logger.info(f'Resuming {len(pending)} queued webhook jobs')
+    self.workers = [asyncio.create_task(self._worker()) for _ in range(self.worker_count)]
+
+  async def stop(self):
+    for worker in self.workers:
+      worker.cancel()
+    await asyncio.gather(*self.workers, return_exceptions=True)
+    self.workers = []
+    self.queue = None
+    with self.db_lock:
+      if self.db is not None:
+        self.db.close()
+        self.db = None
+
+  async def submit(self, schema:str, body:str) -> WebhookJob:
+    await self.start()
+    # every worker process adds to the one jobs table, so random ids
+    job = WebhookJob(id=uuid.uuid4().hex, schema_name=schema, status=QUEUED, created=time.time())
+    self._execute('INSERT INTO jobs (id, schema_name, body, status, created) VALUES (?, ?, ?, ?, ?)',
+                  (job.id, schema, body, QUEUED, job.created))
+    self._stats(schema).submitted += 1
+    self.credentials[job.id] = current_credentials()
+    self.queue.put_nowait(job.id)
+    return job
+
+  def get(self, job_id:str) -> Optional[WebhookJob]:
+    rows = self._execute('''SELECT id, schema_name, status, created, started, finished, status_code, result, error
+                            FROM jobs WHERE id=?''', (job_id,))
+    if not rows:
+      return None
+    fields = ['id', 'schema_name', 'status', 'created', 'started', 'finished', 'status_code', 'result', 'error']
+    return WebhookJob(**dict(zip(fields, rows[0])))
+
+  def metrics(self) -> Dict[str, SchemaMetrics]:
+    return {schema: stats.metrics() for schema, stats in self.stats.items()}
+
+  async def _worker(self):
+    while True:
+      job_id = await self.queue.get()
+      try:
+        await self._run(job_id)
+      except Exception as e:
+        logger.exception(f'Webhook job {job_id} crashed: {e}')
+      finally:
+        self.queue.task_done()
+
+  async def _run(self, job_id:str):
+    credentials = self.credentials.pop(job_id, (None, None))
+    started = time.time()
+    # claim the job, unless another worker process got there first
+    rows = self._execute('''UPDATE jobs SET status=?, started=?, boot=? WHERE id=? AND status=?
+                            RETURNING schema_name, body, created''', (RUNNING, started, BOOT_ID, job_id, QUEUED))
+    if not rows:
+      return
+    schema, body, created = rows[0]
+    stats = self._stats(schema)
+    stats.waits.append(started - created)
+
+    status, status_code, result, error = DONE, 200, None, None
+    try:
+      with use_credentials(credentials), span('webhook_job'):
+        content = await self.process(schema, body)
+      result = content.decode('utf-8', errors='replace') if isinstance(content, bytes) else str(content)
+    except HTTPException as e:
+      status, status_code, error = FAILED, e.status_code, str(e.detail)
+    except Exception as e:
+      status, status_code, error = FAILED, 500, str(e)
+
+    finished = time.time()
+    self._execute('UPDATE jobs SET status=?, finished=?, status_code=?, result=?, error=? WHERE id=?',
+                  (status, finished, status_code, result, error, job_id))
+    stats.latencies.append(finished - started)
+    stats.finished.append(finished)
+    if status == DONE:
+      stats.completed += 1
+    else:
+      stats.failed += 1
+      logger.warning(f'Webhook job {job_id} for {schema} failed: {error}')
@@ -0,0 +1,193 @@
+import asyncio
+import json
+import os
+import re
+from logging import getLogger
+from threading import Lock
+from typing import Dict, List, Optional, Tuple
+
+from jinja2 import Environment, Template, TemplateSyntaxError
+from pydantic import BaseModel, ValidationError
+
+logger = getLogger()
+
+# In-memory registry of webhook schemas.
+#
+# Each schema is a prompt template (<schema>.jn2) in the webhook template
+# folder, plus optional settings (<schema>.settings.json). We load and compile
+# them all once, keep them up to date as they are saved or deleted through
+# the API, and rescan the folder every few seconds to catch templates edited
+# by hand (only files whose mtime changed are recompiled). Webhook dispatch
+# is then just a dict lookup, with no filesystem access.
+
+TEMPLATE_SUFFIX = '.jn2'
+SETTINGS_SUFFIX = '.settings.json'
+
+# pattern to strip URLs out of incoming text
+DEFAULT_URL_PATTERN = r'\(?"?http[^\t ")]*"?\)?'
+
+# how often (seconds) to look for templates changed outside tana-helper
+REFRESH_INTERVAL = 5.0
+
+class SchemaSettings(BaseModel):
+  model: str = 'gpt-4'
+  max_tokens: int = 1000
+  # incoming text is cut to this many characters, after URLs are stripped
+  max_context: int = 6000
+  url_pattern: str = DEFAULT_URL_PATTERN
+
+
+class WebhookSchema:
+  '''A compiled webhook schema, ready to render prompts.'''
+
+  def __init__(self, name:str, source:str, template:Template, settings:SchemaSettings,
+               mtimes:Tuple[Optional[int], Optional[int]]):
+    self.name = name
+    self.source = source
+    self.template = template
+    self.settings = settings
+    self.url_regex = re.compile(settings.url_pattern)
+    # (template, settings) file mtimes this was loaded from
+    self.mtimes = mtimes
+
+  def render(self, body:str) -> str:
+    context = self.url_regex.sub('', body)[0:self.settings.max_context]
+    return self.template.render({'context': context})
+
+
+class SchemaRegistry:
+  def __init__(self, path:str):
+    self.path = path
+    self.environment = Environment()
+    # replaced wholesale on change, so readers never need the lock
+    self.schemas: Dict[str, WebhookSchema] = {}
+    self.lock = Lock()
+    self.refresher: Optional[asyncio.Task] = None
+
+  def template_file(self, name:str) -> str:
+    return os.path.join(self.path, name + TEMPLATE_SUFFIX)
+
+  def settings_file(self, name:str) -> str:
+    return os.path.join(self.path, name + SETTINGS_SUFFIX)
+
+  def get(self, name:str) -> Optional[WebhookSchema]:
+    return self.schemas.get(name)
+
+  def names(self) -> List[str]:
+    return sorted(self.schemas)
+
+  def _compile(self, name:str, source:str, settings:SchemaSettings,
+               mtimes:Tuple[Optional[int], Optional[int]]) -> WebhookSchema:
+    return WebhookSchema(name, source, self.environment.from_string(source), settings, mtimes)
+
+  def _read_settings(self, name:str) -> SchemaSettings:
+    try:
+      with open(self.settings_file(name), 'r') as settings_file:
+        return SchemaSettings.model_validate(json.load(settings_file))
+    except FileNotFoundError:
+      return SchemaSettings()
+    except (ValueError, ValidationError) as e:
+      logger.warning(f'Ignoring invalid settings for schema {name}: {e}')
+      return SchemaSettings()
+
+  def _load(self, name:str, mtimes:Tuple[Optional[int], Optional[int]]) -> Optional[WebhookSchema]:
+    try:
+      with open(self.template_file(name), 'r') as template_file:
+        source = template_file.read()
+      return self._compile(name, source, self._read_settings(name), mtimes)
+    except (IOError, TemplateSyntaxError) as e:
+      logger.warning(f'Failed to load template {self.template_file(name)}: {e}')
+      return None
+
+  def refresh(self):
+    '''Bring the registry in line with the template folder.'''
+    mtimes = {}
+    try:
+      with os.scandir(self.path) as entries:
+        for entry in entries:
+          if not entry.is_file():
+            continue
+          if entry.name.endswith(SETTINGS_SUFFIX):
+            name = entry.name[:-len(SETTINGS_SUFFIX)]
+            mtimes[name] = (mtimes.get(name, (None, None))[0], entry.stat().st_mtime_ns)
+          elif entry.name.endswith(TEMPLATE_SUFFIX):
+            name = entry.name[:-len(TEMPLATE_SUFFIX)]
+            mtimes[name] = (entry.stat().st_mtime_ns, mtimes.get(name, (None, None))[1])
+    except FileNotFoundError:
+      pass
+
+    with self.lock:
+      schemas = {}
+      for name, file_mtimes in mtimes.items():
+        if file_mtimes[0] is None:
+          # settings without a template
+          continue
+        current = self.schemas.get(name)
+        if current is not None and current.mtimes == file_mtimes:
+          schemas[name] = current
+          continue
+        loaded = self._load(name, file_mtimes)
+        if loaded is not None:
+          schemas[name] = loaded
+          logger.debug(f'Loaded webhook schema {name}')
+      self.schemas = schemas
+
+  def _mtimes(self, name:str) -> Tuple[Optional[int], Optional[int]]:
+    def mtime(file):
+      try:
+        return os.stat(file).st_mtime_ns
+      except FileNotFoundError:
+        return None
+    return (mtime(self.template_file(name)), mtime(self.settings_file(name)))
+
+  def save_template(self, name:str, source:str) -> WebhookSchema:
+    '''Compile and store a template. Raises TemplateSyntaxError if it won't compile.'''
+    # what the file will hold
+    source = source + '\n'
+    template = self.environment.from_string(source)
+    os.makedirs(self.path, exist_ok=True)
+    with open(self.template_file(name), 'w') as template_file:
+      template_file.write(source)
+    with self.lock:
+      schema = WebhookSchema(name, source, template, self._read_settings(name), self._mtimes(name))
+      self.schemas = {**self.schemas, name: schema}
+    return schema
+
+  def save_settings(self, name:str, settings:SchemaSettings) -> WebhookSchema:
+    '''Store the settings for an existing schema. Raises KeyError for unknown schemas.'''
+    # fail on bad patterns before writing them
+    re.compile(settings.url_pattern)
+    with self.lock:
+      current = self.schemas[name]
+      with open(self.settings_file(name), 'w') as settings_file:
+        settings_file.write(settings.model_dump_json(indent=2))
+      schema = WebhookSchema(name, current.source, current.template, settings, self._mtimes(name))
+      self.schemas = {**self.schemas, name: schema}
+    return schema
+
+  def remove(self, name:str):
+    '''Delete a schema and its settings. Raises FileNotFoundError if there is no template.'''
+    with self.lock:
+      self.schemas = {key: value for key, value in self.schemas.items() if key != name}
+      if os.path.exists(self.settings_file(name)):
+        os.remove(self.settings_file(name))
+      os.remove(self.template_file(name))
+
+  async def start(self, interval:float=REFRESH_INTERVAL):
+    self.refresh()
+    if self.refresher is None:
+      self.refresher = asyncio.create_task(self._refresh_loop(interval))
+
+  async def stop(self):
+    if self.refresher is not None:
+      self.refresher.cancel()
+      await asyncio.gather(self.refresher, return_exceptions=True)
+      self.refresher = None
+
+  async def _refresh_loop(self, interval:float):
+    while True:
+      await asyncio.sleep(interval)
+      try:
+        await asyncio.to_thread(self.refresh)
+      except Exception as e:
+        logger.warning(f'Failed to refresh webhook schemas: {e}')
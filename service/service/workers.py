@@ -0,0 +1,67 @@
+import os
+import uuid
+from typing import Optional, Tuple
+
+# How the service is being run.
+#
+# myuvicorn.ServiceWorker can run several worker processes behind one socket.
+# It tells the workers about it through these environment variables, which
+# they inherit:
+#
+#   TANA_HELPER_WORKERS        how many worker processes there are
+#   TANA_HELPER_CHROMA_SERVER  host:port of the Chroma server all workers share,
+#                              since only one process may write the Chroma files
+#   TANA_HELPER_BOOT_ID        the same in every worker started together, so
+#                              that on startup one worker can tell another's
+#                              in-flight work from work interrupted last time
+#
+# and one that can be set by hand:
+#
+#   TANA_HELPER_PROCESSES      processes each worker runs CPU heavy requests
+#                              in (see service/processpool.py). 0 runs them in
+#                              the worker's threadpool instead
+
+WORKERS_ENV = 'TANA_HELPER_WORKERS'
+CHROMA_SERVER_ENV = 'TANA_HELPER_CHROMA_SERVER'
+BOOT_ID_ENV = 'TANA_HELPER_BOOT_ID'
+PROCESSES_ENV = 'TANA_HELPER_PROCESSES'
+
+# where Chroma keeps its files, whether opened directly or by the Chroma server
+CHROMA_DB_PATH = os.path.join(os.path.expanduser('~'), '.chroma.db')
+
+# a single process (the default) gets its own boot id
+BOOT_ID = os.environ.get(BOOT_ID_ENV) or uuid.uuid4().hex
+
+# snowflake-id takes instances 0 to 1022
+SNOWFLAKE_INSTANCES = 1023
+
+
+def snowflake_instance() -> int:
+  '''Snowflake id generator instance for this process, so workers started
+  together (with consecutive pids) don't make the same ids.'''
+  return os.getpid() % SNOWFLAKE_INSTANCES
+
+
+def worker_count() -> int:
+  try:
+    return max(int(os.environ.get(WORKERS_ENV, '1')), 1)
+  except ValueError:
+    return 1
+
+
+def chroma_server() -> Optional[Tuple[str, int]]:
+  '''(host, port) of the shared Chroma server, if there is one.'''
+  server = os.environ.get(CHROMA_SERVER_ENV)
+  if not server:
+    return None
+  host, _, port = server.rpartition(':')
+  return host, int(port)
+
+
+def process_count() -> int:
+  '''Size of each worker's process pool. By default the cores are shared
+  out between the workers.'''
+  try:
+    return max(int(os.environ[PROCESSES_ENV]), 0)
+  except (KeyError, ValueError):
+    return max((os.cpu_count() or 1) // worker_count(), 1)
@@ -29,9 +29,6 @@ from myuvicorn import STATUS_STOPPING, ServiceWorker, STATUS_CHECK_INTERVAL_MS,
 
 # from myuvicorn import ServiceWorker, STATUS_CHECK_INTERVAL_MS, STATUS_STARTING, STATUS_UP, STATUS_DOWN
 
-# these imports are to satisfy PyInstaller's dependency finder
-# since they appear to be "hidden" from it for unknown reasons
-import onnxruntime, tokenizers, tqdm
 from message import message, os_platform
 
 import logging
@@ -40,6 +40,11 @@ datas += [
 # chromadb, llamindex and ollama need things that aren't detected
 # automatically by pyinstaller
 hidden_imports += ['hnswlib', 'tiktoken_ext.openai_public', 'tiktoken_ext', 'llama_index']
+# these used to be imported by tanahelper.py just for the dependency finder,
+# which cost the tray app their import time on every start
+hidden_imports += ['onnxruntime', 'tokenizers', 'tqdm']
+# the Chroma server run in multi-worker mode, see myuvicorn.py
+hidden_imports += ['chromadb.app']
 
 for meta in ['opentelemetry-sdk', 'tqdm', 'regex', 'requests', 'llama_index']:
   datas += copy_metadata(meta)
@@ -0,0 +1,20 @@
+import json
+from benchmarks.synthetic import make_dump
+from service.endpoints.class_diagram import build_class_graph
+from service.graph_pipeline import parse_dump
+
+
+def test_class_graph_has_fields_and_inheritance():
+  entry = parse_dump(json.dumps(make_dump(200, 8, 10, 1, 2, 5)).encode())
+  graph = build_class_graph(entry)
+  classes = {node.id: node for node in graph.nodes}
+  # every synthetic tag defines three fields of its own
+  assert all(len([f for f in classes[f'tag{t}'].fields if f.inherited_from is None]) == 3 for t in range(8))
+  subclasses = [node for node in graph.nodes if node.extends]
+  assert subclasses
+  for node in subclasses:
+    supertag = classes[node.extends[0]]
+    own = {field.id for field in node.fields if field.inherited_from is None}
+    inherited = {field.id for field in node.fields if field.inherited_from == supertag.id}
+    # inherits the supertag's fields it doesn't define itself
+    assert inherited == {field.id for field in supertag.fields if field.inherited_from is None} - own
@@ -0,0 +1,84 @@
+import asyncio
+import os
+import tempfile
+import time
+from types import SimpleNamespace
+import pytest
+from fastapi import HTTPException
+from openai.types.chat import ChatCompletion, ChatCompletionMessage
+from openai.types.chat.chat_completion import Choice
+from service import dependencies
+from service.completioncache import CompletionCache, completion_key
+from service.dependencies import OpenAICompletion, completion_cache_key, get_chatcompletion
+from service.endpoints import webhooks
+
+
+def completion(content, finish_reason='stop'):
+  return ChatCompletion(id='c1', created=0, model='gpt-4', object='chat.completion',
+                        choices=[Choice(index=0, finish_reason=finish_reason,
+                                        message=ChatCompletionMessage(role='assistant', content=content))])
+
+def test_key_depends_on_model_prompt_and_params():
+  key = completion_key('gpt-4', 'prompt', max_tokens=1000, temperature=0)
+  assert key == completion_key('gpt-4', 'prompt', temperature=0, max_tokens=1000)
+  assert key != completion_key('gpt-3.5-turbo', 'prompt', max_tokens=1000, temperature=0)
+  assert key != completion_key('gpt-4', 'prompt!', max_tokens=1000, temperature=0)
+  assert key != completion_key('gpt-4', 'prompt', max_tokens=500, temperature=0)
+
+def test_hits_misses_and_lru_eviction():
+  with tempfile.TemporaryDirectory() as tmp:
+    cache = CompletionCache(os.path.join(tmp, 'cache.db'), max_entries=2)
+    assert cache.get('a') is None
+    cache.put('a', completion('A'))
+    cache.put('b', completion('B'))
+    assert cache.get('a').choices[0].message.content == 'A'
+    # b is now the least recently used
+    time.sleep(0.01)
+    cache.put('c', completion('C'))
+    assert cache.get('b') is None
+    assert cache.get('c').choices[0].message.content == 'C'
+
+    stats = cache.stats()
+    assert (stats.entries, stats.hits, stats.misses, stats.evictions) == (2, 2, 2, 1)
+    assert stats.hit_rate == 0.5
+
+    # survives a restart
+    reopened = CompletionCache(os.path.join(tmp, 'cache.db'))
+    assert reopened.get('a').choices[0].message.content == 'A'
+
+def test_entries_expire():
+  with tempfile.TemporaryDirectory() as tmp:
+    cache = CompletionCache(os.path.join(tmp, 'cache.db'), ttl=0.05)
+    cache.put('a', completion('A'))
+    assert cache.get('a') is not None
+    time.sleep(0.1)
+    assert cache.get('a') is None
+    assert cache.stats().entries == 0
+
+
+@pytest.fixture
+def cache(monkeypatch):
+  with tempfile.TemporaryDirectory() as tmp:
+    cache = CompletionCache(os.path.join(tmp, 'cache.db'))
+    monkeypatch.setattr(dependencies, 'completion_cache', cache)
+    monkeypatch.setattr(webhooks, 'completion_cache', cache)
+    yield cache
+
+def fake_openai(monkeypatch, answers):
+  create = lambda **kwargs: answers.pop(0)
+  client = SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create)))
+  monkeypatch.setattr(dependencies, 'get_openai_client', lambda: client)
+
+def test_only_whole_completions_are_cached(monkeypatch, cache):
+  request = OpenAICompletion(prompt='p', model='gpt-4', max_tokens=10, temperature=0)
+  fake_openai(monkeypatch, [completion('"cut', 'length'), completion('"whole": 1}')])
+  assert get_chatcompletion(request).choices[0].finish_reason == 'length'
+  assert cache.get(completion_cache_key(request)) is None
+  get_chatcompletion(request)
+  assert get_chatcompletion(request).choices[0].message.content == '"whole": 1}'
+
+def test_completion_webhook_cant_parse_is_dropped(cache):
+  cache.put('k', completion('"name": '))
+  with pytest.raises(HTTPException):
+    asyncio.run(webhooks.add_to_tana(cache.get('k').choices[0].message.content, 'k'))
+  assert cache.get('k') is None
@@ -0,0 +1,35 @@
+import json
+from benchmarks.synthetic import make_dump
+from service.graph_pipeline import links, parse_dump
+from service.graphops import dedupe_edges, encode_pairs
+from service.tana_types import TanaDump, Visualizer
+from service.tanaparser import NodeIndex
+
+
+def direct_links(body, config):
+  index = NodeIndex(tana_dump=TanaDump.model_validate_json(body), config=config)
+  index.build_indices()
+  index.build_master_pairs()
+  return dedupe_edges(encode_pairs(index.master_pairs, index.index)).pairs()
+
+def test_pipeline_matches_direct_index_for_each_config():
+  body = json.dumps(make_dump(500, 5, 5, 2, 3, 3)).encode()
+  entry = parse_dump(body)
+  assert parse_dump(body) is entry
+  configs = [Visualizer(),
+             Visualizer(include_inline_refs=False, include_node_tag_links=False, include_tag_schema_links=True),
+             Visualizer(include_content_nodes=True, include_inline_ref_nodes=False)]
+  for config in configs:
+    # content links come from a separate pass, so only the order may differ
+    assert sorted(links(entry, config).pairs()) == sorted(direct_links(body, config))
+
+def test_index_leaves_the_dump_alone():
+  body = json.dumps(make_dump(500, 5, 5, 2, 3, 3)).encode()
+  tana_dump = TanaDump.model_validate_json(body)
+  before = tana_dump.model_dump()
+  for _ in range(2):
+    index = NodeIndex(tana_dump=tana_dump, config=Visualizer(include_content_nodes=True))
+    index.build_indices()
+    index.build_master_pairs()
+    assert index.node_tags and index.node_content
+  assert tana_dump.model_dump() == before
@@ -0,0 +1,80 @@
+import gzip
+import json
+import numpy as np
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from benchmarks.synthetic import make_dump
+from service import graphcodec
+from service.endpoints import graph_view
+from service.graphcodec import GRAPH_MEDIA_TYPE, compress, decode_graph, encode_graph
+from service.processpool import ProcessPool
+
+
+def round_trip(payload, accept_encoding):
+  content, encoding = compress(payload, accept_encoding)
+  if encoding == 'br':
+    return graphcodec.brotli.decompress(content), encoding
+  if encoding == 'gzip':
+    return gzip.decompress(content), encoding
+  return content, encoding
+
+@pytest.mark.parametrize('accept_encoding, expected', [(None, None), ('gzip', 'gzip'), ('br', 'br')])
+def test_encode_decode_round_trip(accept_encoding, expected):
+  if expected == 'br':
+    pytest.importorskip('brotli')
+  ids = ['a', 'ü', '节点', 'x' * 3]
+  names = ['A', 'Ünïcödé "quoted"', '名字 🌳', None]
+  colors = ['red', None, 'blue', None]
+  source = np.array([0, 1, 2], dtype=np.int64)
+  target = np.array([1, 2, 3], dtype=np.int64)
+  reason = np.array([0, 1, 0], dtype=np.uint8)
+  x = np.array([0.5, -1, 2, 3], dtype=np.float32)
+  payload = encode_graph(ids, names, colors, ['itl', 'icl'], source, target, reason,
+                         extra_arrays={'x': ('float32', x)})
+  decoded, encoding = round_trip(payload, accept_encoding)
+  assert encoding == expected and decoded == payload
+  header, arrays = decode_graph(decoded)
+  assert (header['ids'], header['names'], header['colors']) == (ids, names, colors)
+  assert (header['node_count'], header['link_count'], header['reasons']) == (4, 3, ['itl', 'icl'])
+  assert arrays['source'].tolist() == [0, 1, 2] and arrays['target'].tolist() == [1, 2, 3]
+  assert arrays['reason'].tolist() == [0, 1, 0] and arrays['x'].tolist() == x.tolist()
+
+def test_empty_graph_round_trip():
+  empty = np.zeros(0, dtype=np.int64)
+  header, arrays = decode_graph(encode_graph([], [], [], [], empty, empty, empty))
+  assert (header['node_count'], header['link_count']) == (0, 0)
+  assert [len(values) for values in arrays.values()] == [0, 0, 0]
+
+def test_gzip_without_brotli(monkeypatch):
+  monkeypatch.setattr(graphcodec, 'brotli', None)
+  assert compress(b'graph', 'br, gzip')[1] == 'gzip'
+  assert compress(b'graph', 'br') == (b'graph', None)
+
+def test_not_a_graph():
+  with pytest.raises(ValueError):
+    decode_graph(b'{"nodes": []}')
+
+
+app = FastAPI()
+app.include_router(graph_view.router)
+client = TestClient(app)
+
+def test_graph_honours_accept(monkeypatch):
+  monkeypatch.setattr(graph_view, 'process_pool', ProcessPool(0))
+  body = json.dumps(make_dump(200, 5, 5, 1, 2, 3)).encode()
+  graph = client.post('/graph', content=body)
+  assert graph.headers['content-type'] == 'application/json'
+
+  binary = client.post('/graph', content=body, headers={'Accept': GRAPH_MEDIA_TYPE, 'Accept-Encoding': 'gzip'})
+  assert binary.headers['content-type'] == GRAPH_MEDIA_TYPE
+  assert binary.headers['content-encoding'] == 'gzip'
+  assert binary.headers['vary'] == 'Accept, Accept-Encoding'
+  # the client has already gunzipped it
+  header, arrays = decode_graph(binary.content)
+  nodes = graph.json()['nodes']
+  assert header['ids'] == [node['id'] for node in nodes]
+  assert header['names'] == [node['name'] for node in nodes]
+  ids = header['ids']
+  assert [(ids[source], ids[target]) for source, target in zip(arrays['source'], arrays['target'])] == \
+    [(link['source'], link['target']) for link in graph.json()['links']]
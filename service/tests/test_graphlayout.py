@@ -0,0 +1,72 @@
+import numpy as np
+from service import graphlayout
+from service.graphlayout import LayoutCache, _warm_start, cached_layout, force_layout
+from service.settings import settings
+
+
+def ring(n):
+  src = np.arange(n)
+  dst = (src + 1) % n
+  return src, dst
+
+def test_layout_pulls_linked_nodes_together():
+  src, dst = ring(200)
+  pos = force_layout(src, dst, 200, dim=3, iterations=60)
+  assert pos.shape == (200, 3)
+  assert np.isfinite(pos).all()
+  linked = np.linalg.norm(pos[src] - pos[dst], axis=1).mean()
+  spread = np.linalg.norm(pos[src] - pos[(src + 100) % 200], axis=1).mean()
+  assert linked * 3 < spread
+
+def test_warm_start_keeps_known_positions():
+  src, dst = ring(4)
+  previous = np.arange(8, dtype=np.float32).reshape(4, 2)
+  pos, reused = _warm_start(['a', 'b', 'c', 'new'], src, dst, 2, ['c', 'b', 'a', 'gone'], previous)
+  assert reused == 0.75
+  assert (pos[0] == previous[2]).all() and (pos[2] == previous[0]).all()
+  # the new node starts near its placed neighbors 'c' and 'a'
+  assert np.linalg.norm(pos[3] - (previous[0] + previous[2]) / 2) < 100
+
+def test_big_graphs_get_fewer_iterations_or_none(monkeypatch, tmp_path):
+  monkeypatch.setattr(settings, 'temp_files', str(tmp_path))
+  monkeypatch.setattr(graphlayout, 'layout_cache', LayoutCache())
+  # room for 50 iterations of a 200 node ring (a 2x2x2 grid)
+  monkeypatch.setattr(graphlayout, 'LAYOUT_WORK_BUDGET', 200 * 8 * 50)
+  run = []
+  def counted(*args, **kwargs):
+    run.append(args[4])
+    return force_layout(*args, **kwargs)
+  monkeypatch.setattr(graphlayout, 'force_layout', counted)
+
+  src, dst = ring(200)
+  ids = [str(code) for code in range(200)]
+  assert cached_layout('w', ids, src, dst, 3, 120).shape == (200, 3)
+  assert run == [50]
+  src, dst = ring(1000)
+  assert cached_layout('w', [str(code) for code in range(1000)], src, dst, 3, 120) is None
+  assert run == [50]
+
+def test_filtered_views_keep_their_layouts(monkeypatch, tmp_path):
+  monkeypatch.setattr(settings, 'temp_files', str(tmp_path))
+  monkeypatch.setattr(graphlayout, 'layout_cache', LayoutCache())
+  run = []
+  def counted(*args, **kwargs):
+    run.append(args[4])
+    return force_layout(*args, **kwargs)
+  monkeypatch.setattr(graphlayout, 'force_layout', counted)
+
+  # two views of one workspace, say with and without a tag filter
+  src, dst = ring(60)
+  whole = [str(code) for code in range(60)]
+  filtered = [str(code) for code in range(0, 120, 2)]
+  first = cached_layout('w', whole, src, dst, 3, 40)
+  cached_layout('w', filtered, src, dst, 3, 40)
+  assert len(run) == 2
+  assert (cached_layout('w', whole, src, dst, 3, 40) == first).all()
+  assert len(run) == 2
+
+  # and still there after a restart
+  monkeypatch.setattr(graphlayout, 'layout_cache', LayoutCache())
+  assert (cached_layout('w', whole, src, dst, 3, 40) == first).all()
+  cached_layout('w', filtered, src, dst, 3, 40)
+  assert len(run) == 2
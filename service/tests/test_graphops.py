@@ -0,0 +1,60 @@
+import numpy as np
+from service.graphops import (collapse_leaves, connected_components, cooccurrence, dedupe_edges, degrees, encode_pairs, neighborhood, node_mask,
+                              pagerank, top_nodes, unique_undirected_pairs)
+
+
+def test_dedupe_removes_duplicate_and_reversed_links():
+  pairs = [
+    ('a', 'b', 'itl'),
+    ('b', 'a', 'itl'),   # reversed duplicate
+    ('a', 'b', 'itl'),   # exact duplicate
+    ('b', 'a', 'iir'),   # different reason, keep
+    ('c', 'c', 'icl'),
+    ('c', 'c', 'icl'),
+  ]
+  result = unique_undirected_pairs(pairs)
+  # first occurrence wins, with its original direction and order
+  assert result == [('a', 'b', 'itl'), ('b', 'a', 'iir'), ('c', 'c', 'icl')]
+
+def test_encode_with_node_table_drops_unknown_nodes():
+  pairs = [('a', 'b', 'itl'), ('a', 'missing', 'itl'), ('b', 'c', 'iir')]
+  edges = encode_pairs(pairs, ['a', 'b', 'c'])
+  assert edges.pairs() == [('a', 'b', 'itl'), ('b', 'c', 'iir')]
+  assert [edges.node_ids[code] for code in edges.linked_nodes()] == ['a', 'b', 'c']
+
+def test_empty_pairs():
+  edges = dedupe_edges(encode_pairs([]))
+  assert len(edges) == 0
+  assert edges.pairs() == []
+
+def test_neighborhood_and_top_nodes():
+  # a - b - c - d, plus e - b
+  edges = encode_pairs([('a', 'b', 'r'), ('b', 'c', 'r'), ('c', 'd', 'r'), ('e', 'b', 'r')])
+  seeds = node_mask(edges, [edges.node_ids.index('a')])
+  near = neighborhood(edges, seeds, 2)
+  assert sorted(edges.node_ids[code] for code in np.flatnonzero(near)) == ['a', 'b', 'c', 'e']
+  best = top_nodes(degrees(edges), node_mask(edges, edges.linked_nodes()), 1)
+  assert [edges.node_ids[code] for code in np.flatnonzero(best)] == ['b']
+  ranks = pagerank(edges)
+  assert ranks.argmax() == edges.node_ids.index('b')
+  assert abs(ranks.sum() - 1.0) < 1e-6
+
+def test_collapse_leaves_counts_into_parent():
+  edges = encode_pairs([('a', 'b', 'r'), ('b', 'c', 'r'), ('c', 'd', 'r'), ('e', 'b', 'r')])
+  remaining, collapsed = collapse_leaves(edges)
+  assert remaining.pairs() == [('b', 'c', 'r')]
+  assert collapsed[edges.node_ids.index('b')] == 2
+  assert collapsed[edges.node_ids.index('c')] == 1
+
+def test_connected_components():
+  edges = encode_pairs([('a', 'b', 'r'), ('c', 'd', 'r'), ('d', 'e', 'r'), ('f', 'e', 'r')])
+  labels = connected_components(edges)
+  groups = {}
+  for node_id, label in zip(edges.node_ids, labels.tolist()):
+    groups.setdefault(label, set()).add(node_id)
+  assert sorted(groups.values(), key=len) == [{'a', 'b'}, {'c', 'd', 'e', 'f'}]
+
+def test_tag_cooccurrence():
+  # node 0 has tags 5, 6, 7; node 1 has 5, 6; node 2 has 5 (twice)
+  first, second, counts = cooccurrence(np.array([0, 0, 0, 1, 1, 2, 2]), np.array([5, 6, 7, 5, 6, 5, 5]))
+  assert list(zip(first.tolist(), second.tolist(), counts.tolist())) == [(5, 6, 2), (5, 7, 1), (6, 7, 1)]
@@ -0,0 +1,87 @@
+import asyncio
+import random
+from fastapi import FastAPI
+from fastapi.concurrency import run_in_threadpool
+from fastapi.testclient import TestClient
+from service.instrumentation import (REQUEST_SECONDS, STAGE_SECONDS, Histogram, Metrics, bucket_index, bucket_range,
+                                     metrics, route_path, span)
+
+
+def test_buckets_cover_values_within_resolution():
+  for micros in [0, 1, 15, 16, 17, 31, 32, 1000, 123_456, 59_000_000]:
+    low, high = bucket_range(bucket_index(micros))
+    assert low <= micros < high
+    assert high - low <= max(1, low / 16)
+  # increasing values never go to an earlier bucket
+  indices = [bucket_index(micros) for micros in range(0, 5000)]
+  assert indices == sorted(indices)
+
+def test_histogram_quantiles():
+  histogram = Histogram()
+  values = [random.uniform(0.001, 2.0) for _ in range(10_000)]
+  for value in values:
+    histogram.record(value)
+  values.sort()
+  for q in (0.5, 0.9, 0.99):
+    exact = values[int(q * len(values)) - 1]
+    assert abs(histogram.quantile(q) - exact) / exact < 0.07
+  assert histogram.count_below(0.5) <= sum(1 for value in values if value <= 0.5)
+  assert histogram.count_below(100.0) == histogram.count
+
+def test_prometheus_format():
+  registry = Metrics()
+  registry.observe(REQUEST_SECONDS, 0.02, route='/webhook/{schema}', method='POST', status='200')
+  registry.observe(REQUEST_SECONDS, 0.2, route='/webhook/{schema}', method='POST', status='200')
+  text = registry.prometheus()
+  assert '# TYPE tana_helper_request_seconds histogram' in text
+  labels = 'method="POST",route="/webhook/{schema}",status="200"'
+  assert f'tana_helper_request_seconds_bucket{{{labels},le="0.025"}} 1' in text
+  assert f'tana_helper_request_seconds_bucket{{{labels},le="+Inf"}} 2' in text
+  assert f'tana_helper_request_seconds_count{{{labels}}} 2' in text
+
+def test_stages_recorded_with_request_route():
+  async def run():
+    with span('request', method='GET') as request:
+      with span('embedding'):
+        pass
+      # stages in the threadpool belong to the request too
+      def in_thread():
+        with span('llm'):
+          pass
+      await run_in_threadpool(in_thread)
+      request.attributes.update(route='/test/stages', status=200)
+    return request
+  metrics.reset()
+  request = asyncio.run(run())
+  assert [child.name for child in request.walk()] == ['embedding', 'llm']
+  assert request.server_timing().startswith('embedding;dur=')
+  assert metrics.histogram(REQUEST_SECONDS, route='/test/stages', method='GET', status='200').count == 1
+  assert metrics.histogram(STAGE_SECONDS, route='/test/stages', stage='embedding').count == 1
+  assert metrics.histogram(STAGE_SECONDS, route='/test/stages', stage='llm').count == 1
+
+def test_metrics_endpoint():
+  from service.endpoints import metrics as metrics_endpoint
+  app = FastAPI()
+  app.include_router(metrics_endpoint.router)
+
+  @app.get('/items/{item}')
+  def item(item:str):
+    return route_path(scope_holder[0])
+
+  scope_holder = []
+  @app.middleware('http')
+  async def record(request, call_next):
+    scope_holder[:] = [request.scope]
+    with span('request', method=request.method) as request_span:
+      response = await call_next(request)
+      request_span.attributes.update(route=route_path(request.scope), status=response.status_code)
+    return response
+
+  metrics.reset()
+  client = TestClient(app)
+  assert client.get('/items/1').json() == '/items/{item}'
+  client.get('/items/2')
+  assert 'route="/items/{item}",status="200"} 2' in client.get('/metrics').text
+  latency = client.get('/metrics/latency').json()
+  assert any(entry['labels'].get('route') == '/items/{item}' and entry['count'] == 2 for entry in latency)
+  assert client.delete('/metrics').status_code == 204
@@ -0,0 +1,127 @@
+import asyncio
+import json
+import random
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from benchmarks.bench_json2tana import code_paste, deep_paste, legacy_tana_to_json, shallow_paste
+from benchmarks.bench_tanify import legacy_json_to_tana, make_json
+from service.endpoints import jsonify
+from service.json2tana import json_to_tana, tana_lines, tana_to_json
+from service.processpool import ProcessPool
+from service.settings import settings
+
+# bits of lines, including the odd ones the parser has always accepted
+NAMES = ['node', 'a [[ref^abc]] #tag', 'name:: shadowed', 'children:: x', 'children::', 'field::',
+         'field:: value', 'a::b::c', ':: no name', '--> arrow', 'with - dash', 'trailing   ']
+CODE = ['```', '```python', '  indented code', 'code - with dash', 'x = 1  ']
+
+def random_paste(rng):
+  lines = []
+  for _ in range(rng.randrange(1, 25)):
+    kind = rng.random()
+    indent = ' ' * rng.choice([0, 0, 2, 2, 4, 4, 6, 8, 1, 3])
+    if kind < 0.7:
+      lines.append(indent + rng.choice(['- ', '- ', '- ', '-', '', '- - ']) + rng.choice(NAMES))
+    elif kind < 0.85:
+      lines.append(indent + rng.choice(CODE))
+    else:
+      lines.append(rng.choice(['', '-', '   ', '  -']))
+  return '\n'.join(lines)
+
+def outcome(convert, paste):
+  try:
+    return convert(paste)
+  except Exception as e:
+    return type(e)
+
+def test_matches_original_on_random_pastes():
+  rng = random.Random(7)
+  for _ in range(5000):
+    paste = random_paste(rng)
+    assert outcome(tana_to_json, paste) == outcome(legacy_tana_to_json, paste), paste
+
+@pytest.mark.parametrize('make_paste', [shallow_paste, deep_paste, code_paste])
+def test_matches_original_on_benchmark_pastes(make_paste):
+  paste = make_paste(50_000)
+  assert tana_to_json(paste) == legacy_tana_to_json(paste)
+
+def test_fields_and_code_blocks():
+  paste = '\n'.join(['- Person #person', '  - Name:: Jo', '  - Address::', '    - City:: Paris',
+                     '  - Friends::', '    - Al', '    - Bo', '  - Snippet::', '```', 'x = 1', '```', '  - child'])
+  assert tana_to_json(paste) == [{'name': 'Person #person', 'Name': 'Jo', 'Address': {'City': 'Paris'},
+                                  'Friends': [{'name': 'Al'}, {'name': 'Bo'}], 'Snippet': '```\nx = 1\n```\n',
+                                  'children': [{'name': 'child'}]}]
+
+def test_deep_outline_without_recursion():
+  depth = 20_000
+  paste = '\n'.join('  ' * level + f'- level {level}' for level in range(depth))
+  node = tana_to_json(paste)[0]
+  for level in range(1, depth):
+    node = node['children'][0]
+  assert node == {'name': f'level {depth - 1}'}
+
+# and the other way, including the odd shapes that have always failed
+STRINGS = ['node', 'a [[ref^abc]]', '```<br>code<br>  indented<br>```', 'x<br><br>y', '']
+
+def random_json(rng, depth=0):
+  kind = rng.random()
+  if depth > 4 or kind < 0.3:
+    return rng.choice(STRINGS + [None, 1, ['```']])
+  if kind < 0.45:
+    return [random_json(rng, depth + 1) for _ in range(rng.randrange(4))]
+  obj = {}
+  for _ in range(rng.randrange(4)):
+    key = rng.choice(['name', 'name', 'children', 'children', 'Field', 'Other'])
+    obj[key] = random_json(rng, depth + 1)
+  return obj
+
+def test_json_to_tana_matches_original_on_random_json():
+  rng = random.Random(11)
+  for _ in range(5000):
+    json_format = random_json(rng)
+    assert outcome(json_to_tana, json_format) == outcome(legacy_json_to_tana, json_format), json_format
+
+def test_json_to_tana_matches_original_on_benchmark_json():
+  json_format = make_json(200_000)
+  expected = legacy_json_to_tana(json_format)
+  assert json_to_tana(json_format) == expected
+  assert ''.join(tana_lines(json_format)) == expected
+
+def test_deep_json_without_recursion():
+  depth = 20_000
+  node = {'name': 'leaf'}
+  for level in range(depth):
+    node = {'name': f'level {level}', 'Field': {'name': 'value'}, 'children': [node]}
+  lines = json_to_tana(node).splitlines()
+  assert lines[-1] == ' ' * (2 * depth) + '- leaf'
+  assert len(lines) == 3 * depth + 1
+
+
+def test_tanify_removes_its_file(tmp_path, monkeypatch):
+  monkeypatch.setattr(jsonify, 'process_pool', ProcessPool(0))
+  monkeypatch.setattr(settings, 'temp_files', str(tmp_path))
+  app = FastAPI()
+  app.include_router(jsonify.router)
+  body = json.dumps(make_json(5000))
+
+  response = TestClient(app).post('/tanify', content=body, headers={'Content-Type': 'text/plain'})
+  assert response.status_code == 200 and response.text
+  assert list(tmp_path.iterdir()) == []
+
+  # the client goes while the start of the response is still being sent
+  async def disconnect_early():
+    messages = [{'type': 'http.request', 'body': body.encode(), 'more_body': False}]
+    async def receive():
+      if messages:
+        return messages.pop(0)
+      return {'type': 'http.disconnect'}
+    async def send(message):
+      await asyncio.Event().wait()
+    scope = {'type': 'http', 'http_version': '1.1', 'method': 'POST', 'path': '/tanify', 'raw_path': b'/tanify',
+             'root_path': '', 'scheme': 'http', 'query_string': b'', 'headers': [(b'content-type', b'text/plain')], 'server': ('test', 80),
+             'client': ('test', 1)}
+    await app(scope, receive, send)
+
+  asyncio.run(disconnect_early())
+  assert list(tmp_path.iterdir()) == []
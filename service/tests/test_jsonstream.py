@@ -0,0 +1,105 @@
+import json
+import random
+import httpx
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from service.endpoints import proxy
+from service.json2tana import json_to_tana
+from service.jsonstream import JSONStream
+from service.outbound import Outbound
+from service.settings import settings
+
+def random_json(rng, depth=0):
+  kind = rng.random()
+  if depth > 3 or kind < 0.4:
+    return rng.choice([1, -2.5e3, 12345678901234, 'str"é\\', '', None, True, [], {}])
+  if kind < 0.7:
+    return [random_json(rng, depth + 1) for _ in range(rng.randrange(4))]
+  return {f'k{n}': random_json(rng, depth + 1) for n in range(rng.randrange(3))}
+
+def parse_in_pieces(rng, text):
+  stream = JSONStream()
+  values = []
+  pos = 0
+  while pos < len(text):
+    size = rng.randrange(1, 8)
+    values += stream.feed(text[pos:pos + size])
+    pos += size
+  return values + stream.close()
+
+def outcome(parse, text):
+  try:
+    value = parse(text)
+  except json.JSONDecodeError:
+    return 'error'
+  return value
+
+def test_matches_json_loads_in_any_pieces():
+  rng = random.Random(5)
+  for _ in range(5000):
+    text = json.dumps(random_json(rng), indent=rng.choice([None, 1]))
+    if rng.random() < 0.3:
+      # break it
+      pos = rng.randrange(len(text) + 1)
+      text = text[:pos] + rng.choice(['', ',', ']', 'x', ' ', '[', '"']) + text[pos + 1:]
+    expected = outcome(json.loads, text)
+    if expected != 'error' and type(expected) is not list:
+      expected = [expected]
+    assert outcome(lambda text: parse_in_pieces(rng, text), text) == expected, text
+
+def test_array_elements_come_out_as_they_complete():
+  stream = JSONStream()
+  assert stream.feed('[{"a": 1}, {"b"') == [{'a': 1}]
+  assert stream.feed(': 2}, 12') == [{'b': 2}]
+  # could be more digits to come
+  assert stream.feed('3') == []
+  assert stream.feed(']') == [123]
+  assert stream.close() == []
+
+def test_big_element_is_not_reparsed_per_piece():
+  stream = JSONStream()
+  attempts = 0
+  parse = stream._parse
+  def counted(final):
+    nonlocal attempts
+    attempts += 1
+    return parse(final)
+  stream._parse = counted
+  text = json.dumps([{'name': 'x' * 1_000_000}])
+  for pos in range(0, len(text), 100):
+    stream.feed(text[pos:pos + 100])
+  assert stream.close() == [{'name': 'x' * 1_000_000}]
+  assert attempts < 30
+
+
+# the proxy, against a pretend upstream
+UPSTREAM = {'/list': json.dumps([{'name': f'node {n}', 'F': 'v'} for n in range(2000)]),
+            '/object': json.dumps({'name': 'x', 'F': 'y'}),
+            '/bad': 'not json'}
+
+app = FastAPI()
+app.include_router(proxy.router)
+client = TestClient(app)
+
+@pytest.fixture(autouse=True)
+def upstream(monkeypatch):
+  def respond(request):
+    return httpx.Response(201, content=UPSTREAM[request.url.path].encode())
+  monkeypatch.setattr(proxy, 'outbound', Outbound(transport=httpx.MockTransport(respond)))
+
+def test_proxy_converts_as_before():
+  for path in ['/list', '/object']:
+    response = client.get(f'/proxy/GET/http://upstream{path}')
+    assert response.status_code == 201
+    assert response.text == json_to_tana(json.loads(UPSTREAM[path]))
+
+def test_proxy_reports_what_it_cant_convert():
+  response = client.get('/proxy/GET/http://upstream/bad')
+  assert response.status_code == 201
+  assert response.text == "Exception converting response to Tana format. Response was b'not json'"
+
+def test_proxy_caps_response_size(monkeypatch):
+  monkeypatch.setattr(settings, 'proxy_max_bytes', 1000)
+  response = client.get('/proxy/GET/http://upstream/list')
+  assert response.status_code == 502
@@ -0,0 +1,51 @@
+import sys
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from service.importprofile import by_package, parse_importtime
+from service.lazyrouter import LazyRoute, LazyRouters
+
+
+def make_app(module, prefixes):
+  app = FastAPI()
+  routers = LazyRouters(app)
+  routers.include(module, prefixes)
+  app.openapi = routers.openapi
+  return app, routers
+
+def test_module_loaded_on_first_request():
+  sys.modules.pop('service.endpoints.jsonify', None)
+  app, routers = make_app('service.endpoints.jsonify', ['/jsonify', '/tanify', '/tana-to-code', '/code-to-json'])
+  assert 'service.endpoints.jsonify' not in sys.modules
+  client = TestClient(app)
+
+  response = client.post('/tana-to-code', json='- a node')
+  assert response.status_code == 200
+  assert 'service.endpoints.jsonify' in sys.modules
+  # the stub is replaced by the real routes
+  assert not any(isinstance(route, LazyRoute) for route in app.router.routes)
+  assert client.post('/tana-to-code', json='- another node').status_code == 200
+  # unrelated paths still 404
+  assert client.get('/nothing').status_code == 404
+
+def test_missing_module_is_503():
+  app, _ = make_app('service.no_such_module', ['/missing'])
+  response = TestClient(app).get('/missing/thing')
+  assert response.status_code == 503
+  assert 'service.no_such_module' in response.json()['detail']
+
+def test_openapi_includes_lazy_routes():
+  app, _ = make_app('service.endpoints.jsonify', ['/jsonify'])
+  paths = TestClient(app).get('/openapi.json').json()['paths']
+  assert '/jsonify' in paths
+
+def test_parse_importtime():
+  output = '''import time: self [us] | cumulative | imported package
+import time:       120 |        120 |   encodings.aliases
+import time:       300 |        420 | encodings
+import time:      1000 |       1000 | pydantic.main
+import time:        50 |       1050 | pydantic
+'''
+  costs = parse_importtime(output)
+  assert [cost.name for cost in costs] == ['encodings.aliases', 'encodings', 'pydantic.main', 'pydantic']
+  assert costs[1].cumulative_us == 420
+  assert by_package(costs) == [('pydantic', 1050), ('encodings', 420)]
@@ -0,0 +1,84 @@
+import asyncio
+import logging
+import threading
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from service.loghub import LogHub, parse_level
+
+
+def make_logger(hub, name='test_loghub'):
+  log = logging.getLogger(name)
+  log.handlers = [hub]
+  log.propagate = False
+  log.setLevel(logging.DEBUG)
+  return log
+
+def test_ring_buffer_and_filters():
+  hub = LogHub(capacity=3)
+  log = make_logger(hub)
+  log.info('txid=1 start')
+  log.debug('detail')
+  log.warning('txid=2 careful')
+  log.info('txid=1 done', extra={'txid': 'other'})
+  # only the last three are kept
+  assert [entry.message for entry in hub.recent(10)] == ['detail', 'txid=2 careful', 'txid=1 done']
+  assert [entry.message for entry in hub.recent(10, levelno=logging.INFO)] == ['txid=2 careful', 'txid=1 done']
+  # an explicit txid wins over one in the message
+  assert [entry.message for entry in hub.recent(10, txid='other')] == ['txid=1 done']
+  assert hub.recent(1)[0].seq == 4
+
+def test_subscribe_replays_then_streams_across_threads():
+  hub = LogHub()
+  log = make_logger(hub, 'test_loghub_threads')
+  log.info('before 1')
+  log.info('before 2')
+
+  async def run():
+    with hub.subscribe(replay=1) as subscription:
+      thread = threading.Thread(target=lambda: log.info('from a thread'))
+      thread.start()
+      thread.join()
+      messages = []
+      while len(messages) < 2:
+        messages += [entry.message for entry in await asyncio.wait_for(subscription.get(), 1.0)]
+      return messages
+  assert asyncio.run(run()) == ['before 2', 'from a thread']
+  assert not hub.subscribers
+
+def test_slow_subscriber_drops_oldest():
+  hub = LogHub()
+  log = make_logger(hub, 'test_loghub_slow')
+
+  async def run():
+    with hub.subscribe(levelno=logging.WARNING, maxsize=2) as subscription:
+      for n in range(5):
+        log.warning(f'{n}')
+      log.info('filtered out')
+      await asyncio.sleep(0)
+      entries = await subscription.get()
+      return [entry.message for entry in entries], subscription.take_dropped()
+  assert asyncio.run(run()) == (['3', '4'], 3)
+
+def test_parse_level():
+  assert parse_level('warning') == logging.WARNING
+  assert parse_level('15') == 15
+  try:
+    parse_level('loud')
+    assert False, 'expected ValueError'
+  except ValueError:
+    pass
+
+def test_websocket_streams_new_records():
+  from service.endpoints import logmonitor
+  from service.loghub import log_hub
+  log = make_logger(log_hub, 'test_loghub_ws')
+  app = FastAPI()
+  app.include_router(logmonitor.router)
+  client = TestClient(app)
+  with client.websocket_connect('/ws/log?replay=0&format=json&txid=42') as websocket:
+    log.info('txid=7 not for us')
+    log.info('txid=42 hello')
+    message = websocket.receive_json()
+    assert [record['message'] for record in message['records']] == ['txid=42 hello']
+  assert client.get('/log/recent?count=1&txid=42').json()[0]['message'] == 'txid=42 hello'
+  assert client.get('/log/recent?level=loud').status_code == 400
@@ -0,0 +1,128 @@
+import asyncio
+import httpx
+import pytest
+from service.outbound import Outbound, cache_control
+from service.settings import settings
+
+
+def make_outbound(handler, monkeypatch, per_host=10, cache_bytes=1_000_000):
+  monkeypatch.setattr(settings, 'outbound_max_connections_per_host', per_host)
+  monkeypatch.setattr(settings, 'outbound_cache_bytes', cache_bytes)
+  return Outbound(transport=httpx.MockTransport(handler))
+
+def test_cache_control_parsing():
+  assert cache_control('public, max-age="60", No-Store') == {'public': None, 'max-age': '60', 'no-store': None}
+  assert cache_control(None) == {}
+
+def test_calls_to_a_host_are_limited(monkeypatch):
+  running = {}
+  most = {}
+  async def handler(request):
+    host = request.url.host
+    running[host] = running.get(host, 0) + 1
+    most[host] = max(most.get(host, 0), running[host])
+    await asyncio.sleep(0.02)
+    running[host] -= 1
+    return httpx.Response(200)
+
+  async def run():
+    outbound = make_outbound(handler, monkeypatch, per_host=2)
+    await asyncio.gather(*[outbound.client.post(f'http://{host}/') for host in ['a', 'b'] * 6])
+    stats = outbound.stats()
+    await outbound.close()
+    return stats
+
+  stats = asyncio.run(run())
+  assert most == {'a': 2, 'b': 2}
+  assert stats.requests_total == 12 and stats.hosts == []
+
+def test_streamed_response_holds_its_slot_until_closed(monkeypatch):
+  async def run():
+    outbound = make_outbound(lambda request: httpx.Response(200, content=b'body'), monkeypatch, per_host=1)
+    client = outbound.client
+    response = await client.send(client.build_request('GET', 'http://a/'), stream=True)
+    assert [(host.host, host.active) for host in outbound.stats().hosts] == [('http://a', 1)]
+    second = asyncio.create_task(client.post('http://a/'))
+    await asyncio.sleep(0.01)
+    assert not second.done() and outbound.stats().hosts[0].waiting == 1
+    await response.aclose()
+    assert (await second).status_code == 200
+    await outbound.close()
+
+  asyncio.run(run())
+
+@pytest.mark.parametrize('response_headers, request_headers, cached', [
+  ({'cache-control': 'max-age=60'}, {}, True),
+  ({'cache-control': 'public, s-maxage=60'}, {'authorization': 'Bearer x'}, True),
+  ({'cache-control': 'max-age=60'}, {'authorization': 'Bearer x'}, False),
+  ({'cache-control': 'public, max-age=60'}, {'cookie': 'session=x'}, False),
+  ({'cache-control': 'public, max-age=60'}, {'x-api-key': 'x'}, False),
+  ({'cache-control': 'private, max-age=60'}, {}, False),
+  ({'cache-control': 'no-store'}, {}, False),
+  ({'cache-control': 'max-age=60'}, {'cache-control': 'no-cache'}, False),
+  ({'cache-control': 'max-age=60', 'age': '60'}, {}, False),
+  ({'cache-control': 'max-age=60', 'set-cookie': 'a=b'}, {}, False),
+  ({'cache-control': 'max-age=60', 'vary': '*'}, {}, False),
+  ({}, {}, False),
+])
+def test_what_is_cached(monkeypatch, response_headers, request_headers, cached):
+  calls = []
+  def handler(request):
+    calls.append(request)
+    return httpx.Response(200, headers=response_headers, content=b'content')
+
+  async def run():
+    outbound = make_outbound(handler, monkeypatch)
+    for _ in range(2):
+      response = await outbound.client.get('http://a/thing', headers=request_headers)
+      assert response.content == b'content'
+    await outbound.close()
+    return response
+
+  response = asyncio.run(run())
+  assert len(calls) == (1 if cached else 2)
+  if cached:
+    assert response.headers['age'] == '0'
+
+def test_cache_expires_varies_and_is_bounded(monkeypatch):
+  calls = []
+  def handler(request):
+    calls.append(request.url.path)
+    return httpx.Response(200, headers={'cache-control': 'max-age=60', 'vary': 'accept'}, content=b'x' * 100)
+
+  async def run():
+    outbound = make_outbound(handler, monkeypatch, cache_bytes=1000)
+    client = outbound.client
+    await client.get('http://a/1', headers={'accept': 'text/plain'})
+    await client.get('http://a/1', headers={'accept': 'text/plain'})
+    await client.get('http://a/1', headers={'accept': 'text/html'})
+    assert calls == ['/1', '/1']
+    outbound.cache.entries['http://a/1'].expires = 0
+    await client.get('http://a/1', headers={'accept': 'text/html'})
+    assert calls == ['/1', '/1', '/1']
+    for n in range(20):
+      await client.get(f'http://a/{n}')
+    stats = outbound.stats()
+    assert stats.cache_bytes <= 1000 and stats.cache_entries == 10
+    assert stats.cache_hits_total == 1
+    assert 'tana_helper_outbound_cache_entries 10' in outbound.prometheus()
+    await outbound.close()
+
+  asyncio.run(run())
+
+def test_calls_with_cookies_are_not_answered_from_the_cache(monkeypatch):
+  def handler(request):
+    return httpx.Response(200, headers={'cache-control': 'public, max-age=60'},
+                          content=request.headers.get('cookie', 'nobody').encode())
+
+  async def run():
+    outbound = make_outbound(handler, monkeypatch)
+    assert (await outbound.client.get('http://a/me')).content == b'nobody'
+    assert (await outbound.client.get('http://a/me', headers={'cookie': 'alice'})).content == b'alice'
+    assert (await outbound.client.get('http://a/me')).content == b'nobody'
+    stats = outbound.stats()
+    await outbound.close()
+    return stats
+
+  stats = asyncio.run(run())
+  assert stats.cache_stores_total == 1 and stats.cache_hits_total == 1
@@ -0,0 +1,70 @@
+import asyncio
+import json
+import os
+import time
+import pytest
+from fastapi import HTTPException
+from fastapi.exceptions import RequestValidationError
+from benchmarks.synthetic import make_dump
+from service.endpoints.graph_view import render_graph
+from service.json2tana import tana_to_json
+from service.graph_pipeline import load_dump
+from service.processpool import ProcessPool, shard_key
+
+
+def test_results_and_errors_come_back():
+  async def run():
+    pool = ProcessPool(2)
+    try:
+      assert (await pool.run(tana_to_json, '- a node'))[0]['name'] == 'a node'
+      body = json.dumps(make_dump(100, 3, 3, 1, 2, 2)).encode()
+      content, media_type, _ = await pool.run(render_graph, body, None, None, key=shard_key(body))
+      graph = json.loads(content)
+      assert media_type == 'application/json' and graph['nodes'] and graph['links']
+      with pytest.raises(HTTPException) as e:
+        await pool.run(render_graph, body, None, None, None, 'nosuchnode', key=shard_key(body))
+      assert e.value.status_code == 404
+      with pytest.raises(RequestValidationError):
+        await pool.run(load_dump, b'{}')
+    finally:
+      pool.shutdown()
+  asyncio.run(run())
+
+def test_slow_task_times_out_and_process_is_replaced():
+  async def run():
+    pool = ProcessPool(1, timeout=1.0)
+    try:
+      stuck = await pool.run(os.getpid)
+      with pytest.raises(HTTPException) as e:
+        await pool.run(time.sleep, 30)
+      assert e.value.status_code == 504
+      assert await pool.run(os.getpid) != stuck
+      # the stuck process is gone, not left sleeping
+      with pytest.raises(OSError):
+        for _ in range(50):
+          os.kill(stuck, 0)
+          await asyncio.sleep(0.1)
+    finally:
+      pool.shutdown()
+  asyncio.run(run())
+
+def test_queue_is_bounded_and_loop_stays_free():
+  async def run():
+    pool = ProcessPool(1, queue_limit=2)
+    try:
+      await pool.run(time.sleep, 0)
+      # one running, one waiting, one turned away
+      tasks = [asyncio.create_task(pool.run(time.sleep, 0.5)) for _ in range(3)]
+      # the event loop isn't held up while they run
+      start = time.perf_counter()
+      await asyncio.sleep(0.1)
+      assert time.perf_counter() - start < 0.3
+      results = await asyncio.gather(*tasks, return_exceptions=True)
+      busy = [r for r in results if isinstance(r, HTTPException)]
+      assert len(busy) == 1 and busy[0].status_code == 503 and busy[0].headers['Retry-After']
+    finally:
+      pool.shutdown()
+  asyncio.run(run())
+
+def test_no_processes_runs_in_threadpool():
+  assert asyncio.run(ProcessPool(0).run(tana_to_json, '- a node'))[0]['name'] == 'a node'
@@ -0,0 +1,78 @@
+import asyncio
+import httpx
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from fastapi.testclient import TestClient
+from service.dependencies import get_openai_client
+from service.instrumentation import span
+from service.requestcontext import (RequestContextMiddleware, current_credentials, get_openai_api_key,
+                                    get_tana_api_token, request_id, use_credentials)
+from service.settings import settings
+
+
+def make_app():
+  app = FastAPI()
+  app.add_middleware(RequestContextMiddleware)
+
+  @app.get('/context')
+  def context(request: Request):
+    # a sync endpoint, so this runs in the threadpool
+    with span('llm'):
+      return {'txid': request_id.get(), 'header': request.headers.get('x-request-id'),
+              'openai': get_openai_api_key(), 'tana': get_tana_api_token()}
+
+  @app.get('/stream')
+  def stream():
+    return StreamingResponse(iter(['a', 'b', 'c']))
+
+  return app
+
+def test_request_id_and_credentials():
+  client = TestClient(make_app())
+  response = client.get('/context', headers={'x-openai-api-key': 'sk-one', 'x-tana-api-token': 'tana-one'})
+  body = response.json()
+  assert body['openai'] == 'sk-one' and body['tana'] == 'tana-one'
+  # a request id is made up, seen by the endpoint and returned
+  assert body['txid'] == body['header'] == response.headers['x-request-id']
+  assert response.headers['server-timing'].startswith('llm;dur=')
+
+  # credentials don't stick around for the next request
+  body = client.get('/context', headers={'x-request-id': 'given'}).json()
+  assert body['openai'] == settings.openai_api_key and body['tana'] == settings.tana_api_token
+  assert body['txid'] == 'given'
+
+def test_streaming_passes_through():
+  response = TestClient(make_app()).get('/stream')
+  assert response.text == 'abc'
+  assert 'x-request-id' in response.headers
+
+def test_credentials_carried_over():
+  with use_credentials(('sk-job', None)):
+    credentials = current_credentials()
+  assert current_credentials() == (None, None)
+  with use_credentials(credentials):
+    assert get_openai_api_key() == 'sk-job'
+    assert get_tana_api_token() == settings.tana_api_token
+
+def test_concurrent_requests_keep_their_own_keys():
+  app = FastAPI()
+  app.add_middleware(RequestContextMiddleware)
+
+  @app.get('/slow')
+  async def slow(delay:float):
+    # the other request starts and finishes while this one waits
+    await asyncio.sleep(delay)
+    return get_openai_api_key()
+
+  async def run():
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://test') as client:
+      return await asyncio.gather(*[client.get('/slow', params={'delay': delay}, headers={'x-openai-api-key': key})
+                                    for key, delay in [('sk-a', 0.05), ('sk-b', 0.0), ('sk-c', 0.02)]])
+  assert [response.json() for response in asyncio.run(run())] == ['sk-a', 'sk-b', 'sk-c']
+
+def test_openai_clients_pooled_per_key():
+  with use_credentials(('sk-a', None)):
+    first = get_openai_client()
+    assert get_openai_client() is first and first.api_key == 'sk-a'
+  with use_credentials(('sk-b', None)):
+    assert get_openai_client() is not first
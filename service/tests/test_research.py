@@ -0,0 +1,80 @@
+import asyncio
+import os
+import subprocess
+import sys
+import threading
+import time
+from service.endpoints.research import FAILED, READY, ResearchStack
+from service.fanout import RateLimiter, ordered_map
+from service.instrumentation import current_span, span
+from service.requestcontext import current_credentials, use_credentials
+
+
+def test_router_import_leaves_llama_index_alone():
+  code = 'import sys, service.endpoints.research; print("llama_index" in sys.modules)'
+  service_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+  result = subprocess.run([sys.executable, '-c', code], cwd=service_dir, capture_output=True, text=True, check=True)
+  assert result.stdout.strip() == 'False'
+
+def test_stack_loads_once_on_first_use():
+  async def run():
+    # any importable module will do. With no warm_up() the index step just logs
+    stack = ResearchStack(module='colorsys')
+    first, second = await asyncio.gather(stack.load(), stack.load())
+    assert first is second and first.__name__ == 'colorsys'
+    assert stack.status.state == READY and stack.status.import_seconds is not None
+    assert await stack.load() is first
+  asyncio.run(run())
+
+def test_failed_load_is_retried():
+  async def run():
+    stack = ResearchStack(module='service.no_such_module')
+    try:
+      await stack.load()
+      assert False, 'expected ImportError'
+    except ImportError:
+      pass
+    assert stack.status.state == FAILED
+    stack.module_name = 'colorsys'
+    assert (await stack.load()).__name__ == 'colorsys'
+  asyncio.run(run())
+
+def test_questions_fan_out_in_order_within_the_rate_limit():
+  # a pretend research stack: a retrieve and a summarize call per question,
+  # later questions finishing first
+  limiter = RateLimiter(20)
+  calls = []
+  running = 0
+  most = 0
+  lock = threading.Lock()
+  def research_question(question):
+    nonlocal running, most
+    with lock:
+      running += 1
+      most = max(most, running)
+    for _ in ['retrieve', 'summarize']:
+      limiter.wait()
+      calls.append(time.monotonic())
+      time.sleep(0.01 * (6 - question))
+    with lock:
+      running -= 1
+    return {'question': question}
+
+  results = list(ordered_map(research_question, range(6), 3))
+  assert [result['question'] for result in results] == list(range(6))
+  assert most == 3
+  calls.sort()
+  assert all(later - earlier >= 0.05 - 0.005 for earlier, later in zip(calls, calls[1:]))
+
+def test_questions_keep_the_request_context():
+  def research_question(question):
+    with span('llm'):
+      return current_credentials()
+
+  with span('request') as request:
+    with use_credentials(('openai key', 'tana token')):
+      results = list(ordered_map(research_question, range(4), 2))
+    assert current_span.get() is request
+  assert results == [('openai key', 'tana token')] * 4
+  # the steps' spans are the request's stages
+  assert [child.name for child in request.children] == ['llm'] * 4
@@ -0,0 +1,78 @@
+from fastapi import FastAPI, Request
+from fastapi.testclient import TestClient
+import asyncio
+import os
+from service.streaming import StreamEvent, file_chunks, sse_message, stream_response
+from service.txntimer import StageTimings
+
+app = FastAPI()
+
+def tokens():
+  yield 'Hello'
+  yield StreamEvent('progress', 'half way')
+  yield ' world'
+
+async def failing():
+  yield 'partial'
+  raise RuntimeError('model went away')
+
+@app.get('/sync')
+def sync_stream(request: Request):
+  return stream_response(request, tokens())
+
+@app.get('/failing')
+def failing_stream(request: Request):
+  return stream_response(request, failing())
+
+timings = StageTimings()
+
+def staged():
+  # stages held open across yields, as stream_research does. Each step
+  # runs in its own copy of the context
+  with timings.stage('research'):
+    yield from ['question', ' summary']
+  with timings.stage('answer'):
+    for token in [' the', ' answer']:
+      yield token
+  yield ' done'
+
+@app.get('/staged')
+def staged_stream(request: Request):
+  return stream_response(request, staged())
+
+client = TestClient(app)
+
+
+def test_sse_message_splits_lines():
+  assert sse_message('a\nb', 'done') == 'event: done\ndata: a\ndata: b\n\n'
+
+def test_plain_clients_get_just_the_text():
+  response = client.get('/sync')
+  assert response.headers['content-type'].startswith('text/plain')
+  assert response.text == 'Hello world'
+
+def test_sse_clients_get_events():
+  response = client.get('/sync', headers={'Accept': 'text/event-stream'})
+  assert response.headers['content-type'].startswith('text/event-stream')
+  assert response.text == 'data: Hello\n\nevent: progress\ndata: half way\n\ndata:  world\n\n'
+
+def test_errors_mid_stream_become_error_events():
+  response = client.get('/failing', headers={'Accept': 'text/event-stream'})
+  assert response.text == 'data: partial\n\nevent: error\ndata: model went away\n\n'
+  assert client.get('/failing').text == 'partial'
+
+def test_file_chunks_remove_the_file(tmp_path):
+  path = tmp_path / 'out.txt'
+  path.write_bytes(b'x' * 1000)
+
+  async def read():
+    return [chunk async for chunk in file_chunks(str(path), remove=True, size=300)]
+
+  chunks = asyncio.run(read())
+  assert b''.join(chunks) == b'x' * 1000 and len(chunks) == 4
+  assert not os.path.exists(path)
+
+def test_stages_can_stay_open_across_yields():
+  response = client.get('/staged')
+  assert response.text == 'question summary the answer done'
+  assert set(timings.durations) == {'research', 'answer'}
@@ -0,0 +1,119 @@
+import asyncio
+import json
+import httpx
+from service.tanainput import AsyncTanaInputAPIClient, TanaInputAPIError
+
+
+def make_client(handler, **kwargs):
+  client = AsyncTanaInputAPIClient(window=0.05, min_interval=0, backoff=0.01, **kwargs)
+  client.client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+  return client
+
+def test_adds_to_same_target_are_coalesced():
+  calls = []
+  def handler(request):
+    calls.append(json.loads(request.content))
+    return httpx.Response(200, json={'ok': True})
+
+  async def run():
+    client = make_client(handler)
+    results = await asyncio.gather(*[client.add_nodes([{'name': f'node {i}'}], 'INBOX', 'token') for i in range(5)],
+                                   client.add_nodes([{'name': 'elsewhere'}], 'OTHER', 'token'))
+    assert all(result.status_code == 200 for result in results)
+
+  asyncio.run(run())
+  assert len(calls) == 2
+  inbox = [call for call in calls if call['targetNodeId'] == 'INBOX'][0]
+  assert [node['name'] for node in inbox['nodes']] == [f'node {i}' for i in range(5)]
+
+def test_retries_rate_limited_calls():
+  responses = [httpx.Response(429, headers={'Retry-After': '0'}), httpx.Response(429), httpx.Response(200)]
+  def handler(request):
+    return responses.pop(0)
+
+  async def run():
+    client = make_client(handler)
+    return await client.add_nodes([{'name': 'node'}], auth_token='token')
+
+  assert asyncio.run(run()).status_code == 200
+  assert responses == []
+
+def test_retries_only_when_nodes_werent_sent():
+  calls = []
+  def handler(request):
+    calls.append(request)
+    if len(calls) == 1:
+      raise httpx.ConnectError('refused', request=request)
+    if len(calls) == 2:
+      raise httpx.ReadTimeout('no response', request=request)
+    return httpx.Response(500)
+
+  async def add(client):
+    try:
+      return await client.add_nodes([{'name': 'node'}], auth_token='token')
+    except Exception as e:
+      return e
+
+  async def run():
+    client = make_client(handler)
+    # connect fails, so retried; the read times out, maybe after the nodes were added
+    timed_out = await add(client)
+    # a 500 may have added them too
+    server_error = await add(client)
+    return timed_out, server_error
+
+  timed_out, server_error = asyncio.run(run())
+  assert isinstance(timed_out, httpx.ReadTimeout)
+  assert isinstance(server_error, TanaInputAPIError) and server_error.status_code == 500
+  assert len(calls) == 3
+
+def test_callers_get_their_own_calls_result():
+  def handler(request):
+    names = [node['name'] for node in json.loads(request.content)['nodes']]
+    return httpx.Response(400, text='bad node') if 'bad' in names else httpx.Response(200)
+
+  async def add(client, name):
+    try:
+      return await client.add_nodes([{'name': name}], 'INBOX', 'token')
+    except TanaInputAPIError as e:
+      return e
+
+  async def run():
+    client = make_client(handler, max_batch=2)
+    return await asyncio.gather(add(client, 'one'), add(client, 'two'), add(client, 'bad'))
+
+  one, two, bad = asyncio.run(run())
+  assert one.status_code == 200 and two.status_code == 200
+  assert isinstance(bad, TanaInputAPIError)
+
+def test_gives_up_with_error():
+  def handler(request):
+    return httpx.Response(400, text='bad node')
+
+  async def run():
+    client = make_client(handler)
+    try:
+      await client.add_nodes([{'name': 'node'}], auth_token='token')
+    except TanaInputAPIError as e:
+      return e
+
+  error = asyncio.run(run())
+  assert error.status_code == 400 and error.detail == 'bad node'
+
+def test_uses_request_token_by_default():
+  from service.requestcontext import use_credentials
+  tokens = []
+  def handler(request):
+    tokens.append(request.headers['Authorization'])
+    return httpx.Response(200)
+
+  async def run():
+    client = make_client(handler)
+    async def add(token):
+      with use_credentials((None, token)):
+        return await client.add_nodes([{'name': token}])
+    await asyncio.gather(add('one'), add('two'))
+
+  asyncio.run(run())
+  # different tokens are never batched together
+  assert sorted(tokens) == ['Bearer one', 'Bearer two']
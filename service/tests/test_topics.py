@@ -0,0 +1,32 @@
+import json
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from pydantic import TypeAdapter
+from typing import List
+from benchmarks.synthetic import make_dump
+from service.endpoints import class_diagram, graph_view, topics
+from service.processpool import ProcessPool
+from service.tana_types import TanaDocument, TanaDump
+
+app = FastAPI()
+for module in [topics, graph_view, class_diagram]:
+  app.include_router(module.router)
+client = TestClient(app)
+
+@pytest.fixture(autouse=True)
+def in_process(monkeypatch):
+  # in this process, so every call shares the one cached dump
+  for module in [topics, graph_view, class_diagram]:
+    monkeypatch.setattr(module, 'process_pool', ProcessPool(0))
+
+def test_same_dump_gives_same_topics():
+  body = json.dumps(make_dump(300, 5, 5, 1, 2, 7)).encode()
+  first = client.post('/topics?format=JSON', content=body)
+  assert first.status_code == 200 and first.json()
+  for path in ['/topics?format=JSON', '/graph', '/class_diagram']:
+    assert client.post(path, content=body).status_code == 200
+  assert client.post('/topics?format=JSON', content=body).content == first.content
+  # and the same as from a dump of its own, as preload does
+  own = topics.topics_from_dump(TanaDump.model_validate_json(body), 'JSON')
+  assert first.content == TypeAdapter(List[TanaDocument]).dump_json(own)
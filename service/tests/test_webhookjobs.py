@@ -0,0 +1,100 @@
+import asyncio
+import os
+import tempfile
+from fastapi import HTTPException
+from service.webhookjobs import DONE, FAILED, QUEUED, RUNNING, WebhookJobQueue
+from service.workers import BOOT_ID
+
+
+async def echo(schema, body):
+  if body == 'bad':
+    raise HTTPException(status_code=400, detail='bad body')
+  return f'{schema}:{body}'.encode('utf-8')
+
+async def wait_for(queue, job_id, status):
+  for _ in range(100):
+    job = queue.get(job_id)
+    if job.status == status:
+      return job
+    await asyncio.sleep(0.01)
+  raise AssertionError(f'job {job_id} never reached {status}')
+
+def test_jobs_run_in_background_and_record_results():
+  async def run():
+    with tempfile.TemporaryDirectory() as tmp:
+      queue = WebhookJobQueue(os.path.join(tmp, 'jobs.db'), echo, workers=2)
+      good = await queue.submit('person', 'hello')
+      bad = await queue.submit('person', 'bad')
+      assert (await wait_for(queue, good.id, DONE)).result == 'person:hello'
+      failed = await wait_for(queue, bad.id, FAILED)
+      assert failed.status_code == 400 and failed.error == 'bad body'
+      metrics = queue.metrics()['person']
+      assert metrics.submitted == 2 and metrics.completed == 1 and metrics.failed == 1
+      await queue.stop()
+  asyncio.run(run())
+
+def test_queued_jobs_survive_restart():
+  async def run():
+    with tempfile.TemporaryDirectory() as tmp:
+      db_path = os.path.join(tmp, 'jobs.db')
+      stalled = WebhookJobQueue(db_path, echo, workers=0)
+      job = await stalled.submit('person', 'later')
+      assert stalled.get(job.id).status == QUEUED
+      await stalled.stop()
+
+      restarted = WebhookJobQueue(db_path, echo, workers=1)
+      await restarted.start()
+      assert (await wait_for(restarted, job.id, DONE)).result == 'person:later'
+      await restarted.stop()
+  asyncio.run(run())
+
+def test_running_jobs_only_resumed_from_an_earlier_boot():
+  async def run():
+    with tempfile.TemporaryDirectory() as tmp:
+      db_path = os.path.join(tmp, 'jobs.db')
+      stalled = WebhookJobQueue(db_path, echo, workers=0)
+      ours = await stalled.submit('person', 'ours')
+      theirs = await stalled.submit('person', 'theirs')
+      # one claimed by a worker process started along with this one, one by a process since gone
+      stalled._execute('UPDATE jobs SET status=?, boot=? WHERE id=?', (RUNNING, BOOT_ID, ours.id))
+      stalled._execute('UPDATE jobs SET status=?, boot=? WHERE id=?', (RUNNING, 'earlier', theirs.id))
+      await stalled.stop()
+
+      restarted = WebhookJobQueue(db_path, echo, workers=1)
+      await restarted.start()
+      assert (await wait_for(restarted, theirs.id, DONE)).result == 'person:theirs'
+      assert restarted.get(ours.id).status == RUNNING
+      await restarted.stop()
+  asyncio.run(run())
+
+def test_job_claimed_once():
+  async def run():
+    with tempfile.TemporaryDirectory() as tmp:
+      db_path = os.path.join(tmp, 'jobs.db')
+      runs = []
+      async def count(schema, body):
+        runs.append(body)
+        return b'ok'
+      # two processes' queues over the same database, both told about the job
+      first = WebhookJobQueue(db_path, count, workers=0)
+      second = WebhookJobQueue(db_path, count, workers=0)
+      job = await first.submit('person', 'once')
+      await first._run(job.id)
+      await second._run(job.id)
+      assert runs == ['once'] and second.get(job.id).status == DONE
+      await first.stop()
+      await second.stop()
+  asyncio.run(run())
+
+def test_workers_sharing_the_jobs_table_make_distinct_ids():
+  async def run():
+    with tempfile.TemporaryDirectory() as tmp:
+      db_path = os.path.join(tmp, 'jobs.db')
+      # as if two worker processes, submitting in the same millisecond
+      queues = [WebhookJobQueue(db_path, echo, workers=0) for _ in range(2)]
+      jobs = await asyncio.gather(*[queue.submit('person', 'hi') for queue in queues for _ in range(50)])
+      assert len({job.id for job in jobs}) == 100
+      assert all(queues[0].get(job.id) is not None for job in jobs)
+      for queue in queues:
+        await queue.stop()
+  asyncio.run(run())
@@ -0,0 +1,58 @@
+import json
+import os
+import tempfile
+import pytest
+from jinja2 import TemplateSyntaxError
+from service.webhookschemas import SchemaRegistry, SchemaSettings
+
+
+def test_saved_templates_render_without_reading_files():
+  with tempfile.TemporaryDirectory() as tmp:
+    registry = SchemaRegistry(tmp)
+    registry.save_template('person', 'CONTEXT: {{ context }}')
+    assert registry.names() == ['person']
+    assert os.path.exists(registry.template_file('person'))
+
+    schema = registry.get('person')
+    prompt = schema.render('see (https://example.com/x) and "http://a.b" ' + 'x' * 7000)
+    assert 'http' not in prompt
+    assert prompt == 'CONTEXT: ' + ('see  and  ' + 'x' * 7000)[:6000]
+    assert schema.settings.model == 'gpt-4'
+
+    with pytest.raises(TemplateSyntaxError):
+      registry.save_template('broken', '{{ context ')
+    assert registry.get('broken') is None
+
+    registry.save_settings('person', SchemaSettings(model='gpt-3.5-turbo', max_context=10))
+    assert registry.get('person').settings.model == 'gpt-3.5-turbo'
+    assert registry.get('person').render('0123456789abc') == 'CONTEXT: 0123456789'
+
+    registry.remove('person')
+    assert registry.get('person') is None and os.listdir(tmp) == []
+
+
+def test_refresh_picks_up_changed_files():
+  with tempfile.TemporaryDirectory() as tmp:
+    with open(os.path.join(tmp, 'task.jn2'), 'w') as f:
+      f.write('one {{ context }}')
+    registry = SchemaRegistry(tmp)
+    registry.refresh()
+    first = registry.get('task')
+    assert first.render('x') == 'one x'
+
+    # unchanged files aren't recompiled
+    registry.refresh()
+    assert registry.get('task') is first
+
+    with open(os.path.join(tmp, 'task.jn2'), 'w') as f:
+      f.write('two {{ context }}')
+    with open(os.path.join(tmp, 'task.settings.json'), 'w') as f:
+      json.dump({'max_tokens': 50}, f)
+    os.utime(os.path.join(tmp, 'task.jn2'), ns=(1, 1))
+    registry.refresh()
+    assert registry.get('task').render('x') == 'two x'
+    assert registry.get('task').settings.max_tokens == 50
+
+    os.remove(os.path.join(tmp, 'task.jn2'))
+    registry.refresh()
+    assert registry.names() == []
@@ -20,6 +20,9 @@ export default function Visualizer() {
   const dimensions = useDimensions(containerRef);
   const { graphData, loading, twoDee } = useContext(TanaHelperContext)
   const fgRef = useRef(null);
+  // if the server already laid out the graph, don't run the simulation again
+  const prelaid = graphData?.nodes.length > 0 && graphData.nodes[0].x !== undefined;
+  const cooldownTicks = prelaid ? 0 : Infinity;
 
   // TODO: rework this to be cleaner React.
   // See example:
@@ -66,6 +69,8 @@ export default function Visualizer() {
                 node.fz = node.z;
               }}
               linkColor={() => 'rgba(255,255,255,0.0)'}
+              nodeVal={node => 1 + (node.collapsed ?? 0)}
+              cooldownTicks={cooldownTicks}
               width={dimensions.width}
               height={dimensions.height}
             />
@@ -77,7 +82,8 @@ export default function Visualizer() {
                 node.fy = node.y;
                 node.fz = node.z;
               }}
-
+              nodeVal={node => 1 + (node.collapsed ?? 0)}
+              cooldownTicks={cooldownTicks}
               width={dimensions.width}
               height={dimensions.height}
             />
@@ -6,6 +6,7 @@ import { GraphData } from 'react-force-graph-3d';
 import axios from 'axios';
 import { Id, Index } from "flexsearch-ts";
 import { TanaHelperContext } from "../TanaHelperContext";
+import { GRAPH_ACCEPT, decodeGraphResponse } from "./graphcodec";
 
 interface GraphConfig {
   include_all_nodes: boolean;
@@ -53,13 +54,17 @@ export default function VisualizerControls() {
   useEffect(() => {
     if (upload) {
       setLoading(true);
-      axios.post('/graph', dumpFile, {
+      // ask for the compact binary graph encoding. Much faster for big graphs
+      // and have the server lay out the graph, so the browser doesn't have to
+      axios.post(`/graph?layout=${twoDee ? 2 : 3}`, dumpFile, {
         headers: {
           "Content-Type": "application/json",
-        }
+          "Accept": GRAPH_ACCEPT,
+        },
+        responseType: 'arraybuffer',
       })
         .then(response => {
-          let new_graph = response.data as GraphData;
+          let new_graph = decodeGraphResponse(response.data, response.headers['content-type']);
           setRawGraphData(new_graph);
           // buld new search index
           if (new_graph) {
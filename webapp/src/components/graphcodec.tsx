@@ -0,0 +1,98 @@
+/*
+  Decoder for the compact binary graph format returned by /graph
+  when we ask for it via the Accept header.
+
+  See service/service/graphcodec.py for the encoder and layout.
+*/
+
+import { GraphData } from 'react-force-graph-3d';
+
+export const GRAPH_MEDIA_TYPE = 'application/vnd.tana-helper.graph';
+
+// Accept header for /graph requests: binary preferred, JSON as fallback
+export const GRAPH_ACCEPT = `${GRAPH_MEDIA_TYPE}, application/json;q=0.9`;
+
+const GRAPH_MAGIC = 'TGRF';
+
+const ARRAY_TYPES = {
+  uint8: Uint8Array,
+  uint32: Uint32Array,
+  float32: Float32Array,
+};
+
+interface GraphHeader {
+  directed: boolean;
+  multigraph: boolean;
+  node_count: number;
+  link_count: number;
+  ids: string[];
+  names: (string | null)[];
+  colors: (string | null)[];
+  reasons: string[];
+  arrays: { name: string, type: string, length: number }[];
+}
+
+// returns the header and a dictionary of typed arrays by name
+export function decodeGraphArrays(buffer: ArrayBuffer) {
+  const view = new DataView(buffer);
+  const magic = String.fromCharCode(...new Uint8Array(buffer, 0, 4));
+  if (magic != GRAPH_MAGIC) {
+    throw new Error(`Not a binary graph payload (magic ${magic})`);
+  }
+  // version is at offset 4, we only know version 1 so far
+  const header_length = view.getUint32(8, true);
+  const header: GraphHeader = JSON.parse(new TextDecoder().decode(new Uint8Array(buffer, 12, header_length)));
+
+  let offset = 12 + header_length;
+  const arrays = {};
+  header.arrays.forEach((spec) => {
+    const ArrayType = ARRAY_TYPES[spec.type];
+    if (!ArrayType) {
+      throw new Error(`Unknown array type ${spec.type} for ${spec.name}`);
+    }
+    const size = spec.length * ArrayType.BYTES_PER_ELEMENT;
+    arrays[spec.name] = new ArrayType(buffer, offset, spec.length);
+    // every array starts on a 4 byte boundary
+    offset += size + ((4 - size % 4) % 4);
+  });
+
+  return { header, arrays };
+}
+
+export function decodeGraph(buffer: ArrayBuffer): GraphData {
+  const { header, arrays } = decodeGraphArrays(buffer);
+  const { ids, names, colors, reasons } = header;
+
+  const nodes = ids.map((id, i) => ({ id: id, name: names[i], color: colors[i] }));
+  // only present if the server collapsed leaf nodes
+  const collapsed: Uint32Array | undefined = arrays['collapsed'];
+  if (collapsed) {
+    nodes.forEach((node, i) => { node['collapsed'] = collapsed[i]; });
+  }
+  // only present if we asked for a precomputed layout
+  ['x', 'y', 'z'].forEach((axis) => {
+    const values: Float32Array | undefined = arrays[axis];
+    if (values) {
+      nodes.forEach((node, i) => { node[axis] = values[i]; });
+    }
+  });
+
+  const source: Uint32Array = arrays['source'];
+  const target: Uint32Array = arrays['target'];
+  const reason: Uint8Array = arrays['reason'];
+  const links = new Array(header.link_count);
+  for (let i = 0; i < header.link_count; i++) {
+    links[i] = { source: ids[source[i]], target: ids[target[i]], reason: reasons[reason[i]] };
+  }
+
+  return { nodes: nodes, links: links } as GraphData;
+}
+
+// decode a /graph response fetched with responseType 'arraybuffer'
+// the server may still answer with JSON, so check the content type
+export function decodeGraphResponse(data: ArrayBuffer, content_type: string | undefined): GraphData {
+  if (content_type && content_type.startsWith(GRAPH_MEDIA_TYPE)) {
+    return decodeGraph(data);
+  }
+  return JSON.parse(new TextDecoder().decode(data)) as GraphData;
+}